@@ -0,0 +1,128 @@
+import os
+import json
+import hashlib
+import threading
+import collections
+import numpy as np
+import torch
+
+# Content-addressed cache of SAM image embeddings.
+#
+# The image encoder is where nearly all of SAM's time goes, but its output only
+# depends on the pixels and the model. Embeddings are keyed by a hash of the
+# image plus the model type, kept in a small in-memory LRU and written to disk
+# as .npy files that are memory-mapped on the way back in. Re-segmenting the
+# same image with other generator parameters or prompts then skips the encoder.
+#
+#   cache = EmbeddingCache("embedding_cache", model_type="vit_h")
+#   predictor = FeaturePredictor(sam, cache=cache)     # from sam_batch
+#
+# An entry is (features, original_size, input_size), the state SamPredictor
+# keeps after set_image().
+
+CACHE_DIR = "embedding_cache"
+
+
+def image_key(image, model_type):
+    """Hash an RGB image's pixels, shape and the model type into a cache key"""
+    digest = hashlib.sha256()
+    digest.update(model_type.encode('utf-8'))
+    digest.update(str(image.shape).encode('utf-8'))
+    digest.update(np.ascontiguousarray(image).data)
+    return f"{model_type}_{digest.hexdigest()[:32]}"
+
+
+class EmbeddingCache:
+    """Two-tier (memory LRU + memory-mapped .npy) cache of image embeddings
+    Args:
+        cache_dir: Directory for the on-disk tier, None to keep embeddings in memory only
+        model_type: Model the embeddings come from ("vit_h", "vit_b", ...), part of every key
+        max_items: Embeddings kept in memory, a vit_h embedding is 4MB
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, model_type="vit_h", max_items=32):
+        self.cache_dir = cache_dir
+        self.model_type = model_type
+        self.max_items = max_items
+        self._memory = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def key(self, image):
+        return image_key(image, self.model_type)
+
+    def _paths(self, key):
+        base = os.path.join(self.cache_dir, key)
+        return base + ".npy", base + ".json"
+
+    def get(self, key, device=None):
+        """Return the cached (features, original_size, input_size) for a key, or None"""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                features, original_size, input_size = self._memory[key]
+                return features.to(device) if device is not None else features, original_size, input_size
+
+        if self.cache_dir:
+            features_path, info_path = self._paths(key)
+            try:
+                with open(info_path) as f:
+                    info = json.load(f)
+                # copy-on-write map, pages are read from disk only when the tensor is used
+                features = torch.from_numpy(np.load(features_path, mmap_mode='c'))
+            except (OSError, ValueError):
+                features = None
+            if features is not None:
+                entry = (features, tuple(info['original_size']), tuple(info['input_size']))
+                self._remember(key, entry)
+                with self._lock:
+                    self.disk_hits += 1
+                return features.to(device) if device is not None else features, entry[1], entry[2]
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, features, original_size, input_size):
+        """Store an embedding in both tiers"""
+        features = features.detach().to('cpu')
+        entry = (features, tuple(original_size), tuple(input_size))
+        self._remember(key, entry)
+
+        if self.cache_dir:
+            features_path, info_path = self._paths(key)
+            # write to temporary names first so a reader never sees half a file
+            with open(features_path + ".partial", 'wb') as f:
+                np.save(f, features.numpy())
+            with open(info_path + ".partial", 'w') as f:
+                json.dump({'original_size': list(entry[1]), 'input_size': list(entry[2]),
+                           'model_type': self.model_type}, f)
+            os.replace(features_path + ".partial", features_path)
+            os.replace(info_path + ".partial", info_path)
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._memory[key] = entry
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_items:
+                self._memory.popitem(last=False)
+
+    def clear_memory(self):
+        with self._lock:
+            self._memory.clear()
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            'memory_items': len(self._memory),
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else None,
+        }
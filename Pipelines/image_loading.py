@@ -0,0 +1,148 @@
+import io
+import time
+import argparse
+import numpy as np
+import cv2
+from PIL import Image
+
+# Image loading at the size that is actually needed.
+#
+# A JPEG can be decoded at 1/2, 1/4 or 1/8 of its size by skipping the
+# high-frequency DCT coefficients, which is several times faster than a full
+# decode followed by a resize. A 6000 pixel A6700 still only needs a 1/4 decode
+# for SAM's 1024 pixel input, and a 1/8 decode for a thumbnail. load_rgb()
+# reads the size from the header, picks the largest reduction that still
+# covers the requested long side, decodes straight to RGB and resizes the rest
+# of the way with INTER_AREA. Other formats are decoded at full size.
+#
+#   image = load_rgb("test1.jpg")                   # full size RGB
+#   image = load_rgb(jpeg_bytes, max_side=1024)     # SAM input size, 1/4 decode of a 24 MP frame
+#   image = load_rgb("test1.jpg", 256, method='pil')
+#
+# python image_loading.py test1.jpg prints the decode time per target size.
+
+REDUCTIONS = (8, 4, 2)
+REDUCED_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+                 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+# OpenCV 4.10+ can decode to RGB directly, older versions decode to BGR and convert
+COLOR_RGB = getattr(cv2, 'IMREAD_COLOR_RGB', None)
+
+
+def _open(source):
+    return Image.open(io.BytesIO(source) if isinstance(source, (bytes, bytearray, memoryview)) else source)
+
+
+def image_info(source):
+    """(format, (h, w)) from the image header, without decoding the pixels"""
+    with _open(source) as image:
+        return image.format, (image.height, image.width)
+
+
+def reduction_for(size, max_side):
+    """Largest JPEG DCT reduction whose output still has a long side of at least max_side"""
+    if not max_side:
+        return 1
+    for factor in REDUCTIONS:
+        if max(size) / factor >= max_side:
+            return factor
+    return 1
+
+
+def fit(image, max_side):
+    """Downscale an image with INTER_AREA so its long side is at most max_side"""
+    h, w = image.shape[:2]
+    if not max_side or max(h, w) <= max_side:
+        return image
+    scale = max_side / max(h, w)
+    return cv2.resize(image, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+
+
+def _decode_cv2(source, reduction):
+    flags = REDUCED_FLAGS[reduction]
+    if COLOR_RGB is not None:
+        flags = (flags & ~cv2.IMREAD_COLOR) | COLOR_RGB
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        image = cv2.imdecode(np.frombuffer(source, np.uint8), flags)
+    else:
+        image = cv2.imread(source, flags)
+    if image is None:
+        raise ValueError("Could not decode image")
+    return image if COLOR_RGB is not None else cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=image)
+
+
+def _decode_pil(source, max_side):
+    with _open(source) as image:
+        if max_side and max(image.size) > max_side:
+            # draft() only picks a DCT scale for JPEGs (keeping both sides at least the requested
+            # size), other formats ignore it
+            scale = max_side / max(image.size)
+            image.draft('RGB', (int(np.ceil(image.width * scale)), int(np.ceil(image.height * scale))))
+        return np.array(image.convert('RGB'))
+
+
+def load_rgb(source, max_side=None, method='cv2'):
+    """Decode an image to an RGB array, using a reduced JPEG decode when max_side allows it
+    Args:
+        source: Path or encoded bytes
+        max_side: Long side of the result, full size by default (images are never upscaled)
+        method: 'cv2' (IMREAD_REDUCED_*) or 'pil' (Image.draft)
+    Returns:
+        HxWx3 uint8 RGB array
+    """
+    if method == 'pil':
+        return fit(_decode_pil(source, max_side), max_side)
+    reduction = 1
+    if max_side:
+        try:
+            format, size = image_info(source)
+        except Exception:
+            format, size = None, None
+        if format == 'JPEG':
+            reduction = reduction_for(size, max_side)
+    return fit(_decode_cv2(source, reduction), max_side)
+
+
+def benchmark(source, sizes=(None, 2048, 1024, 512, 256), repeats=5):
+    """Median decode time of a full decode + resize against the reduced paths, per target size
+    Returns:
+        List of dicts with max_side, method, seconds and the output shape
+    """
+    if not isinstance(source, (bytes, bytearray)):
+        with open(source, 'rb') as f:
+            source = f.read()
+    methods = {
+        'full': lambda side: fit(_decode_cv2(source, 1), side),
+        'cv2': lambda side: load_rgb(source, side),
+        'pil': lambda side: load_rgb(source, side, method='pil'),
+    }
+    rows = []
+    for side in sizes:
+        for method, fn in methods.items():
+            times = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                image = fn(side)
+                times.append(time.perf_counter() - start)
+            rows.append({'max_side': side, 'method': method, 'seconds': float(np.median(times)),
+                         'shape': image.shape[:2]})
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time full and reduced JPEG decodes at several target sizes")
+    parser.add_argument('image')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[0, 2048, 1024, 512, 256],
+                        help="target long sides, 0 for full size")
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    format, (h, w) = image_info(args.image)
+    print(f"{args.image}: {format} {w}x{h}")
+    print(f"{'max side':>9} {'method':>6} {'ms':>8} {'output':>11}")
+    for row in benchmark(args.image, [side or None for side in args.sizes], args.repeats):
+        out_h, out_w = row['shape']
+        print(f"{row['max_side'] or 'full':>9} {row['method']:>6} {row['seconds'] * 1000:8.1f} {f'{out_w}x{out_h}':>11}")
+
+
+if __name__ == "__main__":
+    main()
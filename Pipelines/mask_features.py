@@ -0,0 +1,208 @@
+import json
+import argparse
+import numpy as np
+import cv2
+import mask_rle
+import image_loading
+
+# Per-mask features for weed classification.
+#
+# The pixels of every mask are gathered from its RLE runs once, and every
+# feature is then a bincount over the gathered pixels, so the cost is a few
+# passes over the image plus the total mask area, with no loop over pixels.
+# Masks are handled in chunks of at most MAX_CHUNK_PIXELS gathered pixels, so
+# memory stays bounded however much the masks cover; colour conversions and
+# vegetation indices are computed on the gathered pixels only.
+# SAM's masks overlap and nest (a plant and its leaves), and each mask is
+# measured over all of its own pixels: area and bbox match the generator's
+# 'area' and the RLE, whatever other masks cover.
+#
+#   features = extract_features(image, masks)     # {'mask_index': array, 'area': array, ...}
+#
+# Vegetation indices are computed from chromatic coordinates (r = R/(R+G+B)...):
+#   ExG = 2g - r - b, ExR = 1.4r - g, ExGR = ExG - ExR,
+#   GLI = (2G - R - B) / (2G + R + B), VARI = (G - R) / (G + R - B)
+# Hue is averaged on the circle, in degrees.
+
+MAX_CHUNK_PIXELS = 1 << 21
+
+
+def _sums(labels, values, count):
+    return np.bincount(labels, weights=values, minlength=count + 1)[1:]
+
+
+def _mean_std(labels, values, count, pixels):
+    """Per-label mean and std of a flat float array"""
+    total = _sums(labels, values, count)
+    squares = _sums(labels, values * values, count)
+    n = np.maximum(pixels, 1)
+    mean = total / n
+    return mean, np.sqrt(np.maximum(squares / n - mean * mean, 0))
+
+
+def vegetation_indices(image):
+    """Yield (name, float32 index) for the vegetation indices of an RGB image (or Nx3 pixels), one at a time"""
+    rgb = image.astype(np.float32)
+    R, G, B = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    total = np.maximum(R + G + B, 1)
+    r, g, b = R / total, G / total, B / total
+    exg = 2 * g - r - b
+    exr = 1.4 * r - g
+    yield 'exg', exg
+    yield 'exr', exr
+    yield 'exgr', exg - exr
+    yield 'gli', (2 * G - R - B) / np.maximum(2 * G + R + B, 1)
+    # VARI blows up where G + R - B is near 0, those pixels count as 0
+    denominator = G + R - B
+    yield 'vari', np.clip((G - R) / np.where(np.abs(denominator) > 1, denominator, np.inf), -1, 1)
+
+
+def mask_pixels(rles):
+    """Column-major flat indices of the pixels of every RLE
+    Returns:
+        (labels, indices), labels[k] is the 1-based mask the pixel indices[k] belongs to;
+        both are sorted by (label, index)
+    """
+    labels, indices = [], []
+    for label, rle in enumerate(rles, start=1):
+        starts, ends = mask_rle.runs(rle)
+        lengths = ends - starts
+        # expand the runs: each pixel is its run's start plus its offset within the run
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        indices.append(np.repeat(starts, lengths) + offsets)
+        labels.append(np.full(lengths.sum(), label, dtype=np.int64))
+    return np.concatenate(labels), np.concatenate(indices).astype(np.int64)
+
+
+def perimeters(labels, indices, count, size):
+    """Pixels of each mask with a 4-neighbour outside the mask (or the image)"""
+    h, w = size
+    keys = labels * (h * w) + indices     # sorted, so membership is a binary search
+    row = indices % h
+
+    def inside(offset, valid):
+        found = np.zeros(len(keys), dtype=bool)
+        query = keys[valid] + offset
+        position = np.minimum(np.searchsorted(keys, query), len(keys) - 1)
+        found[valid] = keys[position] == query
+        return found
+
+    # column-major: the pixel below is the next index, the one to the right is h further
+    interior = (inside(1, row < h - 1) & inside(-1, row > 0)
+                & inside(h, indices < h * (w - 1)) & inside(-h, indices >= h))
+    return np.bincount(labels[~interior], minlength=count + 1)[1:]
+
+
+def chunks(areas, limit=MAX_CHUNK_PIXELS):
+    """(start, stop) ranges of consecutive masks with at most limit pixels together, a larger mask is a chunk alone"""
+    start, total = 0, 0
+    for i, area in enumerate(areas):
+        if total and total + area > limit:
+            yield start, i
+            start, total = i, 0
+        total += area
+    if start < len(areas):
+        yield start, len(areas)
+
+
+def _chunk_features(image, rles, pixels, gray, gradient, laplacian):
+    """Perimeter, shape, colour and texture columns of a chunk of masks"""
+    h, w = image.shape[:2]
+    count = len(rles)
+    labels, indices = mask_pixels(rles)
+    # RLE indices are column-major, the images are row-major
+    flat = (indices % h) * w + indices // h
+
+    def stats(values):
+        return _mean_std(labels, values.astype(np.float64), count, pixels)
+
+    columns = {'perimeter': perimeters(labels, indices, count, (h, w))}
+    # 1 for a disc, lower for elongated or ragged shapes
+    columns['compactness'] = 4 * np.pi * pixels / np.maximum(columns['perimeter'], 1) ** 2
+
+    rgb = image.reshape(-1, 3)[flat]
+    for channel, name in enumerate(['red', 'green', 'blue']):
+        columns[f'{name}_mean'], columns[f'{name}_std'] = stats(rgb[:, channel])
+
+    # colour conversions are per pixel, so only the gathered pixels are converted
+    hsv = cv2.cvtColor(rgb[:, None], cv2.COLOR_RGB2HSV)[:, 0]
+    hue = hsv[:, 0] * (2 * np.pi / 180)   # OpenCV hue is 0-179
+    sin, cos = _sums(labels, np.sin(hue), count), _sums(labels, np.cos(hue), count)
+    columns['hue_mean'] = np.degrees(np.arctan2(sin, cos)) % 360
+    resultant = np.hypot(sin, cos) / np.maximum(pixels, 1)
+    columns['hue_std'] = np.degrees(np.sqrt(-2 * np.log(np.clip(resultant, 1e-12, 1))))
+    for channel, name in [(1, 'saturation'), (2, 'value')]:
+        columns[f'{name}_mean'], columns[f'{name}_std'] = stats(hsv[:, channel])
+    del hsv, hue
+
+    for name, index in vegetation_indices(rgb):
+        columns[f'{name}_mean'], columns[f'{name}_std'] = stats(index)
+
+    # texture: local contrast of the gray image
+    columns['gray_std'] = stats(gray.ravel()[flat])[1]
+    columns['gradient_mean'] = _sums(labels, gradient.ravel()[flat].astype(np.float64), count) / np.maximum(pixels, 1)
+    columns['laplacian_var'] = stats(laplacian.ravel()[flat])[1] ** 2
+    return columns
+
+
+def extract_features(image, masks):
+    """Compute the features of every mask of an RGB frame
+    Args:
+        image: HxWx3 uint8 RGB frame
+        masks: Mask records (RLE or boolean 'segmentation') from the generator
+    Returns:
+        Columnar dict of equal length numpy arrays, one row per mask, 'mask_index'
+        is the position of the mask in masks
+    """
+    count = len(masks)
+    if count == 0:
+        return {'mask_index': np.zeros(0, dtype=np.int64)}
+    image = np.ascontiguousarray(image)
+    rles = []
+    for m in masks:
+        segmentation = m['segmentation'] if 'segmentation' in m else m
+        rles.append(segmentation if isinstance(segmentation, dict) else mask_rle.encode(segmentation))
+    pixels = mask_rle.areas(rles)
+
+    columns = {'mask_index': np.arange(count, dtype=np.int64), 'area': pixels}
+    boxes = mask_rle.bboxes(rles)
+    for i, name in enumerate(['bbox_x', 'bbox_y', 'bbox_w', 'bbox_h']):
+        columns[name] = boxes[:, i]
+
+    gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY).astype(np.float32)
+    gradient = cv2.magnitude(cv2.Sobel(gray, cv2.CV_32F, 1, 0), cv2.Sobel(gray, cv2.CV_32F, 0, 1))
+    laplacian = cv2.Laplacian(gray, cv2.CV_32F)
+    parts = [_chunk_features(image, rles[start:stop], pixels[start:stop], gray, gradient, laplacian)
+             for start, stop in chunks(pixels, MAX_CHUNK_PIXELS)]
+    for name in parts[0]:
+        columns[name] = np.concatenate([part[name] for part in parts])
+    return columns
+
+
+def to_columns(features):
+    """Features as plain lists for JSON"""
+    return {'num_rows': len(features['mask_index']),
+            'columns': {name: values.tolist() for name, values in features.items()}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compute per-mask features from an image and its masks")
+    parser.add_argument('image')
+    parser.add_argument('masks', help="<name>.masks.json written by sam_service.py or pipelined_runner.py")
+    parser.add_argument('--output', default=None, help="JSON file for the features, printed by default")
+    args = parser.parse_args()
+
+    image = image_loading.load_rgb(args.image)
+    with open(args.masks) as f:
+        masks = json.load(f)['masks']
+    table = to_columns(extract_features(image, masks))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(table, f)
+        print(f"Wrote features of {table['num_rows']} masks to {args.output}")
+    else:
+        print(json.dumps(table, indent=1))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import numpy as np
+import mask_rle
+
+# Mask de-duplication on RLE masks.
+#
+# Comparing every pair of full-size boolean masks is O(N^2 * H * W). Here the
+# boxes prune the pairs first: boxes that don't overlap can't share a pixel,
+# and the box intersection and mask areas give an upper bound on the IoU, so
+# only pairs that could exceed a threshold get an exact intersection, computed
+# on the runs (mask_rle.intersection) without decoding anything.
+#
+#   kept = nms(records, iou_thresh=0.7, containment_thresh=0.85)
+#
+# Greedy NMS visits masks from the highest score down and removes the later
+# masks that overlap a kept one by more than iou_thresh. With
+# containment_thresh, a later mask that lies mostly inside a kept one
+# (intersection / its own area) is removed too, e.g. the part of an object a
+# tile seam cut off.
+#
+# The boxes are always computed from the RLEs (mask_rle.bboxes, inclusive of
+# the last row and column). The generator's 'bbox' has w = right - left, one
+# pixel short, which would make the box intersection of two identical
+# one-pixel-wide masks 0 and hide every duplicate among thin grass blades.
+
+BLOCK = 1024    # rows of the pairwise box tests done at once, bounds their memory
+
+
+def _xyxy(boxes):
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    return np.concatenate([boxes[:, :2], boxes[:, :2] + boxes[:, 2:]], axis=1)
+
+
+def candidate_pairs(boxes, areas, iou_thresh, containment_thresh=None):
+    """Pairs (i, j), i < j, whose boxes and areas allow an IoU or containment above the thresholds
+    Returns:
+        (first, second) index arrays
+    """
+    xyxy = _xyxy(boxes)
+    areas = np.asarray(areas, dtype=np.float64)
+    found = []
+    for top in range(0, len(xyxy), BLOCK):
+        rows = slice(top, top + BLOCK)
+        inter_w = np.minimum(xyxy[rows, None, 2], xyxy[None, :, 2]) - np.maximum(xyxy[rows, None, 0], xyxy[None, :, 0])
+        inter_h = np.minimum(xyxy[rows, None, 3], xyxy[None, :, 3]) - np.maximum(xyxy[rows, None, 1], xyxy[None, :, 1])
+        box_inter = np.clip(inter_w, 0, None) * np.clip(inter_h, 0, None)
+
+        # the masks can share at most the smaller area and at most the box intersection
+        most = np.minimum(np.minimum(areas[rows, None], areas[None, :]), box_inter)
+        possible = most > iou_thresh * (areas[rows, None] + areas[None, :] - most)
+        if containment_thresh is not None:
+            possible |= most > containment_thresh * np.minimum(areas[rows, None], areas[None, :])
+        possible &= box_inter > 0
+        # each pair once
+        possible &= np.arange(top, top + possible.shape[0])[:, None] < np.arange(len(xyxy))[None, :]
+        i, j = np.nonzero(possible)
+        found.append((i + top, j))
+
+    if not found:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64)
+    return tuple(np.concatenate(parts) for parts in zip(*found))
+
+
+def nms(records, iou_thresh=0.7, containment_thresh=None, scores=None, containable=None):
+    """Greedy NMS over RLE mask records
+    Args:
+        records: Mask records with an RLE 'segmentation', their 'bbox' is not used
+        iou_thresh: Masks overlapping a better one by more than this IoU are removed
+        containment_thresh: Masks with more than this fraction of their area inside a better one are removed
+        scores: Higher is better, 'predicted_iou' by default
+        containable: Booleans, which masks may be removed by containment (all by default)
+    Returns:
+        Indices of the kept records, best first
+    """
+    count = len(records)
+    if count == 0:
+        return []
+    rles = [record['segmentation'] for record in records]
+    boxes = mask_rle.bboxes(rles)
+    areas = mask_rle.areas(rles).astype(np.float64)
+    if scores is None:
+        scores = [record['predicted_iou'] for record in records]
+    order = np.argsort(-np.asarray(scores, dtype=np.float64), kind='stable')
+    rank = np.empty(count, dtype=np.int64)
+    rank[order] = np.arange(count)
+    containable = np.ones(count, dtype=bool) if containable is None else np.asarray(containable, dtype=bool)
+
+    first, second = candidate_pairs(boxes, areas, iou_thresh, containment_thresh)
+    # neighbours that rank below each mask
+    better = np.where(rank[first] < rank[second], first, second)
+    worse = np.where(rank[first] < rank[second], second, first)
+    by_better = np.argsort(better, kind='stable')
+    better, worse = better[by_better], worse[by_better]
+    bounds = np.searchsorted(better, np.arange(count + 1))
+
+    suppressed = np.zeros(count, dtype=bool)
+    keep = []
+    for i in order:
+        if suppressed[i]:
+            continue
+        keep.append(int(i))
+        for j in worse[bounds[i]:bounds[i + 1]]:
+            if suppressed[j]:
+                continue
+            inter = mask_rle.intersection(rles[i], rles[j])
+            union = areas[i] + areas[j] - inter
+            if union and inter / union > iou_thresh:
+                suppressed[j] = True
+            elif (containment_thresh is not None and containable[j] and areas[j]
+                  and inter / areas[j] > containment_thresh):
+                suppressed[j] = True
+    return keep
+
+
+def dedupe(records, iou_thresh=0.7, containment_thresh=None, scores=None, containable=None):
+    """nms() returning the kept records instead of their indices"""
+    return [records[i] for i in nms(records, iou_thresh, containment_thresh, scores, containable)]
@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import argparse
+import threading
+import numpy as np
+import torch
+from segment_anything import SamAutomaticMaskGenerator
+import model_tiers
+import mask_rle
+import image_loading
+
+# Named SamAutomaticMaskGenerator presets and a harness to compare them.
+#
+#   mask_generator = SamAutomaticMaskGenerator(sam, **PRESETS['balanced'])
+#
+#   python mask_presets.py turf_images --model-type vit_b --json presets.json
+#
+# The harness runs each preset over a folder of images and reports seconds per
+# image, peak memory, mask count and how well the masks agree with the
+# thorough preset, so production settings can be picked from data.
+
+PRESETS = {
+    # 16x16 grid in large batches, a single crop and strict thresholds
+    'fast': {
+        'points_per_side': 16,
+        'points_per_batch': 256,
+        'crop_n_layers': 0,
+        'pred_iou_thresh': 0.9,
+        'min_mask_region_area': 0,
+    },
+    # the generator's default grid and thresholds, larger point batches and removal of tiny regions
+    'balanced': {
+        'points_per_side': 32,
+        'points_per_batch': 128,
+        'crop_n_layers': 0,
+        'pred_iou_thresh': 0.88,
+        'min_mask_region_area': 100,
+    },
+    # an extra layer of crops for small leaves, the reference for agreement
+    'thorough': {
+        'points_per_side': 32,
+        'points_per_batch': 64,
+        'crop_n_layers': 1,
+        'crop_n_points_downscale_factor': 2,
+        'pred_iou_thresh': 0.86,
+        'min_mask_region_area': 100,
+    },
+}
+
+REFERENCE = 'thorough'
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def load_images(image_dir, max_side=None):
+    """Read the images in a folder as RGB arrays, optionally downscaled so the long side is max_side"""
+    images = {}
+    for name in sorted(os.listdir(image_dir)):
+        if not name.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        try:
+            images[name] = image_loading.load_rgb(os.path.join(image_dir, name), max_side)
+        except Exception:
+            print(f"Could not read {name}, skipping")
+    return images
+
+
+class PeakMemory:
+    """Peak memory while the block runs: CUDA allocations on a GPU, sampled process RSS on CPU"""
+
+    def __init__(self, device, interval=0.05):
+        self.device = torch.device(device)
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+
+    @staticmethod
+    def rss():
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.rss())
+
+    def __enter__(self):
+        if self.device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(self.device)
+        else:
+            self.peak = self.rss()
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.device.type == 'cuda':
+            self.peak = torch.cuda.max_memory_allocated(self.device)
+        else:
+            self._stop.set()
+            self._thread.join()
+            self.peak = max(self.peak, self.rss())
+
+
+def agreement(masks, reference):
+    """Mean, over the reference RLE masks, of the best IoU with any of the other masks
+
+    1.0 means every reference mask was found, 0.0 that none were.
+    """
+    if len(reference) == 0:
+        return 1.0 if len(masks) == 0 else 0.0
+    if len(masks) == 0:
+        return 0.0
+    return float(mask_rle.iou_matrix(reference, masks).max(1).mean())
+
+
+def run_preset(sam, params, images):
+    """Segment every image with one set of generator parameters
+    Returns:
+        (summary dict, {name: RLE masks}) for agreement checks
+    """
+    mask_generator = SamAutomaticMaskGenerator(sam, output_mode="uncompressed_rle", **params)
+    seconds = []
+    counts = []
+    results = {}
+    with PeakMemory(sam.device) as memory, torch.inference_mode():
+        for name, image in images.items():
+            start = time.time()
+            masks = mask_generator.generate(image)
+            seconds.append(time.time() - start)
+            counts.append(len(masks))
+            results[name] = [mask['segmentation'] for mask in masks]
+    summary = {
+        'seconds_per_image': float(np.mean(seconds)),
+        'peak_memory_mb': memory.peak / 1024 / 1024,
+        'masks_per_image': float(np.mean(counts)),
+    }
+    return summary, results
+
+
+def compare_presets(sam, images, presets=None, reference=REFERENCE):
+    """Run each preset over the images and score it against the reference preset
+    Returns:
+        {preset name: summary dict with 'agreement'}
+    """
+    presets = presets or PRESETS
+    # the reference runs first so the others can be scored as they finish
+    names = sorted(presets, key=lambda name: name != reference)
+    report = {}
+    reference_masks = None
+    for name in names:
+        # warm up outside the measurement so the first preset isn't penalized
+        if not report:
+            with torch.inference_mode():
+                SamAutomaticMaskGenerator(sam, points_per_side=1).generate(next(iter(images.values())))
+        summary, masks = run_preset(sam, presets[name], images)
+        if name == reference:
+            reference_masks = masks
+        if reference_masks is not None:
+            summary['agreement'] = float(np.mean([agreement(masks[image], reference_masks[image])
+                                                  for image in images]))
+        report[name] = summary
+        print(format_row(name, summary))
+    return report
+
+
+def format_row(name, summary):
+    agreement = summary.get('agreement')
+    return (f"{name:>10}  {summary['seconds_per_image']:8.2f} s/img  {summary['peak_memory_mb']:8.0f} MB  "
+            f"{summary['masks_per_image']:7.1f} masks  "
+            + (f"{agreement:.3f} agreement" if agreement is not None else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare mask generator presets on a folder of images")
+    parser.add_argument('image_dir')
+    parser.add_argument('--model-type', default="vit_h", choices=sorted(model_tiers.CHECKPOINTS))
+    parser.add_argument('--checkpoint', default=None)
+    parser.add_argument('--input-size', type=int, default=1024)
+    parser.add_argument('--device', default=None)
+    parser.add_argument('--max-side', type=int, default=None, help="downscale images so the long side is at most this")
+    parser.add_argument('--presets', nargs='+', default=sorted(PRESETS), choices=sorted(PRESETS))
+    parser.add_argument('--json', default=None, help="write the report to this file")
+    args = parser.parse_args()
+
+    images = load_images(args.image_dir, args.max_side)
+    if not images:
+        print(f"No images found in {args.image_dir}")
+        return
+    tier = {'model_type': args.model_type, 'input_size': args.input_size}
+    checkpoints = {args.model_type: args.checkpoint} if args.checkpoint else None
+    sam = model_tiers.load_tier(tier, checkpoints, args.device)
+
+    print(f"Comparing {', '.join(args.presets)} on {len(images)} images with {model_tiers.tier_name(tier)}")
+    presets = {name: PRESETS[name] for name in args.presets}
+    reference = REFERENCE if REFERENCE in presets else args.presets[0]
+    report = compare_presets(sam, images, presets, reference)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'tier': model_tiers.tier_name(tier), 'images': len(images), 'reference': reference,
+                       'presets': report}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+import numpy as np
+
+# Helpers for SAM's uncompressed RLE masks.
+#
+# With output_mode="uncompressed_rle" the mask generator returns each mask as
+# {"size": [h, w], "counts": [...]}: run lengths over the pixels in
+# column-major order, starting with a run of zeros (COCO's layout). A few
+# hundred full-size boolean masks of a 24 MP frame take gigabytes, their RLE
+# a few megabytes, so masks stay in this form and are only decoded when a
+# pixel array is really needed. Area, bbox and IoU are computed on the runs.
+
+
+def encode(mask):
+    """Encode a boolean HxW mask as uncompressed RLE"""
+    h, w = mask.shape
+    flat = np.asarray(mask, dtype=bool).T.ravel()
+    if flat.size == 0:
+        return {'size': [h, w], 'counts': []}
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate([[0], changes, [flat.size]]))
+    if flat[0]:
+        counts = np.concatenate([[0], counts])
+    return {'size': [h, w], 'counts': counts.tolist()}
+
+
+def decode(rle):
+    """Decode an RLE to a boolean HxW mask"""
+    h, w = rle['size']
+    counts = np.asarray(rle['counts'], dtype=np.int64)
+    values = np.arange(len(counts)) % 2 == 1
+    return np.repeat(values, counts).reshape(w, h).T
+
+
+def runs(rle):
+    """Start and end (exclusive) flat column-major indices of the runs of ones"""
+    counts = np.asarray(rle['counts'], dtype=np.int64)
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    return starts[1::2], ends[1::2]
+
+
+def from_runs(starts, ends, size):
+    """Build an RLE from sorted, non-overlapping runs of ones given as flat column-major indices"""
+    h, w = size
+    starts, ends = np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64)
+    keep = ends > starts
+    starts, ends = starts[keep], ends[keep]
+    if len(starts):
+        # join runs that continue where the previous one ended
+        new_run = np.concatenate([[True], starts[1:] != ends[:-1]])
+        last_of_run = np.concatenate([new_run[1:], [True]])
+        starts, ends = starts[new_run], ends[last_of_run]
+    zeros = starts - np.concatenate([[0], ends[:-1]])
+    counts = np.stack([zeros, ends - starts], axis=1).ravel()
+    tail = h * w - (ends[-1] if len(ends) else 0)
+    if tail or not len(counts):
+        counts = np.concatenate([counts, [tail]])
+    return {'size': [h, w], 'counts': counts.tolist()}
+
+
+def translate(rle, offset, size):
+    """Move an RLE from a crop into a larger frame
+    Args:
+        rle: Mask of the crop
+        offset: (x, y) of the crop's top left corner in the frame
+        size: (h, w) of the frame
+    Returns:
+        RLE of the same mask in the frame
+    """
+    crop_h = rle['size'][0]
+    x0, y0 = offset
+    starts, ends = runs(rle)
+    keep = ends > starts
+    starts, ends = starts[keep], ends[keep]
+    # split runs that wrap from one crop column into the next
+    first_column, last_column = starts // crop_h, (ends - 1) // crop_h
+    pieces = last_column - first_column + 1
+    run = np.repeat(np.arange(len(starts)), pieces)
+    column = first_column[run] + np.arange(pieces.sum()) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+    first_row = np.where(column == first_column[run], starts[run] % crop_h, 0)
+    end_row = np.where(column == last_column[run], (ends[run] - 1) % crop_h + 1, crop_h)
+    frame_h = size[0]
+    base = (column + x0) * frame_h + y0
+    return from_runs(base + first_row, base + end_row, size)
+
+
+def area(rle):
+    return int(np.sum(rle['counts'][1::2]))
+
+
+def bbox(rle):
+    """Bounding box of an RLE in XYWH format, w and h count the pixels (the generator's 'bbox' is one less)"""
+    h, w = rle['size']
+    starts, ends = runs(rle)
+    keep = ends > starts
+    starts, ends = starts[keep], ends[keep] - 1
+    if len(starts) == 0:
+        return [0, 0, 0, 0]
+    x0, x1 = starts[0] // h, ends[-1] // h
+    # a run that wraps into the next column covers the whole column height
+    wraps = starts // h != ends // h
+    y0 = 0 if wraps.any() else int((starts % h).min())
+    y1 = h - 1 if wraps.any() else int((ends % h).max())
+    return [int(x0), y0, int(x1 - x0 + 1), y1 - y0 + 1]
+
+
+def areas(rles):
+    return np.array([area(rle) for rle in rles], dtype=np.int64)
+
+
+def bboxes(rles):
+    """(N, 4) XYWH boxes of a list of RLEs"""
+    return np.array([bbox(rle) for rle in rles], dtype=np.int64).reshape(-1, 4)
+
+
+def intersection(a, b):
+    """Number of pixels set in both RLEs, computed on the runs without decoding
+
+    The count of ones before a flat index is piecewise linear between run
+    boundaries, so it is exact to interpolate it at the other mask's runs.
+    """
+    starts_a, ends_a = runs(a)
+    starts_b, ends_b = runs(b)
+    if len(starts_a) == 0 or len(starts_b) == 0:
+        return 0
+    positions = np.stack([starts_a, ends_a], axis=1).ravel()
+    ones_before = np.concatenate([[0], np.cumsum(ends_a - starts_a)])
+    cumulative = np.stack([ones_before[:-1], ones_before[1:]], axis=1).ravel()
+    inside = np.interp(ends_b, positions, cumulative) - np.interp(starts_b, positions, cumulative)
+    return int(round(inside.sum()))
+
+
+def iou(a, b):
+    inter = intersection(a, b)
+    union = area(a) + area(b) - inter
+    return inter / union if union else 0.0
+
+
+def box_overlap(boxes_a, boxes_b):
+    """(N, M) boolean matrix of which XYWH boxes overlap"""
+    ax0, ay0 = boxes_a[:, 0, None], boxes_a[:, 1, None]
+    ax1, ay1 = ax0 + boxes_a[:, 2, None], ay0 + boxes_a[:, 3, None]
+    bx0, by0 = boxes_b[None, :, 0], boxes_b[None, :, 1]
+    bx1, by1 = bx0 + boxes_b[None, :, 2], by0 + boxes_b[None, :, 3]
+    return (ax0 < bx1) & (bx0 < ax1) & (ay0 < by1) & (by0 < ay1)
+
+
+def iou_matrix(rles_a, rles_b):
+    """(N, M) exact IoU between two lists of RLEs, only pairs whose boxes overlap are compared"""
+    matrix = np.zeros((len(rles_a), len(rles_b)))
+    if len(rles_a) == 0 or len(rles_b) == 0:
+        return matrix
+    areas_a, areas_b = areas(rles_a), areas(rles_b)
+    for i, j in zip(*np.nonzero(box_overlap(bboxes(rles_a), bboxes(rles_b)))):
+        inter = intersection(rles_a[i], rles_b[j])
+        union = areas_a[i] + areas_b[j] - inter
+        matrix[i, j] = inter / union if union else 0.0
+    return matrix
+
+
+class MaskSet:
+    """Mask records from the generator with their masks kept as RLE
+
+    Indexing returns the record, mask(i) decodes a single mask when its pixels
+    are needed. Areas and boxes are computed from the runs.
+    """
+
+    def __init__(self, records):
+        self.records = [record if isinstance(record['segmentation'], dict)
+                        else dict(record, segmentation=encode(record['segmentation']))
+                        for record in records]
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, i):
+        return self.records[i]
+
+    def __iter__(self):
+        return iter(self.records)
+
+    @property
+    def rles(self):
+        return [record['segmentation'] for record in self.records]
+
+    def mask(self, i):
+        return decode(self.records[i]['segmentation'])
+
+    def masks(self):
+        """Decode the masks one at a time"""
+        for record in self.records:
+            yield decode(record['segmentation'])
+
+    def areas(self):
+        return areas(self.rles)
+
+    def bboxes(self):
+        return bboxes(self.rles)
+
+    def sorted_by_area(self, reverse=True):
+        return MaskSet([self.records[i] for i in np.argsort(self.areas(), kind='stable')[::-1 if reverse else 1]])
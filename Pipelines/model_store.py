@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import hashlib
+import datetime
+import urllib.request
+import torch
+from segment_anything import sam_model_registry
+
+# Local store for SAM checkpoints.
+#
+# Checkpoints are resolved from a cache directory ($SAM_CACHE_DIR, by default
+# ~/.cache/sam) and only downloaded when missing. A checkpoint's SHA-256 is
+# computed once, while downloading or on first use, checked against the
+# published hash in EXPECTED_SHA256 and recorded in checksums.json with the
+# file's size and mtime; later loads only stat the file, and a file that
+# changed since it was recorded is hashed again. Checkpoints passed by path are
+# checked the same way by file name, one without a pinned hash (a fine-tuned
+# or converted model) is only loaded with allow_unpinned=True. Once the cache
+# is populated no network access is needed.
+#
+# Weights are loaded memory-mapped into a model built on the meta device, so
+# the random initialization is skipped and the 2.4GB vit_h checkpoint is never
+# copied in RAM before it is moved to the GPU.
+#
+#   sam = load_model("vit_h").to("cuda")
+
+CACHE_DIR = os.environ.get("SAM_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "sam"))
+BASE_URL = "https://dl.fbaipublicfiles.com/segment_anything/"
+CHECKPOINTS = {
+    'vit_h': "sam_vit_h_4b8939.pth",
+    'vit_l': "sam_vit_l_0b3195.pth",
+    'vit_b': "sam_vit_b_01ec64.pth",
+}
+# published SHA-256 of each checkpoint, a download or cached file that doesn't match is rejected
+EXPECTED_SHA256 = {
+    "sam_vit_h_4b8939.pth": "a7bf3b02f3ebf1267aba913ff637d9a2d5c33d3173bb679e46d9f338c26f262e",
+    "sam_vit_l_0b3195.pth": "3adcc4315b642a4d2101128f611684e8734c41232a17c648ed1693702a49a622",
+    "sam_vit_b_01ec64.pth": "ec2df62732614e57411cdcf32a23ffdf28910380d03139ee0f4fcbe91eb8c912",
+}
+CHECKSUMS_FILE = "checksums.json"
+
+# Sam.pixel_mean and pixel_std are not saved in checkpoints
+PIXEL_MEAN = [123.675, 116.28, 103.53]
+PIXEL_STD = [58.395, 57.12, 57.375]
+
+
+class ChecksumError(Exception):
+    pass
+
+
+def _load_records(cache_dir):
+    path = os.path.join(cache_dir, CHECKSUMS_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_record(cache_dir, filename, record):
+    records = _load_records(cache_dir)
+    records[filename] = record
+    path = os.path.join(cache_dir, CHECKSUMS_FILE)
+    with open(path + ".partial", 'w') as f:
+        json.dump(records, f, indent=2)
+    os.replace(path + ".partial", path)
+
+
+def file_sha256(path, chunk_size=8 * 1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def verify(path, expected_sha256=None):
+    """Check a checkpoint against its recorded (or expected) SHA-256, hashing it only if needed
+    Returns:
+        The file's SHA-256
+    Raises:
+        ChecksumError if the file doesn't match
+    """
+    cache_dir, filename = os.path.split(os.path.abspath(path))
+    stat = os.stat(path)
+    record = _load_records(cache_dir).get(filename)
+    unchanged = record and record['size'] == stat.st_size and record['mtime'] == stat.st_mtime
+
+    if unchanged:
+        sha256 = record['sha256']
+    else:
+        print(f"Verifying {filename}...")
+        sha256 = file_sha256(path)
+        if record and record['sha256'] != sha256:
+            raise ChecksumError(f"{filename} changed since it was verified (sha256 {sha256})")
+    if expected_sha256 and sha256 != expected_sha256:
+        raise ChecksumError(f"{filename} has sha256 {sha256}, expected {expected_sha256}")
+
+    if not unchanged:
+        _save_record(cache_dir, filename, {'sha256': sha256, 'size': stat.st_size, 'mtime': stat.st_mtime,
+                                           'verified_at': datetime.datetime.now().isoformat()})
+    return sha256
+
+
+def expected_sha256(filename, allow_unpinned=False):
+    """Pinned SHA-256 of a checkpoint file name, None for an unpinned one if allow_unpinned
+    Raises:
+        ChecksumError for a file name without a pinned hash
+    """
+    if filename in EXPECTED_SHA256:
+        return EXPECTED_SHA256[filename]
+    if allow_unpinned:
+        return None
+    raise ChecksumError(f"{filename} has no pinned sha256 in EXPECTED_SHA256, "
+                        "add it there or load it with allow_unpinned=True")
+
+
+def download(url, path):
+    """Download a file to path, hashing it as it arrives
+    Returns:
+        The file's SHA-256
+    """
+    digest = hashlib.sha256()
+    partial_path = path + ".partial"
+    with urllib.request.urlopen(url) as response, open(partial_path, 'wb') as f:
+        total = int(response.headers.get('Content-Length') or 0)
+        done = 0
+        last_report = 0
+        for chunk in iter(lambda: response.read(8 * 1024 * 1024), b''):
+            f.write(chunk)
+            digest.update(chunk)
+            done += len(chunk)
+            if total and time.time() - last_report > 5:
+                print(f"Downloading {os.path.basename(path)}: {done / total:.0%}")
+                last_report = time.time()
+    os.replace(partial_path, path)
+    return digest.hexdigest()
+
+
+def checkpoint_path(model_type="vit_h", cache_dir=None, allow_download=True, allow_unpinned=False):
+    """Path of a verified checkpoint in the cache, downloading it if it is missing"""
+    cache_dir = cache_dir or CACHE_DIR
+    os.makedirs(cache_dir, exist_ok=True)
+    filename = CHECKPOINTS[model_type]
+    path = os.path.join(cache_dir, filename)
+    expected = expected_sha256(filename, allow_unpinned)
+
+    if not os.path.exists(path):
+        if not allow_download:
+            raise FileNotFoundError(f"{filename} is not in {cache_dir} and downloading is disabled")
+        print(f"Downloading {BASE_URL + filename} to {cache_dir}")
+        sha256 = download(BASE_URL + filename, path)
+        if expected and sha256 != expected:
+            os.remove(path)
+            raise ChecksumError(f"Downloaded {filename} has sha256 {sha256}, expected {expected}")
+        stat = os.stat(path)
+        _save_record(cache_dir, filename, {'sha256': sha256, 'size': stat.st_size, 'mtime': stat.st_mtime,
+                                           'verified_at': datetime.datetime.now().isoformat()})
+        return path
+
+    verify(path, expected)
+    return path
+
+
+def load_state_dict(path):
+    """Load a checkpoint's tensors, memory-mapped where the format allows it"""
+    if path.endswith(".safetensors"):
+        from safetensors.torch import load_file # type: ignore
+        return load_file(path)
+    try:
+        return torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    except RuntimeError:
+        # checkpoints saved in the legacy (non zip) format can't be memory-mapped
+        return torch.load(path, map_location="cpu", weights_only=True)
+
+
+def load_model(model_type="vit_h", checkpoint=None, cache_dir=None, allow_download=True, allow_unpinned=False):
+    """Build a SAM model on the CPU with its weights from the store (or an explicit checkpoint path)
+
+    The model is built on the meta device and the loaded tensors are assigned
+    to it, instead of initializing random weights and copying over them. An
+    explicit checkpoint is verified against the pinned hash of its file name,
+    allow_unpinned=True loads one that has none.
+    """
+    if checkpoint is None:
+        checkpoint = checkpoint_path(model_type, cache_dir, allow_download, allow_unpinned)
+    else:
+        verify(checkpoint, expected_sha256(os.path.basename(checkpoint), allow_unpinned))
+    state_dict = load_state_dict(checkpoint)
+
+    with torch.device("meta"):
+        sam = sam_model_registry[model_type]()
+    sam.load_state_dict(state_dict, assign=True)
+    sam.register_buffer("pixel_mean", torch.tensor(PIXEL_MEAN).view(-1, 1, 1), False)
+    sam.register_buffer("pixel_std", torch.tensor(PIXEL_STD).view(-1, 1, 1), False)
+
+    missing = [name for name, tensor in list(sam.named_parameters()) + list(sam.named_buffers())
+               if tensor.is_meta]
+    if missing:
+        raise RuntimeError(f"{checkpoint} does not have weights for {', '.join(missing)}")
+    sam.eval()
+    return sam
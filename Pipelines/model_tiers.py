@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import platform
+import datetime
+import argparse
+import numpy as np
+import torch
+import torch.nn.functional as F
+from segment_anything import SamAutomaticMaskGenerator
+import model_store
+
+# SAM model tiers and latency-budgeted selection.
+#
+# A tier is a model type (vit_b, vit_l, vit_h) plus the input size of the image
+# encoder. Shrinking the input size from 1024 interpolates the encoder's
+# position embedding, so the same checkpoint runs on fewer patches: 512 is
+# roughly 4x less encoder work, at the cost of fine detail.
+#
+# auto_select() benchmarks the tiers on the local device in order of
+# preference and returns the first one whose per-frame time fits the budget.
+# Measurements are stored in model_tiers.json, keyed by device and generator
+# parameters, so later runs skip the benchmark.
+#
+#   tier, sam = auto_select(budget=2.0)
+
+CHECKPOINTS = model_store.CHECKPOINTS
+
+# most accurate first
+TIERS = [
+    {'model_type': 'vit_h', 'input_size': 1024},
+    {'model_type': 'vit_l', 'input_size': 1024},
+    {'model_type': 'vit_b', 'input_size': 1024},
+    {'model_type': 'vit_l', 'input_size': 768},
+    {'model_type': 'vit_b', 'input_size': 768},
+    {'model_type': 'vit_b', 'input_size': 512},
+]
+
+RESULTS_PATH = "model_tiers.json"
+PATCH_SIZE = 16
+
+
+def tier_name(tier):
+    return f"{tier['model_type']}@{tier['input_size']}"
+
+
+def set_input_size(sam, input_size):
+    """Change the image size a SAM model expects, in place
+
+    Must be called before creating predictors or mask generators for the model.
+    input_size has to be a multiple of the 16 pixel patch size.
+    """
+    if input_size % PATCH_SIZE:
+        raise ValueError(f"input_size must be a multiple of {PATCH_SIZE}, got {input_size}")
+    encoder = sam.image_encoder
+    if encoder.img_size == input_size:
+        return sam
+
+    grid = input_size // PATCH_SIZE
+    if encoder.pos_embed is not None:
+        # (1, H, W, C) -> (1, C, H, W) for interpolation and back
+        pos_embed = F.interpolate(encoder.pos_embed.data.permute(0, 3, 1, 2), size=(grid, grid),
+                                  mode='bicubic', align_corners=False)
+        encoder.pos_embed = torch.nn.Parameter(pos_embed.permute(0, 2, 3, 1).contiguous())
+    # the relative position tables of the global attention blocks are interpolated on the fly
+    encoder.img_size = input_size
+    sam.prompt_encoder.image_embedding_size = (grid, grid)
+    sam.prompt_encoder.input_image_size = (input_size, input_size)
+    return sam
+
+
+def default_device():
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def device_name(device):
+    """Name the benchmark results are stored under"""
+    device = torch.device(device)
+    if device.type == 'cuda':
+        return torch.cuda.get_device_name(device)
+    return f"cpu-{platform.machine()}-{torch.get_num_threads()}threads"
+
+
+def load_tier(tier, checkpoints=None, device=None):
+    """Build the model for a tier, from the model store unless checkpoints maps its model type to a path"""
+    sam = model_store.load_model(tier['model_type'], (checkpoints or {}).get(tier['model_type']))
+    set_input_size(sam, tier['input_size'])
+    sam.to(device=device or default_device())
+    sam.eval()
+    return sam
+
+
+def benchmark(sam, image, repeats=3, **generator_params):
+    """Seconds per frame for the automatic mask generator, after one warmup run"""
+    mask_generator = SamAutomaticMaskGenerator(sam, **generator_params)
+    with torch.inference_mode():
+        mask_generator.generate(image)
+        times = []
+        for _ in range(repeats):
+            if sam.device.type == 'cuda':
+                torch.cuda.synchronize()
+            start = time.time()
+            mask_generator.generate(image)
+            if sam.device.type == 'cuda':
+                torch.cuda.synchronize()
+            times.append(time.time() - start)
+    return float(np.median(times))
+
+
+def load_results(results_path=RESULTS_PATH):
+    if not os.path.exists(results_path):
+        return {}
+    with open(results_path) as f:
+        return json.load(f)
+
+
+def save_results(results, results_path=RESULTS_PATH):
+    with open(results_path + ".partial", 'w') as f:
+        json.dump(results, f, indent=2)
+    os.replace(results_path + ".partial", results_path)
+
+
+def auto_select(budget, tiers=TIERS, image=None, device=None, loader=None, results_path=RESULTS_PATH,
+                rebenchmark=False, repeats=3, **generator_params):
+    """Pick the most accurate tier whose seconds per frame fit the budget
+    Args:
+        budget: Seconds per frame allowed
+        tiers: Candidate tiers, most accurate first
+        image: RGB frame to benchmark with, a random 1200x1600 frame by default
+        device: Torch device, cuda when available by default
+        loader: loader(tier, device) returning a model, load_tier() by default
+        results_path: JSON file the measurements are kept in
+        rebenchmark: Ignore stored measurements
+        generator_params: Passed on to SamAutomaticMaskGenerator
+    Returns:
+        (tier dict with its 'seconds', loaded model). The fastest tier is
+        returned when none fits the budget.
+    """
+    device = device or default_device()
+    loader = loader or (lambda tier, device: load_tier(tier, device=device))
+    if image is None:
+        image = np.random.default_rng(0).integers(0, 255, (1200, 1600, 3), dtype=np.uint8)
+
+    results = load_results(results_path)
+    key = f"{device_name(device)} {json.dumps(generator_params, sort_keys=True)} {image.shape[1]}x{image.shape[0]}"
+    measured = {} if rebenchmark else results.get(key, {}).get('seconds', {})
+
+    fastest = None
+    for tier in tiers:
+        name = tier_name(tier)
+        sam = None
+        if name not in measured:
+            sam = loader(tier, device)
+            measured[name] = benchmark(sam, image, repeats, **generator_params)
+            print(f"{name}: {measured[name]:.2f} seconds per frame")
+            results[key] = {'seconds': measured, 'measured_at': datetime.datetime.now().isoformat()}
+            save_results(results, results_path)
+        if measured[name] <= budget:
+            print(f"Selected {name} ({measured[name]:.2f}s per frame, budget {budget:.2f}s)")
+            return dict(tier, seconds=measured[name]), sam if sam is not None else loader(tier, device)
+        if fastest is None or measured[name] < measured[tier_name(fastest)]:
+            fastest = tier
+        del sam
+
+    name = tier_name(fastest)
+    print(f"No tier fits {budget:.2f}s per frame, using the fastest: {name} ({measured[name]:.2f}s)")
+    return dict(fastest, seconds=measured[name]), loader(fastest, device)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark SAM tiers and pick one for a latency budget")
+    parser.add_argument('budget', type=float, help="seconds per frame")
+    parser.add_argument('--image', default=None, help="image to benchmark with")
+    parser.add_argument('--device', default=None)
+    parser.add_argument('--points-per-side', type=int, default=32)
+    parser.add_argument('--rebenchmark', action='store_true')
+    args = parser.parse_args()
+
+    image = None
+    if args.image:
+        import image_loading
+        image = image_loading.load_rgb(args.image)
+    tier, _ = auto_select(args.budget, image=image, device=args.device, rebenchmark=args.rebenchmark,
+                          points_per_side=args.points_per_side)
+    print(json.dumps(tier))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+import os
+import time
+import argparse
+import numpy as np
+import torch
+import onnxruntime # type: ignore
+from segment_anything import SamAutomaticMaskGenerator
+from segment_anything.utils.onnx import SamOnnxModel
+import model_tiers
+import sam_service
+import mask_presets
+from sam_batch import FeaturePredictor, FeatureMaskGenerator
+
+# ONNX export and an onnxruntime backend for SAM.
+#
+# For CPU-only workstations and cloud VMs the image encoder and the mask
+# decoder are exported to ONNX once, then run with onnxruntime, with
+# configurable thread pools and optional dynamic int8 quantization.
+# OnnxPredictor is a drop-in SamPredictor, so the automatic mask generator,
+# the embedding cache and the segmentation service work unchanged.
+#
+#   python onnx_backend.py export --model-type vit_b --output onnx_models --quantize
+#   python onnx_backend.py benchmark test1.jpg --model-type vit_b --onnx-dir onnx_models --threads 8
+#
+# The torch model is still loaded for its image transform, preprocessing and
+# mask upscaling, but the encoder and decoder run in onnxruntime.
+
+ONNX_DIR = "onnx_models"
+OPSET = 17
+
+
+class EncoderOnnxModel(torch.nn.Module):
+    """Image encoder taking the normalized, padded 1x3xSxS image Sam.preprocess() produces"""
+
+    def __init__(self, sam):
+        super().__init__()
+        self.image_encoder = sam.image_encoder
+
+    def forward(self, image):
+        return self.image_encoder(image)
+
+
+class DecoderOnnxModel(SamOnnxModel):
+    """Prompt encoder and mask decoder returning the low resolution masks
+
+    Upscaling is left to Sam.postprocess_masks in the predictor: traced, the
+    crop to the unpadded size would be fixed to the example image's size.
+    """
+
+    def __init__(self, sam):
+        super().__init__(sam, return_single_mask=False)
+
+    @torch.no_grad()
+    def forward(self, image_embeddings, point_coords, point_labels, mask_input, has_mask_input):
+        masks, scores = self.model.mask_decoder.predict_masks(
+            image_embeddings=image_embeddings,
+            image_pe=self.model.prompt_encoder.get_dense_pe(),
+            sparse_prompt_embeddings=self._embed_points(point_coords, point_labels),
+            dense_prompt_embeddings=self._embed_masks(mask_input, has_mask_input),
+        )
+        return scores, masks
+
+
+def model_paths(onnx_dir, tag, quantized=False):
+    suffix = "_int8" if quantized else ""
+    return {
+        'encoder': os.path.join(onnx_dir, f"{tag}_encoder{suffix}.onnx"),
+        'decoder': os.path.join(onnx_dir, f"{tag}_decoder{suffix}.onnx"),
+    }
+
+
+@torch.no_grad()
+def export(sam, onnx_dir=ONNX_DIR, tag="vit_h@1024", quantize=False, opset=OPSET):
+    """Export the image encoder and the prompt encoder + mask decoder of a model to ONNX
+    Returns:
+        dict with the 'encoder' and 'decoder' paths (the quantized ones when quantize is set)
+    """
+    os.makedirs(onnx_dir, exist_ok=True)
+    paths = model_paths(onnx_dir, tag)
+    sam = sam.to('cpu').eval()
+    size = sam.image_encoder.img_size
+
+    print(f"Exporting image encoder to {paths['encoder']}")
+    torch.onnx.export(EncoderOnnxModel(sam), (torch.randn(1, 3, size, size),), paths['encoder'],
+                      input_names=['image'], output_names=['image_embeddings'],
+                      opset_version=opset, do_constant_folding=True, dynamo=False)
+
+    print(f"Exporting mask decoder to {paths['decoder']}")
+    grid = sam.prompt_encoder.image_embedding_size
+    decoder_inputs = {
+        'image_embeddings': torch.randn(1, sam.prompt_encoder.embed_dim, *grid),
+        'point_coords': torch.randint(0, size, (1, 5, 2), dtype=torch.float),
+        'point_labels': torch.randint(0, 4, (1, 5), dtype=torch.float),
+        'mask_input': torch.randn(1, 1, 4 * grid[0], 4 * grid[1]),
+        'has_mask_input': torch.tensor([1], dtype=torch.float),
+    }
+    torch.onnx.export(DecoderOnnxModel(sam), tuple(decoder_inputs.values()), paths['decoder'],
+                      input_names=list(decoder_inputs), output_names=['iou_predictions', 'low_res_masks'],
+                      dynamic_axes={'point_coords': {0: 'batch', 1: 'num_points'},
+                                    'point_labels': {0: 'batch', 1: 'num_points'}},
+                      opset_version=opset, do_constant_folding=True, dynamo=False)
+
+    if quantize:
+        return quantize_models(paths, model_paths(onnx_dir, tag, quantized=True))
+    return paths
+
+
+def quantize_models(paths, quantized_paths):
+    """Dynamic int8 quantization of the exported graphs' weights"""
+    from onnxruntime.quantization import QuantType, quantize_dynamic # type: ignore
+    for part in ('encoder', 'decoder'):
+        print(f"Quantizing {paths[part]}")
+        # the vit_h encoder is larger than protobuf's 2GB limit
+        quantize_dynamic(paths[part], quantized_paths[part], weight_type=QuantType.QUInt8,
+                         use_external_data_format=part == 'encoder')
+    return quantized_paths
+
+
+def create_session(path, intra_threads=0, inter_threads=0):
+    """onnxruntime CPU session, 0 threads lets onnxruntime pick"""
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = intra_threads
+    options.inter_op_num_threads = inter_threads
+    options.execution_mode = (onnxruntime.ExecutionMode.ORT_PARALLEL if inter_threads > 1
+                              else onnxruntime.ExecutionMode.ORT_SEQUENTIAL)
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+
+class OnnxPredictor(FeaturePredictor):
+    """SamPredictor running the image encoder and mask decoder with onnxruntime
+    Args:
+        sam: Torch model the graphs were exported from, used for its transform and preprocessing
+        encoder_session, decoder_session: onnxruntime sessions from create_session()
+        cache: Optional EmbeddingCache
+    """
+
+    def __init__(self, sam, encoder_session, decoder_session, cache=None):
+        super().__init__(sam, cache)
+        self.encoder_session = encoder_session
+        self.decoder_session = decoder_session
+
+    @torch.no_grad()
+    def set_torch_image(self, transformed_image, original_image_size):
+        self.reset_image()
+        self.original_size = original_image_size
+        self.input_size = tuple(transformed_image.shape[-2:])
+        input_image = self.model.preprocess(transformed_image).cpu().numpy().astype(np.float32)
+        (features,) = self.encoder_session.run(None, {'image': input_image})
+        self.features = torch.from_numpy(features)
+        self.is_image_set = True
+
+    @torch.no_grad()
+    def predict_torch(self, point_coords, point_labels, boxes=None, mask_input=None,
+                      multimask_output=True, return_logits=False):
+        if not self.is_image_set:
+            raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
+        if point_coords is None:
+            batch = boxes.shape[0]
+            point_coords = torch.zeros((batch, 0, 2))
+            point_labels = torch.zeros((batch, 0))
+        else:
+            batch = point_coords.shape[0]
+        if boxes is not None:
+            # box corners are points with labels 2 and 3
+            point_coords = torch.cat([point_coords, boxes.reshape(-1, 2, 2)], dim=1)
+            point_labels = torch.cat([point_labels, torch.tensor([[2, 3]]).repeat(batch, 1)], dim=1)
+        else:
+            # the decoder expects a padding point when there is no box
+            point_coords = torch.cat([point_coords, torch.zeros((batch, 1, 2))], dim=1)
+            point_labels = torch.cat([point_labels, -torch.ones((batch, 1))], dim=1)
+
+        grid = self.model.prompt_encoder.image_embedding_size
+        has_mask = mask_input is not None
+        iou_predictions, low_res_masks = self.decoder_session.run(None, {
+            'image_embeddings': self.features.cpu().numpy(),
+            'point_coords': point_coords.cpu().numpy().astype(np.float32),
+            'point_labels': point_labels.cpu().numpy().astype(np.float32),
+            'mask_input': (mask_input.cpu().numpy().astype(np.float32)[:1] if has_mask
+                           else np.zeros((1, 1, 4 * grid[0], 4 * grid[1]), np.float32)),
+            'has_mask_input': np.array([1 if has_mask else 0], np.float32),
+        })
+        # output 0 is the single mask prediction, 1-3 the multimask ones
+        outputs = slice(1, None) if multimask_output else slice(0, 1)
+        low_res_masks = torch.from_numpy(low_res_masks[:, outputs]).to(self.device)
+        masks = self.model.postprocess_masks(low_res_masks, self.input_size, self.original_size)
+        if not return_logits:
+            masks = masks > self.model.mask_threshold
+        return masks, torch.from_numpy(iou_predictions[:, outputs]).to(self.device), low_res_masks
+
+
+def load_predictor(sam, onnx_dir=ONNX_DIR, tag="vit_h@1024", quantized=False, intra_threads=0, inter_threads=0,
+                   cache=None):
+    """OnnxPredictor for graphs previously written by export()"""
+    paths = model_paths(onnx_dir, tag, quantized)
+    for path in paths.values():
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"{path} not found, run: python onnx_backend.py export")
+    return OnnxPredictor(sam, create_session(paths['encoder'], intra_threads, inter_threads),
+                         create_session(paths['decoder'], intra_threads, inter_threads), cache)
+
+
+def compare(sam, predictor, image, **generator_params):
+    """Compare an ONNX predictor with the torch model on one image
+    Returns:
+        dict with the largest embedding difference and the mask agreement (mean best IoU)
+    """
+    generator_params.setdefault('output_mode', "uncompressed_rle")
+    with torch.inference_mode():
+        torch_generator = SamAutomaticMaskGenerator(sam, **generator_params)
+        torch_generator.predictor.set_image(image)
+        torch_features = torch_generator.predictor.features.cpu()
+        torch_masks = torch_generator.generate(image)
+
+        predictor.set_image(image)
+        onnx_features = predictor.features
+        onnx_masks = FeatureMaskGenerator(sam, predictor=predictor, **generator_params).generate(image)
+
+    return {
+        'max_embedding_difference': float((torch_features - onnx_features).abs().max()),
+        'torch_masks': len(torch_masks),
+        'onnx_masks': len(onnx_masks),
+        'agreement': mask_presets.agreement([m['segmentation'] for m in onnx_masks],
+                                            [m['segmentation'] for m in torch_masks]),
+    }
+
+
+def benchmark(sam, predictor, image, repeats=3, **generator_params):
+    """Seconds per image for the torch model and the ONNX predictor, each after a warmup run"""
+    generators = {
+        'torch': SamAutomaticMaskGenerator(sam, **generator_params),
+        'onnx': FeatureMaskGenerator(sam, predictor=predictor, **generator_params),
+    }
+    report = {}
+    with torch.inference_mode():
+        for name, generator in generators.items():
+            generator.generate(image)
+            times = []
+            for _ in range(repeats):
+                start = time.time()
+                generator.generate(image)
+                times.append(time.time() - start)
+            report[name] = float(np.median(times))
+            print(f"{name:>6}: {report[name]:.2f} seconds per image")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export SAM to ONNX and compare onnxruntime with torch on CPU")
+    parser.add_argument('command', choices=['export', 'benchmark'])
+    parser.add_argument('image', nargs='?', default=None, help="image for benchmark")
+    parser.add_argument('--model-type', default="vit_h", choices=sorted(model_tiers.CHECKPOINTS))
+    parser.add_argument('--checkpoint', default=None)
+    parser.add_argument('--input-size', type=int, default=1024)
+    parser.add_argument('--onnx-dir', '--output', dest='onnx_dir', default=ONNX_DIR)
+    parser.add_argument('--quantize', action='store_true', help="export or benchmark the int8 graphs")
+    parser.add_argument('--threads', type=int, default=0, help="intra-op threads, for torch too")
+    parser.add_argument('--inter-threads', type=int, default=0)
+    parser.add_argument('--preset', default='balanced', choices=sorted(mask_presets.PRESETS))
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    sam = sam_service.load_sam(args.model_type, args.checkpoint, "cpu", args.input_size)
+    tag = model_tiers.tier_name({'model_type': args.model_type, 'input_size': args.input_size})
+
+    if args.command == 'export':
+        paths = export(sam, args.onnx_dir, tag, args.quantize)
+        print(f"Wrote {paths['encoder']} and {paths['decoder']}")
+        return
+
+    if not args.image:
+        parser.error("benchmark needs an image")
+    image = sam_service.decode_image(open(args.image, 'rb').read())
+    predictor = load_predictor(sam, args.onnx_dir, tag, args.quantize, args.threads, args.inter_threads)
+    params = mask_presets.PRESETS[args.preset]
+    print(compare(sam, predictor, image, **params))
+    benchmark(sam, predictor, image, **params)
+
+
+if __name__ == "__main__":
+    main()
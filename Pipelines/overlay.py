@@ -0,0 +1,126 @@
+import numpy as np
+import cv2
+import mask_rle
+
+# Mask overlay renderer.
+#
+# Replaces the notebook's show_anns(), which painted every mask into a float64
+# HxWx4 image through matplotlib. Here the masks are painted into a uint16
+# label map straight from their RLE runs with a vectorized scatter-max (largest
+# first, so small masks stay on top), the label map is looked up in a uint8
+# RGBA palette, and the colors are blended into the frame in place with integer
+# math. The result is written with OpenCV.
+#
+#   preview = render(image, masks, "frame_0001_masks.jpg", max_side=1600)
+
+# pixels of the masks label_map expands and scatters at once
+MAX_SCATTER_PIXELS = 1 << 22
+
+
+def label_map(masks, size=None):
+    """Paint masks into a uint16 label map, 0 where no mask covers the pixel
+    Args:
+        masks: Mask records (RLE or boolean 'segmentation') or bare RLEs
+        size: (h, w), taken from the first mask when not given
+    Returns:
+        (HxW uint16 label map, list of the records in label order starting at label 1)
+    """
+    records = [m if 'segmentation' in m else {'segmentation': m} for m in masks]
+    if size is None:
+        if not records:
+            raise ValueError("size is required when there are no masks")
+        segmentation = records[0]['segmentation']
+        size = segmentation['size'] if isinstance(segmentation, dict) else segmentation.shape
+    h, w = size
+    if len(records) >= 2 ** 16:
+        raise ValueError(f"Too many masks for a uint16 label map: {len(records)}")
+
+    def record_area(record):
+        segmentation = record['segmentation']
+        return mask_rle.area(segmentation) if isinstance(segmentation, dict) else int(segmentation.sum())
+    records = sorted(records, key=record_area, reverse=True)
+    areas = np.array([record_area(record) for record in records], dtype=np.int64)
+
+    # decode every mask's runs once, with the label each run paints
+    decoded = [mask_rle.runs(r['segmentation'] if isinstance(r['segmentation'], dict)
+                             else mask_rle.encode(r['segmentation'])) for r in records]
+
+    # RLE runs index the pixels in column-major order, so fill a transposed buffer.
+    # A pixel gets the highest label covering it (the smallest mask), i.e. the argmax
+    # over the label-ordered mask stack, done as one scatter-max of the expanded runs
+    # per group of masks with at most MAX_SCATTER_PIXELS pixels together
+    flat = np.zeros(h * w, dtype=np.uint16)
+    start = 0
+    while start < len(records):
+        stop = start + max(1, int(np.searchsorted(np.cumsum(areas[start:]), MAX_SCATTER_PIXELS, side='right')))
+        starts = np.concatenate([decoded[i][0] for i in range(start, stop)])
+        ends = np.concatenate([decoded[i][1] for i in range(start, stop)])
+        owners = np.repeat(np.arange(start + 1, stop + 1, dtype=np.uint16),
+                           [len(decoded[i][0]) for i in range(start, stop)])
+        lengths = ends - starts
+        total = int(lengths.sum())
+        if total:
+            # expand the runs into flat indices without a Python loop over runs
+            offsets = np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+            np.maximum.at(flat, offsets + np.arange(total), np.repeat(owners, lengths))
+        start = stop
+    labels = flat.reshape(w, h)
+    return np.ascontiguousarray(labels.T), records
+
+
+def make_palette(count, alpha=0.35, seed=0):
+    """uint8 RGBA palette with a random color per label, label 0 is transparent"""
+    rng = np.random.default_rng(seed)
+    palette = np.zeros((count + 1, 4), dtype=np.uint8)
+    palette[1:, :3] = rng.integers(0, 256, (count, 3))
+    palette[1:, 3] = int(round(alpha * 255))
+    return palette
+
+
+def blend(image, labels, palette, band_rows=256):
+    """Alpha blend palette colors into an RGB uint8 image in place, a band of rows at a time"""
+    for top in range(0, image.shape[0], band_rows):
+        rows = slice(top, top + band_rows)
+        colors = palette[labels[rows]]
+        covered = colors[..., 3] > 0
+        if not covered.any():
+            continue
+        pixels = image[rows][covered].astype(np.uint16)
+        color = colors[covered]
+        alpha = color[:, 3:4].astype(np.uint16)
+        image[rows][covered] = ((pixels * (255 - alpha) + color[:, :3] * alpha + 127) // 255).astype(np.uint8)
+    return image
+
+
+def render(image, masks, output_path=None, alpha=0.35, seed=0, max_side=None, in_place=False):
+    """Draw masks over an RGB image and optionally write it to a PNG/JPEG file
+    Args:
+        image: HxWx3 uint8 RGB frame the masks were generated from
+        masks: Mask records or RLEs from the generator
+        output_path: File to write, format from the extension
+        alpha: Opacity of the mask colors
+        seed: Seed for the mask colors
+        max_side: Downscale the preview so its long side is at most this many pixels
+        in_place: Blend into image itself instead of a copy (ignored when downscaling)
+    Returns:
+        The rendered RGB preview
+    """
+    h, w = image.shape[:2]
+    if len(masks):
+        labels, _ = label_map(masks, (h, w))
+    else:
+        labels = np.zeros((h, w), dtype=np.uint16)
+
+    if max_side and max(h, w) > max_side:
+        scale = max_side / max(h, w)
+        size = (max(1, round(w * scale)), max(1, round(h * scale)))
+        preview = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        labels = cv2.resize(labels, size, interpolation=cv2.INTER_NEAREST)
+    else:
+        preview = image if in_place else image.copy()
+
+    blend(preview, labels, make_palette(int(labels.max()), alpha, seed))
+    if output_path:
+        if not cv2.imwrite(output_path, cv2.cvtColor(preview, cv2.COLOR_RGB2BGR)):
+            raise IOError(f"Could not write {output_path}")
+    return preview
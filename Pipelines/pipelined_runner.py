@@ -0,0 +1,284 @@
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+import torch
+import sam_batch
+import sam_service
+import overlay
+import mask_features
+import vegetation_roi
+import model_tiers
+from mask_presets import PRESETS
+
+# Pipelined capture -> decode -> preprocess -> segment -> write loop.
+#
+# The notebook captures, decodes and segments strictly in sequence, so the
+# accelerator idles during the USB transfer and JPEG decode. Here every stage
+# runs on its own thread connected by small bounded queues: while frame N is
+# in SAM, frame N+1 is being decoded and preprocessed and frame N+2 captured.
+# Loop throughput approaches the speed of the slowest stage, and the bounded
+# queues keep a fast camera from piling up frames in memory.
+#
+#   python pipelined_runner.py --camera --count 20 --output masks
+#   python pipelined_runner.py --images turf_images --output masks --previews 1600
+#
+# Each stage reports its utilization (the fraction of the run it spent
+# working rather than waiting), which shows where the bottleneck is.
+
+STOP = object()
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def camera_frames(camera, count=None, interval=0.0):
+    """Capture frames with gphoto2 and yield (name, JPEG bytes) without writing them to disk
+
+    Each frame is deleted from the camera once it is downloaded, so long runs don't fill the card.
+    """
+    import gphoto2 as gp # type: ignore
+    captured = 0
+    while count is None or captured < count:
+        start = time.time()
+        file_path = camera.capture(gp.GP_CAPTURE_IMAGE)
+        camera_file = camera.file_get(file_path.folder, file_path.name, gp.GP_FILE_TYPE_NORMAL)
+        data = bytes(memoryview(camera_file.get_data_and_size()))
+        try:
+            camera.file_delete(file_path.folder, file_path.name)
+        except gp.GPhoto2Error as e:
+            print(f"Could not delete {file_path.name} from the camera: {str(e)}")
+        yield file_path.name, data
+        captured += 1
+        time.sleep(max(0.0, interval - (time.time() - start)))
+
+
+def directory_frames(image_dir):
+    """Yield (name, file bytes) for the images in a directory"""
+    for name in sorted(os.listdir(image_dir)):
+        if name.lower().endswith(IMAGE_EXTENSIONS):
+            with open(os.path.join(image_dir, name), 'rb') as f:
+                yield name, f.read()
+
+
+class Stage(threading.Thread):
+    """Worker thread applying fn to every item between two bounded queues"""
+
+    def __init__(self, name, fn, inbox, outbox):
+        super().__init__(name=name, daemon=True)
+        self.fn = fn
+        self.inbox = inbox
+        self.outbox = outbox
+        self.items = 0
+        self.busy = 0.0
+        self.error = None
+
+    def run(self):
+        while True:
+            item = self.inbox.get()
+            if item is STOP:
+                break
+            start = time.time()
+            try:
+                result = self.fn(item)
+            except Exception as e:
+                print(f"Error in {self.name} stage: {str(e)}")
+                self.error = e
+                continue
+            finally:
+                self.busy += time.time() - start
+            self.items += 1
+            if self.outbox is not None:
+                self.outbox.put(result)
+        if self.outbox is not None:
+            self.outbox.put(STOP)
+
+
+class PipelinedRunner:
+    """Runs frames from a source through capture, decode, preprocess, segment and output threads
+    Args:
+        sam: Loaded SAM model
+        on_result: on_result(name, image, masks) called on the output thread for each frame
+        queue_size: Frames allowed to wait between two stages
+        max_side: Decode frames with their long side at most this, full size by default; a reduced
+            JPEG decode is much faster than a full one when only SAM's input size is needed
+        vegetation: Optional vegetation_roi.VegetationPrompter in 'points' mode, frames are only
+            prompted on vegetation and frames without any skip the encoder
+        generator_params: Passed on to SamAutomaticMaskGenerator
+    """
+
+    def __init__(self, sam, on_result=None, queue_size=2, max_side=None, vegetation=None, **generator_params):
+        generator_params.setdefault('output_mode', "uncompressed_rle")
+        self.sam = sam
+        self.on_result = on_result
+        self.queue_size = queue_size
+        self.max_side = max_side
+        self.vegetation = vegetation
+        self.mask_generator = sam_batch.FeatureMaskGenerator(sam, **generator_params)
+        self.stages = []
+        self.elapsed = 0.0
+
+    def _decode(self, item):
+        name, data = item
+        return name, sam_service.decode_image(data, self.max_side)
+
+    def _preprocess(self, item):
+        name, image = item
+        # the vegetation mask is computed here, off the accelerator's thread
+        vegetation = self.vegetation.masks(image) if self.vegetation else None
+        if vegetation is not None and not vegetation[0].any():
+            return name, image, None, None, vegetation
+        tensor, input_size = sam_batch.preprocess(self.sam, image)
+        return name, image, tensor, input_size, vegetation
+
+    @torch.no_grad()
+    def _segment(self, item):
+        name, image, tensor, input_size, vegetation = item
+        if tensor is None:
+            return name, image, []
+        features = (self.sam.image_encoder(tensor), image.shape[:2], input_size)
+        if vegetation is not None:
+            masks, _ = self.vegetation.generate(self.mask_generator, image, features, vegetation)
+        else:
+            masks = self.mask_generator.generate(image, features)
+        return name, image, masks
+
+    def _output(self, item):
+        if self.on_result:
+            self.on_result(*item)
+
+    def run(self, frames):
+        """Push every (name, encoded image bytes) from frames through the pipeline, returns stats()"""
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(4)]
+        self.stages = [
+            Stage('decode', self._decode, queues[0], queues[1]),
+            Stage('preprocess', self._preprocess, queues[1], queues[2]),
+            Stage('segment', self._segment, queues[2], queues[3]),
+            Stage('output', self._output, queues[3], None),
+        ]
+        # the capture stage runs on the calling thread, this only keeps its counters
+        capture = Stage('capture', None, None, None)
+        start = time.time()
+        for stage in self.stages:
+            stage.start()
+
+        # blocks while the decode queue is full
+        try:
+            iterator = iter(frames)
+            while True:
+                busy = time.time()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    capture.busy += time.time() - busy
+                capture.items += 1
+                queues[0].put(item)
+        except KeyboardInterrupt:
+            print("\nStopping capture, finishing the frames already captured")
+        finally:
+            queues[0].put(STOP)
+            for stage in self.stages:
+                stage.join()
+            self.elapsed = time.time() - start
+            self.stages.insert(0, capture)
+        return self.stats()
+
+    def stats(self):
+        frames = self.stages[-1].items if self.stages else 0
+        return {
+            'frames': frames,
+            'seconds': self.elapsed,
+            'frames_per_second': frames / self.elapsed if self.elapsed else 0.0,
+            'stages': {stage.name: {'items': stage.items, 'busy_seconds': stage.busy,
+                                    'utilization': stage.busy / self.elapsed if self.elapsed else 0.0}
+                       for stage in self.stages},
+        }
+
+
+def print_stats(stats):
+    print(f"{stats['frames']} frames in {stats['seconds']:.1f} seconds ({stats['frames_per_second']:.2f} frames/s)")
+    for name, stage in stats['stages'].items():
+        print(f"  {name:>10}: {stage['utilization']:6.1%} busy, {stage['busy_seconds'] / max(stage['items'], 1):.3f} s/frame")
+
+
+def result_writer(output_dir, preview_side=None, features=False, store=None):
+    """on_result callback writing <name>.masks.json (and a preview and per-mask features) for every frame
+
+    With store (a results_store.ResultsWriter) the masks and features are
+    added to the Parquet results store as well.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+
+    def write(name, image, masks):
+        base = os.path.join(output_dir, os.path.splitext(name)[0])
+        with open(base + ".masks.json", 'w') as f:
+            json.dump({'image': name, 'size': list(image.shape[:2]),
+                       'masks': [sam_service.compact_mask(mask) for mask in masks]}, f)
+        if preview_side:
+            overlay.render(image, masks, base + ".preview.jpg", max_side=preview_side)
+        columns = mask_features.extract_features(image, masks) if features else None
+        if features:
+            with open(base + ".features.json", 'w') as f:
+                json.dump(mask_features.to_columns(columns), f)
+        if store is not None:
+            store.add(name, masks, image.shape[:2], features=columns)
+        print(f"{name}: {len(masks)} masks")
+    return write
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Capture and segment frames with overlapping stages")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--camera', action='store_true', help="capture with the camera through gphoto2")
+    source.add_argument('--images', default=None, help="segment the images in a directory")
+    parser.add_argument('--count', type=int, default=None, help="frames to capture, until Ctrl-C by default")
+    parser.add_argument('--interval', type=float, default=0.0, help="minimum seconds between captures")
+    parser.add_argument('--output', default="masks")
+    parser.add_argument('--previews', type=int, default=None, metavar='MAX_SIDE')
+    parser.add_argument('--features', action='store_true', help="also write per-mask features")
+    parser.add_argument('--store', default=None, help="also append the results to a Parquet results store here")
+    parser.add_argument('--model-type', default="vit_h", choices=sorted(model_tiers.CHECKPOINTS))
+    parser.add_argument('--checkpoint', default=None)
+    parser.add_argument('--input-size', type=int, default=1024)
+    parser.add_argument('--device', default=None)
+    parser.add_argument('--preset', default=None, choices=sorted(PRESETS))
+    parser.add_argument('--queue-size', type=int, default=2)
+    parser.add_argument('--max-side', type=int, default=None,
+                        help="decode frames at this long side (masks are at that size too), full size by default")
+    parser.add_argument('--vegetation-roi', action='store_true',
+                        help="only prompt SAM on vegetation, frames without any skip the model")
+    args = parser.parse_args()
+
+    sam = sam_service.load_sam(args.model_type, args.checkpoint, args.device, args.input_size)
+    store = None
+    if args.store:
+        import results_store    # needs pyarrow
+        store = results_store.ResultsWriter(args.store)
+    runner = PipelinedRunner(sam, result_writer(args.output, args.previews, args.features, store),
+                             args.queue_size, args.max_side,
+                             vegetation_roi.VegetationPrompter('points') if args.vegetation_roi else None,
+                             **PRESETS.get(args.preset, {}))
+
+    try:
+        if args.camera:
+            import gphoto2 as gp # type: ignore
+            camera = gp.Camera()
+            camera.init()
+            try:
+                stats = runner.run(camera_frames(camera, args.count, args.interval))
+            finally:
+                camera.exit()
+        else:
+            stats = runner.run(directory_frames(args.images))
+    finally:
+        # write the buffered rows even when the run is interrupted
+        if store is not None:
+            store.close()
+            print(f"Stored {store.rows} masks in {args.store}")
+    print_stats(stats)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+import os
+import json
+import uuid
+import argparse
+import datetime
+import numpy as np
+import pyarrow as pa # type: ignore
+import pyarrow.dataset as ds # type: ignore
+
+# Columnar results store for segmentation outputs.
+#
+# One row per mask: the image it came from, capture metadata, the mask's RLE,
+# box and scores, and optionally its features (mask_features.py, stored as
+# feature_<name>). Every file has the same schema, the feature columns are
+# null for masks stored without features, so rows with and without features
+# share files and the dataset is opened without reading each file's footer
+# first. Rows are buffered and written in bulk as Arrow record
+# batches to Parquet files partitioned by capture date (Hive layout,
+# results/date=2024-05-14/part-....parquet), so a run appends files and never
+# rewrites old ones.
+#
+#   with ResultsWriter("results") as writer:
+#       writer.add("IMG_0001.JPG", masks, image.shape[:2], {'session_id': session}, features)
+#
+#   table = read("results", columns=['image_id', 'area'],
+#                filter=(ds.field('date') == '2024-05-14') & (ds.field('predicted_iou') > 0.9))
+#
+# Filters on the partition columns skip whole directories and filters on the
+# other columns are checked against the Parquet row group statistics, so a
+# scan only reads the row groups and columns it needs.
+
+PARTITION_BY = ['date']
+FLUSH_ROWS = 50000      # rows buffered before a flush writes them
+ROW_GROUP_ROWS = 16384  # smaller row groups let filters skip more, larger compress better
+
+# feature columns of mask_features.extract_features, counts are integers and the rest floats
+INTEGER_FEATURES = ['area', 'bbox_x', 'bbox_y', 'bbox_w', 'bbox_h', 'perimeter']
+FLOAT_FEATURES = ['compactness'] + [
+    f'{name}_{stat}' for name in ['red', 'green', 'blue', 'hue', 'saturation', 'value',
+                                  'exg', 'exr', 'exgr', 'gli', 'vari'] for stat in ['mean', 'std']
+] + ['gray_std', 'gradient_mean', 'laplacian_var']
+
+SCHEMA = pa.schema([
+    ('image_id', pa.string()),
+    ('session_id', pa.string()),
+    ('capture_time', pa.timestamp('ms')),
+    ('date', pa.string()),
+    ('settings', pa.string()),
+    ('image_height', pa.int32()),
+    ('image_width', pa.int32()),
+    ('mask_index', pa.int32()),
+    ('rle_counts', pa.list_(pa.int32())),
+    ('bbox_x', pa.float32()),
+    ('bbox_y', pa.float32()),
+    ('bbox_w', pa.float32()),
+    ('bbox_h', pa.float32()),
+    ('area', pa.int64()),
+    ('predicted_iou', pa.float32()),
+    ('stability_score', pa.float32()),
+] + [('feature_' + name, pa.int64()) for name in INTEGER_FEATURES]
+  + [('feature_' + name, pa.float64()) for name in FLOAT_FEATURES])
+
+
+class ResultsWriter:
+    """Buffers mask rows and appends them to a partitioned Parquet dataset
+    Args:
+        root: Directory of the dataset
+        partition_by: Columns the files are partitioned by, Hive style
+        flush_rows: Rows buffered before they are written
+    """
+
+    def __init__(self, root, partition_by=PARTITION_BY, flush_rows=FLUSH_ROWS):
+        self.root = root
+        self.partition_by = list(partition_by)
+        self.flush_rows = flush_rows
+        self.run_id = uuid.uuid4().hex[:12]
+        self.batches = []
+        self.buffered = 0
+        self.files = 0
+        self.rows = 0
+
+    def add(self, image_id, masks, size, metadata=None, features=None):
+        """Buffer the masks of one image
+        Args:
+            image_id: Name of the image
+            masks: Mask records with an RLE 'segmentation'
+            size: (h, w) of the image
+            metadata: Optional session_id, capture_time (datetime) and settings (dict)
+            features: Optional columnar features from mask_features.extract_features
+        """
+        metadata = metadata or {}
+        count = len(masks)
+        capture_time = metadata.get('capture_time') or datetime.datetime.now()
+        settings = metadata.get('settings')
+        bboxes = np.array([mask['bbox'] for mask in masks], dtype=np.float32).reshape(-1, 4)
+        columns = {
+            'image_id': [image_id] * count,
+            'session_id': [metadata.get('session_id')] * count,
+            'capture_time': [capture_time] * count,
+            'date': [capture_time.strftime("%Y-%m-%d")] * count,
+            'settings': [json.dumps(settings, sort_keys=True) if settings is not None else None] * count,
+            'image_height': np.full(count, size[0], dtype=np.int32),
+            'image_width': np.full(count, size[1], dtype=np.int32),
+            'mask_index': np.arange(count, dtype=np.int32),
+            'rle_counts': [mask['segmentation']['counts'] for mask in masks],
+            'bbox_x': bboxes[:, 0], 'bbox_y': bboxes[:, 1], 'bbox_w': bboxes[:, 2], 'bbox_h': bboxes[:, 3],
+            'area': np.array([mask['area'] for mask in masks], dtype=np.int64),
+            'predicted_iou': np.array([mask['predicted_iou'] for mask in masks], dtype=np.float32),
+            'stability_score': np.array([mask['stability_score'] for mask in masks], dtype=np.float32),
+        }
+        if features is not None:
+            order = np.argsort(features['mask_index'])
+            for name, values in features.items():
+                if name == 'mask_index':
+                    continue
+                if 'feature_' + name not in SCHEMA.names:
+                    raise ValueError(f"Feature {name} is not a column of the results store")
+                columns['feature_' + name] = np.asarray(values)[order]
+        arrays = [pa.array(columns[field.name], type=field.type) if field.name in columns
+                  else pa.nulls(count, field.type) for field in SCHEMA]
+        self.batches.append(pa.record_batch(arrays, schema=SCHEMA))
+        self.buffered += count
+        if self.buffered >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows, one file per partition"""
+        if not self.buffered:
+            self.batches = []
+            return
+        table = pa.Table.from_batches(self.batches, schema=SCHEMA)
+        ds.write_dataset(table, self.root, format='parquet',
+                         partitioning=self.partition_by, partitioning_flavor='hive',
+                         basename_template=f"part-{self.run_id}-{self.files:05d}-{{i}}.parquet",
+                         existing_data_behavior='overwrite_or_ignore',
+                         max_rows_per_group=ROW_GROUP_ROWS, min_rows_per_group=min(ROW_GROUP_ROWS, self.buffered))
+        self.files += 1
+        self.rows += self.buffered
+        self.batches = []
+        self.buffered = 0
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_dataset(root):
+    """The store as a pyarrow dataset, partition columns included
+
+    The schema is SCHEMA rather than one discovered from the files, so opening
+    reads no footers, and columns missing from older files read as null.
+    """
+    return ds.dataset(root, schema=SCHEMA, format='parquet', partitioning='hive')
+
+
+def scan(root, columns=None, filter=None, batch_size=65536):
+    """Yield record batches of the rows matching filter, reading only the given columns
+    Args:
+        root: Directory of the dataset
+        columns: Column names to read, all by default
+        filter: pyarrow.dataset expression, e.g. ds.field('area') > 500
+    """
+    yield from open_dataset(root).to_batches(columns=columns, filter=filter, batch_size=batch_size)
+
+
+def read(root, columns=None, filter=None):
+    """Read the rows matching filter into a single Arrow table"""
+    return open_dataset(root).to_table(columns=columns, filter=filter)
+
+
+def to_masks(table):
+    """Rebuild mask records with RLE segmentations from rows read with the image size and RLE columns"""
+    columns = table.to_pydict()
+    masks = []
+    for i in range(table.num_rows):
+        masks.append({
+            'image_id': columns['image_id'][i] if 'image_id' in columns else None,
+            'segmentation': {'size': [columns['image_height'][i], columns['image_width'][i]],
+                             'counts': columns['rle_counts'][i]},
+            'bbox': [columns[name][i] for name in ['bbox_x', 'bbox_y', 'bbox_w', 'bbox_h'] if name in columns],
+            'area': columns['area'][i] if 'area' in columns else None,
+            'predicted_iou': columns['predicted_iou'][i] if 'predicted_iou' in columns else None,
+            'stability_score': columns['stability_score'][i] if 'stability_score' in columns else None,
+        })
+    return masks
+
+
+def import_json(root, masks_dir, partition_by=PARTITION_BY):
+    """Load the <name>.masks.json (and <name>.features.json) files of a directory into the store"""
+    with ResultsWriter(root, partition_by) as writer:
+        for name in sorted(os.listdir(masks_dir)):
+            if not name.endswith(".masks.json"):
+                continue
+            path = os.path.join(masks_dir, name)
+            with open(path) as f:
+                result = json.load(f)
+            features = None
+            features_path = path[:-len(".masks.json")] + ".features.json"
+            if os.path.exists(features_path):
+                with open(features_path) as f:
+                    features = {key: np.asarray(values) for key, values in json.load(f)['columns'].items()}
+            capture_time = datetime.datetime.fromtimestamp(os.path.getmtime(path))
+            writer.add(result['image'], result['masks'], result['size'], {'capture_time': capture_time}, features)
+    return writer.rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load mask JSON files into the Parquet results store, or summarize it")
+    parser.add_argument('root', help="directory of the results store")
+    parser.add_argument('--import-dir', default=None, help="directory of <name>.masks.json files to import")
+    args = parser.parse_args()
+
+    if args.import_dir:
+        print(f"Imported {import_json(args.root, args.import_dir)} masks into {args.root}")
+    dataset = open_dataset(args.root)
+    print(f"{dataset.count_rows()} masks in {len(dataset.files)} files")
+    for field in dataset.schema:
+        print(f"  {field.name}: {field.type}")
+
+
+if __name__ == "__main__":
+    main()
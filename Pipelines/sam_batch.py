@@ -0,0 +1,214 @@
+import time
+import queue
+import threading
+import concurrent.futures
+import torch
+from segment_anything import SamAutomaticMaskGenerator, SamPredictor
+from segment_anything.utils.transforms import ResizeLongestSide
+
+# Batched SAM segmentation for frame streams.
+#
+# SamAutomaticMaskGenerator runs the ViT image encoder on one image at a time.
+# Here several frames are preprocessed and stacked through the encoder in one
+# forward pass, then each frame's embedding is handed to the mask generator,
+# which only runs the (much cheaper) prompt encoder and mask decoder per image.
+#
+#   segmenter = BatchSegmenter(sam, max_batch=4, max_wait=0.05)
+#   future = segmenter.submit(frame)        # from the capture loop
+#   masks = future.result()
+#
+# A partial batch is encoded once max_wait seconds have passed since its first
+# frame arrived, so a slow stream doesn't wait for a full batch.
+
+
+def preprocess(sam, image):
+    """Resize, normalize and pad an RGB image the way SamPredictor.set_image does
+    Returns:
+        (1x3xSxS tensor on the model's device, input size before padding)
+    """
+    transform = ResizeLongestSide(sam.image_encoder.img_size)
+    input_image = transform.apply_image(image)
+    input_image_torch = torch.as_tensor(input_image, device=sam.device)
+    input_image_torch = input_image_torch.permute(2, 0, 1).contiguous()[None, :, :, :]
+    return sam.preprocess(input_image_torch), tuple(input_image_torch.shape[-2:])
+
+
+@torch.no_grad()
+def encode_batch(sam, images):
+    """Run several RGB images through the image encoder in one forward pass
+    Returns:
+        list of (features, original_size, input_size), one per image
+    """
+    tensors, input_sizes = zip(*(preprocess(sam, image) for image in images))
+    features = sam.image_encoder(torch.cat(tensors))
+    return [(features[i:i + 1], image.shape[:2], input_size)
+            for i, (image, input_size) in enumerate(zip(images, input_sizes))]
+
+
+class FeaturePredictor(SamPredictor):
+    """SamPredictor that can be handed an embedding computed elsewhere
+
+    After set_features(), the next set_image() call for an image of the same
+    size uses those features instead of running the encoder. Calls for other
+    sizes (the smaller crops when crop_n_layers > 0) fall back to the encoder,
+    or to the embedding cache when one is given.
+    """
+
+    def __init__(self, sam_model, cache=None):
+        super().__init__(sam_model)
+        self.cache = cache
+        self.pending = None
+
+    def set_features(self, features, original_size, input_size):
+        self.pending = (features, tuple(original_size), tuple(input_size))
+
+    def clear_features(self):
+        self.pending = None
+
+    def set_image(self, image, image_format="RGB"):
+        if image_format != self.model.image_format:
+            image = image[..., ::-1]
+        if self.pending is not None and tuple(image.shape[:2]) == self.pending[1]:
+            entry = self.pending
+        else:
+            key = self.cache.key(image) if self.cache is not None else None
+            entry = self.cache.get(key, self.device) if key else None
+            if entry is None:
+                super().set_image(image, self.model.image_format)
+                if key:
+                    self.cache.put(key, self.features, self.original_size, self.input_size)
+                return
+        self.reset_image()
+        self.features, self.original_size, self.input_size = entry
+        self.is_image_set = True
+
+
+class FeatureMaskGenerator(SamAutomaticMaskGenerator):
+    """SamAutomaticMaskGenerator that can reuse a precomputed or cached image embedding
+
+    predictor replaces the FeaturePredictor it would create, e.g. an
+    OnnxPredictor from onnx_backend.
+    """
+
+    def __init__(self, model, cache=None, predictor=None, **kwargs):
+        super().__init__(model, **kwargs)
+        self.predictor = predictor or FeaturePredictor(model, cache)
+
+    @torch.no_grad()
+    def generate(self, image, features=None):
+        """Generate masks for an image, using features from encode_batch() when given"""
+        if features is None:
+            return super().generate(image)
+        self.predictor.set_features(*features)
+        try:
+            return super().generate(image)
+        finally:
+            self.predictor.clear_features()
+
+
+class BatchSegmenter:
+    """Collects frames into batches for the image encoder and segments them in a worker thread
+    Args:
+        sam: Loaded SAM model
+        max_batch: Most frames stacked into one encoder pass
+        max_wait: Seconds to wait for more frames before encoding a partial batch
+        cache: Optional EmbeddingCache, frames already in it skip the encoder
+        generator_params: Passed on to SamAutomaticMaskGenerator
+    """
+
+    def __init__(self, sam, max_batch=4, max_wait=0.05, cache=None, **generator_params):
+        generator_params.setdefault('output_mode', "uncompressed_rle")
+        self.sam = sam
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.cache = cache
+        self.mask_generator = FeatureMaskGenerator(sam, cache, **generator_params)
+
+        self.batches = 0
+        self.frames = 0
+        self.encode_seconds = 0.0
+        self.decode_seconds = 0.0
+        self.started = time.time()
+
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, image):
+        """Queue an RGB frame, returns a concurrent.futures.Future with its mask records"""
+        future = concurrent.futures.Future()
+        self._queue.put((image, future))
+        return future
+
+    def segment_many(self, images):
+        """Segment a list of frames and return their mask records in order"""
+        futures = [self.submit(image) for image in images]
+        return [future.result() for future in futures]
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            try:
+                job = self._queue.get(timeout=max(0.0, deadline - time.time()))
+            except queue.Empty:
+                break
+            if job is None:
+                self._queue.put(None)   # stop after this batch
+                break
+            batch.append(job)
+        return batch
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            batch = self._collect(job)
+            try:
+                start = time.time()
+                encoded = self._encode([image for image, _ in batch])
+                self.encode_seconds += time.time() - start
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+
+            for (image, future), features in zip(batch, encoded):
+                start = time.time()
+                try:
+                    future.set_result(self.mask_generator.generate(image, features))
+                except Exception as e:
+                    future.set_exception(e)
+                self.decode_seconds += time.time() - start
+                self.frames += 1
+
+    def _encode(self, images):
+        """encode_batch() for the frames that are not in the cache"""
+        if self.cache is None:
+            return encode_batch(self.sam, images)
+        keys = [self.cache.key(image) for image in images]
+        encoded = [self.cache.get(key, self.sam.device) for key in keys]
+        missing = [i for i, entry in enumerate(encoded) if entry is None]
+        if missing:
+            for i, entry in zip(missing, encode_batch(self.sam, [images[i] for i in missing])):
+                self.cache.put(keys[i], *entry)
+                encoded[i] = entry
+        return encoded
+
+    def close(self):
+        """Finish the frames already submitted and stop the worker thread"""
+        self._queue.put(None)
+        self._worker.join()
+
+    def stats(self):
+        elapsed = time.time() - self.started
+        return {
+            'frames': self.frames,
+            'batches': self.batches,
+            'mean_batch_size': self.frames / self.batches if self.batches else None,
+            'encode_seconds': self.encode_seconds,
+            'decode_seconds': self.decode_seconds,
+            'frames_per_second': self.frames / elapsed if elapsed > 0 else 0.0,
+        }
@@ -0,0 +1,365 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import threading
+import urllib.parse
+import collections
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import torch
+from sam_batch import FeatureMaskGenerator
+from embedding_cache import EmbeddingCache
+import model_tiers
+import model_store
+from mask_presets import PRESETS
+import overlay
+import image_loading
+import vegetation_roi
+
+# Resident SAM segmentation service.
+#
+# Loads the model once, warms it up, and then segments images sent to it over
+# a local HTTP API or dropped into a watched directory, so each image only
+# pays for inference instead of model loading and Python startup.
+#
+#   python sam_service.py --checkpoint sam_vit_h_4b8939.pth --port 8765
+#   curl --data-binary @image.jpg http://localhost:8765/segment
+#
+#   python sam_service.py --checkpoint sam_vit_h_4b8939.pth --watch incoming --output results
+#
+# Masks are returned as uncompressed RLE in COCO's column-major layout
+# ({"size": [h, w], "counts": [...]}), straight from the mask generator.
+# The generator parameters in OVERRIDES can be overridden per request (POST
+# /segment?points_per_side=16&pred_iou_thresh=0.9), other names or bad values
+# are answered with 400. The generators for the last MAX_GENERATORS override
+# sets are kept. With --cache-dir the image embedding is cached, so
+# re-segmenting an image with other parameters skips the encoder.
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+CAMERA_SCRIPTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "camera scripts")
+# generator parameters a request may override, with their types and allowed ranges
+OVERRIDES = {
+    'points_per_side': (int, 1, 128),
+    'points_per_batch': (int, 1, 1024),
+    'pred_iou_thresh': (float, 0.0, 1.0),
+    'stability_score_thresh': (float, 0.0, 1.0),
+    'stability_score_offset': (float, 0.0, 10.0),
+    'box_nms_thresh': (float, 0.0, 1.0),
+    'crop_n_layers': (int, 0, 3),
+    'crop_nms_thresh': (float, 0.0, 1.0),
+    'crop_overlap_ratio': (float, 0.0, 1.0),
+    'crop_n_points_downscale_factor': (int, 1, 8),
+    'min_mask_region_area': (int, 0, 1 << 24),
+}
+MAX_GENERATORS = 8
+
+
+def load_sam(model_type="vit_h", checkpoint=None, device=None, input_size=1024, allow_unpinned=False):
+    """Build a SAM model from a checkpoint (the model store's by default) and move it to the device"""
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    sam = model_store.load_model(model_type, checkpoint, allow_unpinned=allow_unpinned)
+    model_tiers.set_input_size(sam, input_size)
+    sam.to(device=device)
+    sam.eval()
+    return sam
+
+
+def decode_image(data, max_side=None):
+    """Decode JPEG/PNG bytes to an RGB array, with max_side a reduced JPEG decode is used when possible"""
+    return image_loading.load_rgb(data, max_side)
+
+
+class SegmentationService:
+    """Holds a loaded SAM mask generator and segments images one at a time
+
+    A lock serializes inference, the HTTP server handles requests on several
+    threads but the accelerator runs one image at a time. With a quality_gate
+    (camera scripts/quality_gate.py) frames it drops are answered without
+    running the model, and every result carries the gate's verdict. With a
+    vegetation prompter (vegetation_roi.py) SAM is only prompted on vegetation.
+    """
+
+    def __init__(self, sam, cache=None, predictor=None, quality_gate=None, vegetation=None, **generator_params):
+        generator_params.setdefault('output_mode', "uncompressed_rle")
+        self.sam = sam
+        self.cache = cache
+        self.generator_params = generator_params
+        self.mask_generator = FeatureMaskGenerator(sam, cache, predictor, **generator_params)
+        self.predictor = self.mask_generator.predictor
+        self._generators = collections.OrderedDict()
+        self.quality_gate = quality_gate
+        self.vegetation = vegetation
+        self.lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.images_segmented = 0
+        self.images_dropped = 0
+        self.total_seconds = 0.0
+
+    def warmup(self, size=(480, 640)):
+        """Run one small image through the model so the first real request isn't slow"""
+        start = time.time()
+        image = np.random.default_rng(0).integers(0, 255, (*size, 3), dtype=np.uint8)
+        with self.lock, torch.inference_mode():
+            self.mask_generator.generate(image)
+        print(f"Warmup took {time.time() - start:.2f} seconds")
+
+    def generator_for(self, overrides):
+        """Mask generator with some parameters overridden, the last MAX_GENERATORS are kept"""
+        overrides = check_overrides(overrides)
+        if not overrides:
+            return self.mask_generator
+        key = tuple(sorted(overrides.items()))
+        if key in self._generators:
+            self._generators.move_to_end(key)
+        else:
+            self._generators[key] = FeatureMaskGenerator(self.sam, self.cache, self.predictor,
+                                                         **{**self.generator_params, **overrides})
+            if len(self._generators) > MAX_GENERATORS:
+                self._generators.popitem(last=False)
+        return self._generators[key]
+
+    def segment(self, image, **overrides):
+        """Segment an RGB image, optionally overriding some generator parameters
+        Returns:
+            dict with the image size, inference time, a list of masks, the quality verdict if gated
+            and the vegetation prefilter's info if used
+        """
+        verdict = self.quality_gate.check_image(image) if self.quality_gate else None
+        if verdict and verdict['decision'] == 'drop':
+            with self._stats_lock:
+                self.images_dropped += 1
+            return {'size': list(image.shape[:2]), 'seconds': 0.0, 'masks': [], 'quality': verdict}
+        with self.lock, torch.inference_mode():
+            start = time.time()
+            if self.vegetation:
+                masks, vegetation = self.vegetation.generate(self.generator_for(overrides), image)
+            else:
+                masks = self.generator_for(overrides).generate(image)
+            seconds = time.time() - start
+        with self._stats_lock:
+            self.images_segmented += 1
+            self.total_seconds += seconds
+        result = {
+            'size': list(image.shape[:2]),
+            'seconds': seconds,
+            'masks': [compact_mask(mask) for mask in masks],
+        }
+        if verdict:
+            result['quality'] = verdict
+        if self.vegetation:
+            result['vegetation'] = vegetation
+        return result
+
+    def stats(self):
+        with self._stats_lock:
+            stats = {
+                'images_segmented': self.images_segmented,
+                'images_dropped': self.images_dropped,
+                'mean_seconds': self.total_seconds / self.images_segmented if self.images_segmented else None,
+                'device': str(self.sam.device),
+            }
+        if self.cache is not None:
+            stats['embedding_cache'] = self.cache.stats()
+        return stats
+
+
+def parse_override(value):
+    """Query value as JSON, or the plain string when it isn't JSON (check_overrides() reports it)"""
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def check_overrides(overrides):
+    """Overrides converted to the types in OVERRIDES, raises ValueError for unknown names or bad values"""
+    checked = {}
+    for name, value in overrides.items():
+        if name not in OVERRIDES:
+            raise ValueError(f"Unknown parameter {name}, can override: {', '.join(sorted(OVERRIDES))}")
+        kind, low, high = OVERRIDES[name]
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or (kind is int and value != int(value)):
+            raise ValueError(f"{name} must be {'an integer' if kind is int else 'a number'}, got {value!r}")
+        if not low <= value <= high:
+            raise ValueError(f"{name} must be between {low} and {high}, got {value}")
+        checked[name] = kind(value)
+    return checked
+
+
+def compact_mask(mask):
+    """Keep the RLE and the scores of a mask record, rounded for a smaller response"""
+    return {
+        'segmentation': mask['segmentation'],
+        'bbox': [round(v, 1) for v in mask['bbox']],
+        'area': int(mask['area']),
+        'predicted_iou': round(mask['predicted_iou'], 4),
+        'stability_score': round(mask['stability_score'], 4),
+    }
+
+
+def make_handler(service):
+    class SegmentationHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/health':
+                self._send_json(200, service.stats())
+            else:
+                self._send_json(404, {'error': 'not found'})
+
+        def do_POST(self):
+            url = urllib.parse.urlsplit(self.path)
+            if url.path != '/segment':
+                self._send_json(404, {'error': 'not found'})
+                return
+            try:
+                overrides = check_overrides({name: parse_override(value)
+                                             for name, value in urllib.parse.parse_qsl(url.query)})
+                length = int(self.headers.get('Content-Length', 0))
+                image = decode_image(self.rfile.read(length))
+            except Exception as e:
+                self._send_json(400, {'error': str(e)})
+                return
+            try:
+                self._send_json(200, service.segment(image, **overrides))
+            except Exception as e:
+                self._send_json(500, {'error': str(e)})
+
+        def log_message(self, format, *args):
+            pass
+
+    return SegmentationHandler
+
+
+def serve_http(service, host="127.0.0.1", port=8765):
+    """Serve POST /segment (image bytes in, JSON masks out) and GET /health until interrupted"""
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    print(f"Segmentation service listening on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nStopping segmentation service")
+    finally:
+        server.server_close()
+
+
+def watch_directory(service, watch_dir, output_dir, poll_interval=0.5, preview_side=None):
+    """Segment every image that appears in watch_dir
+
+    Results are written to output_dir as <name>.masks.json and the image is
+    moved to watch_dir/processed, so a restart doesn't segment it again. With
+    preview_side, a <name>.preview.jpg overlay of that size is written too.
+    """
+    processed_dir = os.path.join(watch_dir, "processed")
+    os.makedirs(processed_dir, exist_ok=True)
+    os.makedirs(output_dir, exist_ok=True)
+    print(f"Watching {watch_dir} for images, writing masks to {output_dir}")
+
+    try:
+        while True:
+            names = sorted(f for f in os.listdir(watch_dir) if f.lower().endswith(IMAGE_EXTENSIONS))
+            for name in names:
+                image_path = os.path.join(watch_dir, name)
+                try:
+                    with open(image_path, 'rb') as f:
+                        image = decode_image(f.read())
+                    result = service.segment(image)
+                    result['image'] = name
+                    output_path = os.path.join(output_dir, os.path.splitext(name)[0] + ".masks.json")
+                    if preview_side:
+                        overlay.render(image, [m['segmentation'] for m in result['masks']],
+                                       os.path.join(output_dir, os.path.splitext(name)[0] + ".preview.jpg"),
+                                       max_side=preview_side)
+                    with open(output_path + ".partial", 'w') as f:
+                        json.dump(result, f)
+                    os.replace(output_path + ".partial", output_path)
+                    if result.get('quality', {}).get('decision') == 'drop':
+                        print(f"{name}: dropped by the quality gate ({', '.join(result['quality']['problems'])})")
+                    else:
+                        print(f"{name}: {len(result['masks'])} masks in {result['seconds']:.2f} seconds")
+                except Exception as e:
+                    print(f"Error segmenting {name}: {str(e)}")
+                shutil.move(image_path, os.path.join(processed_dir, name))
+            if not names:
+                time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        print("\nStopped watching")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resident SAM segmentation service")
+    parser.add_argument('--checkpoint', default=None, help="defaults to the model store's checkpoint for --model-type")
+    parser.add_argument('--allow-unpinned', action='store_true',
+                        help="load a --checkpoint that has no pinned SHA-256 in model_store.py (fine-tuned or converted)")
+    parser.add_argument('--model-type', default="vit_h", choices=sorted(model_tiers.CHECKPOINTS))
+    parser.add_argument('--input-size', type=int, default=1024, help="encoder input size, lower is faster")
+    parser.add_argument('--budget', type=float, default=None,
+                        help="pick the most accurate tier that segments a frame within this many seconds")
+    parser.add_argument('--device', default=None, help="cuda or cpu, defaults to cuda when available")
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--watch', default=None, help="directory to watch for images instead of serving HTTP")
+    parser.add_argument('--output', default="masks", help="where --watch writes results")
+    parser.add_argument('--previews', type=int, default=None, metavar='MAX_SIDE',
+                        help="with --watch, also write overlay previews with this long side")
+    parser.add_argument('--cache-dir', default=None, help="cache image embeddings in this directory")
+    parser.add_argument('--preset', default=None, choices=sorted(PRESETS), help="mask generator preset")
+    parser.add_argument('--backend', default="torch", choices=["torch", "onnx"],
+                        help="onnx runs graphs from onnx_backend.py export with onnxruntime on the CPU")
+    parser.add_argument('--onnx-dir', default="onnx_models")
+    parser.add_argument('--quantized', action='store_true', help="use the int8 ONNX graphs")
+    parser.add_argument('--threads', type=int, default=0, help="onnxruntime intra-op threads")
+    parser.add_argument('--quality-gate', nargs='?', const='', default=None, metavar='THRESHOLDS_JSON',
+                        help="skip blurred and badly exposed frames, optionally with thresholds from a JSON file")
+    parser.add_argument('--vegetation-roi', default=None, choices=['points', 'crops'],
+                        help="only prompt SAM on vegetation, with the grid points on it or on crops around it")
+    parser.add_argument('--vegetation-index', default='exg', choices=sorted(vegetation_roi.THRESHOLDS))
+    args = parser.parse_args()
+
+    start = time.time()
+    if args.budget:
+        tier, sam = model_tiers.auto_select(args.budget, device=args.device)
+        args.model_type, args.input_size = tier['model_type'], tier['input_size']
+    else:
+        sam = load_sam(args.model_type, args.checkpoint, args.device, args.input_size, args.allow_unpinned)
+    tier = model_tiers.tier_name({'model_type': args.model_type, 'input_size': args.input_size})
+    # int8 embeddings differ from the float ones, keep them apart in the cache
+    cache_tag = tier + "_int8" if args.backend == "onnx" and args.quantized else tier
+    cache = EmbeddingCache(args.cache_dir, cache_tag) if args.cache_dir else None
+    predictor = None
+    if args.backend == "onnx":
+        import onnx_backend
+        sam.to("cpu")
+        predictor = onnx_backend.load_predictor(sam, args.onnx_dir, tier, args.quantized, args.threads, cache=cache)
+    gate = None
+    if args.quality_gate is not None:
+        # the gate is shared with the capture scripts
+        if CAMERA_SCRIPTS not in sys.path:
+            sys.path.append(CAMERA_SCRIPTS)
+        import quality_gate
+        gate = quality_gate.QualityGate.load(args.quality_gate)
+    vegetation = None
+    if args.vegetation_roi:
+        vegetation = vegetation_roi.VegetationPrompter(args.vegetation_roi, args.vegetation_index)
+    service = SegmentationService(sam, cache, predictor, gate, vegetation, **PRESETS.get(args.preset, {}))
+    print(f"Loaded {tier} ({args.backend}) on {sam.device} in {time.time() - start:.2f} seconds")
+    service.warmup()
+
+    if args.watch:
+        watch_directory(service, args.watch, args.output, preview_side=args.previews)
+    else:
+        serve_http(service, args.host, args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+import json
+import time
+import argparse
+import torch
+import mask_rle
+import mask_nms
+import overlay
+import model_tiers
+import sam_service
+from mask_presets import PRESETS
+from sam_batch import FeatureMaskGenerator, encode_batch
+
+# Tiled full-resolution segmentation.
+#
+# SAM resizes every frame to a 1024 pixel long side, so on a 6192x4128 A6700
+# still a seedling a few dozen pixels wide ends up a handful of pixels. Here
+# the frame is cut into overlapping tiles of the encoder's input size, the
+# tiles are encoded in small batches and segmented one at a time, and each
+# tile's RLE masks are moved into frame coordinates. Only one batch of tiles
+# is in flight and masks stay RLE, so peak memory doesn't grow with the frame.
+#
+# Objects in the overlap are found by both tiles, and objects crossing a seam
+# are cut by one of them. Duplicates are removed with a greedy NMS on the masks
+# (see mask_nms.py), preferring masks that don't touch a seam and then higher
+# predicted IoU, and seam-cut pieces lying inside a whole mask are dropped.
+#
+#   masks = TiledSegmenter(sam, overlap=0.25, **PRESETS['balanced']).segment(image)
+
+
+def tile_boxes(h, w, tile_size=1024, overlap=0.25):
+    """Overlapping (x0, y0, x1, y1) tiles covering an h x w frame, the last row and column flush with the edge"""
+    step = max(1, int(tile_size * (1 - overlap)))
+
+    def starts(length):
+        if length <= tile_size:
+            return [0]
+        positions = list(range(0, length - tile_size, step))
+        return positions + [length - tile_size]
+
+    return [(x, y, min(x + tile_size, w), min(y + tile_size, h)) for y in starts(h) for x in starts(w)]
+
+
+def touches_seam(bbox, tile, size, margin=2):
+    """Whether an XYWH box in frame coordinates touches an edge of its tile that is inside the frame"""
+    x, y, w, h = bbox
+    x0, y0, x1, y1 = tile
+    frame_h, frame_w = size
+    return ((x0 > 0 and x <= x0 + margin) or (y0 > 0 and y <= y0 + margin)
+            or (x1 < frame_w and x + w >= x1 - margin) or (y1 < frame_h and y + h >= y1 - margin))
+
+
+def merge_tiles(records, iou_thresh=0.6, containment_thresh=0.8):
+    """Remove the duplicates among masks from overlapping tiles
+    Args:
+        records: Mask records in frame coordinates with 'touches_seam'
+        iou_thresh: Mask IoU above which two masks are duplicates
+        containment_thresh: Seam-cut masks with more than this fraction inside a kept mask are dropped
+    Returns:
+        The kept records, best first
+    """
+    scores = [record['predicted_iou'] + (0 if record['touches_seam'] else 1) for record in records]
+    containable = [record['touches_seam'] for record in records]
+    return mask_nms.dedupe(records, iou_thresh, containment_thresh, scores, containable)
+
+
+class TiledSegmenter:
+    """Segments a frame tile by tile and merges the masks across seams
+    Args:
+        sam: Loaded SAM model
+        tile_size: Tile side in pixels, the encoder's input size by default
+        overlap: Fraction of a tile shared with its neighbour
+        max_batch: Tiles encoded per forward pass
+        iou_thresh: Mask IoU above which masks from different tiles are duplicates
+        containment_thresh: Fraction of a seam-cut mask inside a kept mask above which it is dropped
+        generator_params: Passed on to SamAutomaticMaskGenerator
+    """
+
+    def __init__(self, sam, tile_size=None, overlap=0.25, max_batch=2, iou_thresh=0.6,
+                 containment_thresh=0.8, **generator_params):
+        generator_params['output_mode'] = "uncompressed_rle"
+        self.sam = sam
+        self.tile_size = tile_size or sam.image_encoder.img_size
+        self.overlap = overlap
+        self.max_batch = max_batch
+        self.iou_thresh = iou_thresh
+        self.containment_thresh = containment_thresh
+        self.mask_generator = FeatureMaskGenerator(sam, **generator_params)
+
+    def segment_tiles(self, image):
+        """Yield the masks of each tile in frame coordinates, a batch of tiles at a time"""
+        size = image.shape[:2]
+        tiles = tile_boxes(*size, self.tile_size, self.overlap)
+        for first in range(0, len(tiles), self.max_batch):
+            batch = tiles[first:first + self.max_batch]
+            crops = [image[y0:y1, x0:x1] for x0, y0, x1, y1 in batch]
+            with torch.inference_mode():
+                encoded = encode_batch(self.sam, crops)
+                for tile, crop, features in zip(batch, crops, encoded):
+                    x0, y0 = tile[:2]
+                    masks = []
+                    for record in self.mask_generator.generate(crop, features):
+                        x, y, w, h = record['bbox']
+                        record['segmentation'] = mask_rle.translate(record['segmentation'], (x0, y0), size)
+                        record['bbox'] = [x + x0, y + y0, w, h]
+                        record['point_coords'] = [[px + x0, py + y0] for px, py in record['point_coords']]
+                        record['crop_box'] = [x0, y0, tile[2] - x0, tile[3] - y0]
+                        record['touches_seam'] = touches_seam(record['bbox'], tile, size)
+                        masks.append(record)
+                    yield tile, masks
+            del encoded
+
+    def segment(self, image):
+        """Segment a full-resolution RGB frame, returns the merged mask records"""
+        records = []
+        for _, masks in self.segment_tiles(image):
+            records.extend(masks)
+        return merge_tiles(records, self.iou_thresh, self.containment_thresh)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Segment a full-resolution image tile by tile")
+    parser.add_argument('image')
+    parser.add_argument('--output', default=None, help="masks JSON, <image>.masks.json by default")
+    parser.add_argument('--preview', default=None, help="also write an overlay preview to this file")
+    parser.add_argument('--model-type', default="vit_h", choices=sorted(model_tiers.CHECKPOINTS))
+    parser.add_argument('--checkpoint', default=None)
+    parser.add_argument('--device', default=None)
+    parser.add_argument('--tile-size', type=int, default=1024)
+    parser.add_argument('--overlap', type=float, default=0.25)
+    parser.add_argument('--max-batch', type=int, default=2)
+    parser.add_argument('--preset', default='balanced', choices=sorted(PRESETS))
+    args = parser.parse_args()
+
+    sam = sam_service.load_sam(args.model_type, args.checkpoint, args.device, args.tile_size)
+    with open(args.image, 'rb') as f:
+        image = sam_service.decode_image(f.read())
+    segmenter = TiledSegmenter(sam, args.tile_size, args.overlap, args.max_batch, **PRESETS[args.preset])
+
+    start = time.time()
+    masks = segmenter.segment(image)
+    print(f"{len(masks)} masks from {len(tile_boxes(*image.shape[:2], args.tile_size, args.overlap))} tiles "
+          f"in {time.time() - start:.1f} seconds")
+
+    output = args.output or args.image.rsplit('.', 1)[0] + ".masks.json"
+    with open(output, 'w') as f:
+        json.dump({'image': args.image, 'size': list(image.shape[:2]),
+                   'masks': [dict(sam_service.compact_mask(mask), touches_seam=mask['touches_seam'])
+                             for mask in masks]}, f)
+    if args.preview:
+        overlay.render(image, masks, args.preview, max_side=2000)
+
+
+if __name__ == "__main__":
+    main()
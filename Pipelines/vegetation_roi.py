@@ -0,0 +1,237 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+import cv2
+from segment_anything.utils.amg import build_point_grid
+import mask_rle
+import mask_features
+import image_loading
+
+# Vegetation prefilter for the automatic mask generator.
+#
+# Much of a frame is soil, pavement, shadow or equipment, yet the generator
+# prompts SAM with its whole point grid. Here a vegetation index (ExG or ExGR,
+# see mask_features.py) is thresholded on a SIDE pixel copy of the frame,
+# cleaned with a morphological opening, and used in one of two ways:
+#   points  only the grid points that land on (slightly dilated) vegetation are
+#           prompted, so the decoder runs for fewer points on the same embedding
+#   crops   the bounding boxes of the vegetated connected components, padded
+#           and merged, are segmented as crops and their masks moved back into
+#           the frame. Each crop gets its own encoder pass at SAM's full input
+#           size, so small plants get more detail; the grid is thinned to the
+#           frame grid's density so the number of prompts stays the same
+# Frames without vegetation are answered without running SAM at all.
+#
+#   prompter = VegetationPrompter(mode='points')
+#   masks, info = prompter.generate(mask_generator, image)    # info: vegetation fraction, points prompted, regions
+#
+# python vegetation_roi.py turf_images/ prints the vegetation fraction, the
+# share of the grid that would be prompted and the regions of each image.
+
+SIDE = 256
+THRESHOLDS = {'exg': 0.05, 'exgr': 0.0}
+
+
+def vegetation_mask(image, index='exg', threshold=None, side=SIDE):
+    """Boolean vegetation mask of an RGB image at a long side of side
+    Args:
+        image: HxWx3 RGB array
+        index: 'exg' or 'exgr'
+        threshold: Index value above which a pixel is vegetation, THRESHOLDS[index] by default
+        side: Long side the mask is computed at
+    """
+    small = image_loading.fit(image, side)
+    # vegetation_indices() yields lazily, stop at the one we need
+    for name, values in mask_features.vegetation_indices(small):
+        if name == index:
+            break
+    else:
+        raise ValueError(f"Unknown vegetation index {index}")
+    mask = (values > (THRESHOLDS[index] if threshold is None else threshold)).astype(np.uint8)
+    # single pixels of green noise (and gaps of one pixel) don't change the regions
+    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, np.ones((3, 3), np.uint8))
+    return mask.astype(bool)
+
+
+def regions(mask, size, min_area=0.001, pad=0.1):
+    """Padded, merged bounding boxes of the vegetated connected components
+    Args:
+        mask: Low resolution vegetation mask
+        size: (h, w) of the frame the boxes are for
+        min_area: Components smaller than this fraction of the mask are ignored
+        pad: Each box grows by this fraction of its side on every side
+    Returns:
+        List of (x0, y0, x1, y1) boxes in frame pixels, largest first; overlapping boxes are merged
+    """
+    h, w = size
+    count, _, stats, _ = cv2.connectedComponentsWithStats(mask.astype(np.uint8), connectivity=8)
+    scale_x, scale_y = w / mask.shape[1], h / mask.shape[0]
+    boxes = []
+    for x, y, bw, bh, area in stats[1:]:
+        if area < min_area * mask.size:
+            continue
+        px, py = bw * pad, bh * pad
+        boxes.append([max(0, int((x - px) * scale_x)), max(0, int((y - py) * scale_y)),
+                      min(w, int(np.ceil((x + bw + px) * scale_x))), min(h, int(np.ceil((y + bh + py) * scale_y)))])
+    # merge until no two boxes overlap, so no object is segmented twice
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(len(boxes) - 1, i, -1):
+                a, b = boxes[i], boxes[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    boxes[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    del boxes[j]
+                    merged = True
+    boxes.sort(key=lambda box: (box[2] - box[0]) * (box[3] - box[1]), reverse=True)
+    return [tuple(box) for box in boxes]
+
+
+def filter_grid(grid, mask, size, box=None):
+    """Points of a normalized (x, y) grid over box (the whole frame by default) that land on the mask"""
+    h, w = size
+    x0, y0, x1, y1 = box or (0, 0, w, h)
+    mask_h, mask_w = mask.shape
+    columns = ((x0 + grid[:, 0] * (x1 - x0)) * mask_w / w).astype(int)
+    rows = ((y0 + grid[:, 1] * (y1 - y0)) * mask_h / h).astype(int)
+    return grid[mask[np.minimum(rows, mask_h - 1), np.minimum(columns, mask_w - 1)]]
+
+
+class VegetationPrompter:
+    """Runs a SamAutomaticMaskGenerator only where there is vegetation
+    Args:
+        mode: 'points' (prompt grid points on vegetation) or 'crops' (segment vegetated regions)
+        index: Vegetation index, 'exg' or 'exgr'
+        threshold: Index threshold, THRESHOLDS[index] by default
+        margin: Pixels (at side) the mask is dilated by before picking points, to keep points on leaf edges
+        min_area: Smallest component, as a fraction of the frame, that makes a region
+        max_crop_fraction: In crops mode, when the regions cover more of the frame than this the
+            frame is segmented whole (with the point filter), one encoder pass is cheaper then
+        side: Long side the vegetation mask is computed at
+    """
+
+    def __init__(self, mode='points', index='exg', threshold=None, margin=2, min_area=0.001,
+                 max_crop_fraction=0.5, side=SIDE):
+        if mode not in ('points', 'crops'):
+            raise ValueError(f"Unknown mode {mode}")
+        self.mode = mode
+        self.index = index
+        self.threshold = threshold
+        self.margin = margin
+        self.min_area = min_area
+        self.max_crop_fraction = max_crop_fraction
+        self.side = side
+
+    def masks(self, image):
+        """(vegetation mask, dilated mask the points are picked from) of an RGB image"""
+        mask = vegetation_mask(image, self.index, self.threshold, self.side)
+        if not self.margin:
+            return mask, mask
+        kernel = np.ones((2 * self.margin + 1, 2 * self.margin + 1), np.uint8)
+        return mask, cv2.dilate(mask.astype(np.uint8), kernel).astype(bool)
+
+    def _generate_points(self, generator, image, prompt_mask, size, box=None, features=None):
+        """generate() on image (the frame, or its crop box) with the first layer's grid cut down to
+        the points on prompt_mask, returns (masks, points prompted)
+
+        Crop layers (crop_n_layers > 0) keep their full grids.
+        """
+        grids = generator.point_grids
+        grid = grids[0]
+        if box is not None:
+            # as many points per frame pixel as the frame's grid, not per crop pixel
+            x0, y0, x1, y1 = box
+            points_per_side = np.sqrt(len(grid)) * max((x1 - x0) / size[1], (y1 - y0) / size[0])
+            grid = build_point_grid(max(1, int(np.ceil(points_per_side))))
+        grid = filter_grid(grid, prompt_mask, size, box)
+        if len(grid) == 0:
+            return [], 0
+        generator.point_grids = [grid] + list(grids[1:])
+        try:
+            return (generator.generate(image) if features is None else generator.generate(image, features)), len(grid)
+        finally:
+            generator.point_grids = grids
+
+    def generate(self, generator, image, features=None, masks=None):
+        """Segment an RGB image with generator, prompting only on vegetation
+        Args:
+            generator: SamAutomaticMaskGenerator (or FeatureMaskGenerator)
+            image: HxWx3 RGB array
+            features: Optional encode_batch() features of the whole image, used in points mode
+            masks: masks(image) when already computed
+        Returns:
+            (mask records in frame coordinates, info dict with the vegetation fraction, the points
+            prompted out of the grid and the regions segmented)
+        """
+        mask, prompt_mask = masks if masks is not None else self.masks(image)
+        size = image.shape[:2]
+        info = {'vegetation': round(float(mask.mean()), 4), 'grid': len(generator.point_grids[0]),
+                'points': 0, 'regions': []}
+        if not mask.any():
+            return [], info
+
+        boxes = regions(mask, size, self.min_area) if self.mode == 'crops' else []
+        covered = sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in boxes) / (size[0] * size[1])
+        if not boxes or covered > self.max_crop_fraction:
+            masks, info['points'] = self._generate_points(generator, image, prompt_mask, size, features=features)
+            return masks, info
+
+        records = []
+        for box in boxes:
+            x0, y0, x1, y1 = box
+            crop = image[y0:y1, x0:x1]
+            masks, points = self._generate_points(generator, crop, prompt_mask, size, box)
+            info['points'] += points
+            info['regions'].append(list(box))
+            for record in masks:
+                x, y, w, h = record['bbox']
+                record['segmentation'] = mask_rle.translate(record['segmentation'], (x0, y0), size)
+                record['bbox'] = [x + x0, y + y0, w, h]
+                record['point_coords'] = [[px + x0, py + y0] for px, py in record['point_coords']]
+                record['crop_box'] = [x0, y0, x1 - x0, y1 - y0]
+                records.append(record)
+        return records, info
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show how much of each image the vegetation prefilter keeps")
+    parser.add_argument('images', nargs='+', help="images or directories of images")
+    parser.add_argument('--index', default='exg', choices=sorted(THRESHOLDS))
+    parser.add_argument('--threshold', type=float, default=None)
+    parser.add_argument('--points-per-side', type=int, default=32)
+    parser.add_argument('--json', default=None, help="also write the per-image results to this file")
+    args = parser.parse_args()
+
+    grid = build_point_grid(args.points_per_side)
+    prompter = VegetationPrompter('crops', args.index, args.threshold)
+    paths = []
+    for source in args.images:
+        if os.path.isdir(source):
+            paths.extend(os.path.join(source, name) for name in sorted(os.listdir(source))
+                         if name.lower().endswith(('.jpg', '.jpeg', '.png')))
+        else:
+            paths.append(source)
+
+    results = {}
+    print(f"{'image':<32} {'veg':>6} {'points':>7} {'ms':>6}  regions")
+    for path in paths:
+        _, size = image_loading.image_info(path)
+        image = image_loading.load_rgb(path, prompter.side)
+        start = time.perf_counter()
+        mask, prompt_mask = prompter.masks(image)
+        boxes = regions(mask, size, prompter.min_area)
+        seconds = time.perf_counter() - start
+        points = len(filter_grid(grid, prompt_mask, size))
+        results[os.path.basename(path)] = {'vegetation': float(mask.mean()), 'points': points,
+                                           'regions': [list(box) for box in boxes]}
+        print(f"{os.path.basename(path):<32} {mask.mean():6.3f} {points / len(grid):7.1%} {seconds * 1000:6.1f}  {len(boxes)}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
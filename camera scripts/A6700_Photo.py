@@ -1,6 +1,6 @@
 import time
 import os
-from google.cloud import storage
+import storage_backends
 import gphoto2 as gp #type: ignore
 import logging
 import locale
@@ -8,9 +8,14 @@ import subprocess
 import sys
 import mimetypes
 import datetime
+import functools
 import platform  # To detect the operating system
 import traceback
 from pathlib import Path
+import capture_manifest
+import adaptive_upload
+import async_uploader
+import quality_gate
 
 # set up logging and global variables
 def setup():
@@ -32,6 +37,14 @@ def setup():
     global SETTINGS_NAMES  
     SETTINGS_NAMES = ['aperture', 'shutter_speed', 'iso', 'exposure_mode']
 
+    # bucket the images are uploaded to, point it at a file:// directory to run offline
+    global STORAGE_URL
+    STORAGE_URL = os.environ.get("TURFGRASS_STORAGE_URL", "gs://turfgrass")
+
+    # blurred and badly exposed captures are dropped before upload, thresholds from a JSON file if set
+    global QUALITY_GATE_FILE
+    QUALITY_GATE_FILE = os.environ.get("TURFGRASS_QUALITY_GATE")
+
 # Add this function after the setup() function but before the connect_to_cam() function
 def initialize_camera_settings(camera):
     # No need to query camera - use hardcoded values from setup()
@@ -72,11 +85,80 @@ def connect_to_cam():
                 sys.exit(1)
             time.sleep(2)
 
-# take single photo
+# read the current exposure settings so they can be recorded in the manifest
+def get_current_settings(camera):
+    settings = {}
+    try:
+        config = gp.check_result(gp.gp_camera_get_config(camera))
+    except:
+        return settings
+    for setting_name, camera_setting_names in [('aperture', ['aperture', 'f-number', 'fnumber']),
+                                               ('shutter_speed', ['shutterspeed']),
+                                               ('iso', ['iso']),
+                                               ('exposure_mode', ['expprogram'])]:
+        for camera_setting_name in camera_setting_names:
+            try:
+                widget = gp.check_result(gp.gp_widget_get_child_by_name(config, camera_setting_name))
+                settings[setting_name] = gp.check_result(gp.gp_widget_get_value(widget))
+                break
+            except:
+                continue
+    return settings
+
+# record an uploaded capture in the current session's manifest, called from the upload thread
+# metadata carries the quality verdict (and 'replaces' for a backfilled original)
+def record_capture(destination_name, local_filename, variant, capture_time, upload, metadata):
+    global manifest
+    if manifest is None:
+        return
+    record_in(manifest, destination_name, local_filename, variant, capture_time, upload, metadata)
+
+# record an upload in a given session's manifest
+def record_in(session_manifest, destination_name, local_filename, variant, capture_time, upload, metadata):
+    try:
+        capture_manifest.record_upload(session_manifest, destination_name, local_filename, variant,
+                                       capture_time, upload, metadata)
+    except Exception as e:
+        print(f"Error writing manifest entry: {str(e)}")
+
+# open the storage backend once instead of creating a new client for every image
+def get_backend():
+    global backend
+    if backend is None:
+        backend = storage_backends.open_backend(STORAGE_URL)
+    return backend
+
+# upload function used by the background uploader, returns a future so many uploads can be in flight
+def upload_to_bucket(local_filename, destination_name, content_type):
+    global engine
+    if engine is None:
+        engine = async_uploader.AsyncUploader(get_backend())
+    return engine.submit(local_filename, destination_name, content_type)
+
+# score a capture with the quality gate, returns the verdict (None if it can't be scored),
+# a dropped capture is deleted
+def check_quality(local_filename):
+    try:
+        verdict = gate.check_file(local_filename)
+    except Exception as e:
+        print(f"Could not score {local_filename}, keeping it: {str(e)}")
+        return None
+    if verdict['decision'] == 'drop':
+        print(f"Dropped capture ({', '.join(verdict['problems'])})")
+        os.remove(local_filename)
+    return verdict
+
+# queue a capture for upload, the verdict goes into its manifest entry once it is uploaded
+def submit_capture(local_filename, destination_name, capture_time, verdict):
+    uploader.submit(local_filename, destination_name, "image/jpeg", capture_time.isoformat(),
+                    metadata={'quality': verdict}, session=manifest['session_id'])
+
+# take single photo, returns the uploaded object name or False
 def take_photo():
     try:
         global camera
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+        capture_time = datetime.datetime.now()
+        timestamp = capture_time.strftime("%Y%m%d_%H%M%S_%f")
         local_filename = f"capture_{timestamp}.jpg"
         
         try:
@@ -84,25 +166,15 @@ def take_photo():
             preview_file.save(local_filename)
             print("Took image")
             try:
-                bucket_name = "turfgrass"
                 destination_name = f"image_{timestamp}.jpg"
+                verdict = check_quality(local_filename)
+                if verdict and verdict['decision'] == 'drop':
+                    return False
                 
-                json_files = [f for f in os.listdir() if f.endswith('.json')]
-                if not json_files:
-                    raise Exception("No JSON credential file found")
-                os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = json_files[0]
-                
-                storage_client = storage.Client()
-                bucket = storage_client.bucket(bucket_name)
-                blob = bucket.blob(destination_name)
-                
-                with open(local_filename, 'rb') as f:
-                    blob.upload_from_file(f, content_type="image/jpeg")
-                
-                if os.path.exists(local_filename):
-                    os.remove(local_filename)
+                # upload happens in the background, degraded if the link is slow
+                submit_capture(local_filename, destination_name, capture_time, verdict)
                 
-                return True
+                return destination_name
                 
             except:
                 return False
@@ -118,27 +190,19 @@ def take_photo():
                     camera_file.save(local_filename)
                     
                     try:
-                        bucket_name = "turfgrass"
                         destination_name = f"image_{timestamp}.jpg"
+                        verdict = check_quality(local_filename)
+                        if verdict and verdict['decision'] == 'drop':
+                            return False
                         
-                        os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "ai-research-451903-6fb81b030f50.json"
-                        
-                        storage_client = storage.Client()
-                        bucket = storage_client.bucket(bucket_name)
-                        blob = bucket.blob(destination_name)
-                        
-                        with open(local_filename, 'rb') as f:
-                            blob.upload_from_file(f, content_type="image/jpeg")
-                        
-                        if os.path.exists(local_filename):
-                            os.remove(local_filename)
+                        submit_capture(local_filename, destination_name, capture_time, verdict)
                         
                         try:
                             camera.file_delete(folder, name)
                         except:
                             pass
                         
-                        return True
+                        return destination_name
                         
                     except:
                         return False
@@ -156,30 +220,21 @@ def take_photo():
     
     return False
 
-# Function to upload a file to Google Cloud Storage with proper MIME type
-def upload_file_to_gcs(file_path, bucket_name):
+# Function to upload a file to the storage bucket with proper MIME type
+def upload_file_to_gcs(file_path, storage_url=None):
     """
-    Uploads an image file to Google Cloud Storage with proper MIME type
+    Uploads an image file to the storage bucket with proper MIME type
     
     Parameters:
     file_path (str): Local path to the image file to upload
-    bucket_name (str): Name of your GCS bucket
+    storage_url (str): Bucket URL (gs://, s3:// or file://), defaults to STORAGE_URL
     """
     try:
         # Generate a destination name based on timestamp
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
         destination_name = f"image_{timestamp}.jpg"
         
-        os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "ai-research-451903-6fb81b030f50.json"
-        
-        # Initialize the Google Cloud Storage client
-        storage_client = storage.Client()
-        
-        # Get the bucket object
-        bucket = storage_client.bucket(bucket_name)
-        
-        # Create a blob object
-        blob = bucket.blob(destination_name)
+        backend = storage_backends.open_backend(storage_url) if storage_url else get_backend()
         
         # Set content type based on image extension (default to JPEG)
         _, ext = os.path.splitext(file_path.lower())
@@ -193,13 +248,13 @@ def upload_file_to_gcs(file_path, bucket_name):
         content_type = image_extensions.get(ext, 'image/jpeg')
         
         # Upload the file with the appropriate content type
-        blob.upload_from_filename(file_path, content_type=content_type)
+        storage_backends.run(backend.put(file_path, destination_name, content_type))
         
-        print(f"Image {file_path} uploaded to {destination_name} in bucket {bucket_name}")
+        print(f"Image {file_path} uploaded to {destination_name} in {storage_url or STORAGE_URL}")
         return True
         
     except Exception as e:
-        print(f"Error uploading to GCS: {str(e)}")
+        print(f"Error uploading to storage: {str(e)}")
         return False
 
 # set camera settings
@@ -746,6 +801,11 @@ def prompt():
         except ValueError:
             continue
 
+    # every prompt is a new session with its own manifest
+    global manifest
+    manifest = capture_manifest.new_session("photo", get_current_settings(camera))
+    gate.reset()
+
     if num_pics == 1:
         take_photo()
     else:
@@ -766,9 +826,7 @@ def prompt():
             try:
                 result = take_photo()
                 if result:
-                    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-                    filename = f"image_{timestamp}.jpg"
-                    captured_filenames.append(filename)
+                    captured_filenames.append(result)
                     successful_captures += 1
             except:
                 if i > 0 and successful_captures == 0:
@@ -781,7 +839,38 @@ def prompt():
                         break
         
         print(f"\nCaptured {successful_captures} of {num_pics} images")
-        print("Images saved to Google Cloud Storage bucket: turfgrass")
+        print(f"Quality gate: {gate.counts['accept']} accepted, {gate.counts['tag']} tagged, {gate.counts['drop']} dropped")
+        print(f"Images saved to {STORAGE_URL}")
+
+    finish_uploads()
+    upload_session_manifest()
+
+# wait for the background uploads and offer to upload full resolution originals
+def finish_uploads():
+    print("Waiting for uploads to finish...")
+    uploader.drain()
+    stats = uploader.stats()
+    print(f"Uploaded {stats['uploaded']} images, {stats['degraded']} at reduced quality, {stats['failed']} failed")
+
+    # only this session's originals, their entries go into this session's manifest
+    session_id = manifest['session_id']
+    pending = len(uploader.pending_backfill(session_id))
+    if pending:
+        backfill = input(f"Upload {pending} full resolution originals now? (yes/no): ").lower()
+        if backfill in ["y", "yes"]:
+            count = uploader.backfill(session_id, on_uploaded=functools.partial(record_in, manifest))
+            print(f"Uploaded {count} originals")
+        else:
+            print(f"Originals kept in {uploader.backfill_dir(session_id)}, "
+                  f"upload them later with: python adaptive_upload.py {session_id}")
+
+# upload the session manifest next to the images
+def upload_session_manifest():
+    global manifest
+    try:
+        capture_manifest.upload_manifest(manifest, get_backend())
+    except Exception as e:
+        print(f"Error uploading manifest: {str(e)}")
 
 # main function
 def main():
@@ -789,6 +878,16 @@ def main():
     connect_to_cam()
     global first
     first = True
+    global manifest
+    manifest = None
+    global backend
+    backend = None
+    global engine
+    engine = None
+    global gate
+    gate = quality_gate.QualityGate.load(QUALITY_GATE_FILE)
+    global uploader
+    uploader = adaptive_upload.AdaptiveUploader(upload_to_bucket, on_uploaded=record_capture)
     continue_prompt = True
     while continue_prompt:
         prompt()
@@ -1,7 +1,6 @@
 import time
 import os
-import random
-from google.cloud import storage
+import storage_backends
 import gphoto2 as gp #type: ignore
 import logging
 import locale
@@ -15,8 +14,13 @@ from pathlib import Path
 import cv2 # type: ignore
 import numpy as np # type: ignore
 import io # type: ignore
+import json
 import uuid # type: ignore
-from PIL import Image # type: ignore
+import capture_manifest
+import async_uploader
+import augment
+import quality_gate
+import keyframes
 
 
 
@@ -39,16 +43,26 @@ def setup():
     SETTINGS = [APERTURE_SETTINGS, SHUTTER_SPEED_SETTINGS, ISO_SETTINGS]
     SETTINGS_NAMES = ['aperture', 'shutterspeed', 'iso']
     
-    # Google Cloud Storage configuration
+    # Storage configuration, point TURFGRASS_STORAGE_URL at a file:// directory to run offline
     global bucket_name, GCS_FOLDER
     bucket_name = "turfgrass"
     GCS_FOLDER = "a6700_frames"  # Folder in the bucket to store frames     
-    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "ai-research-451903-6fb81b030f50.json"
-        
-    global storage_client
-    storage_client = storage.Client()
-    global bucket
-    bucket = storage_client.bucket(bucket_name)
+    
+    # frames are scored and tagged; with a thresholds JSON file (see quality_gate.py) the frames it
+    # drops aren't uploaded either, they stay in the video so its frame numbers and timing hold
+    global QUALITY_GATE_FILE
+    QUALITY_GATE_FILE = os.environ.get("TURFGRASS_QUALITY_GATE")
+    
+    # a frame becomes a keyframe once this fraction of its view is new ground (see keyframes.py)
+    global KEYFRAME_NEW_GROUND
+    KEYFRAME_NEW_GROUND = 0.4
+    
+    # Augmentation applied to the frames when rotation is chosen, see augment.py for the ops
+    global ROTATE_AUGMENTATION
+    ROTATE_AUGMENTATION = "rotate=180"   # any angle, e.g. "rotate=180,hflip=0.5,jitter=0.2" for more variety
+    
+    global backend
+    backend = storage_backends.open_backend(os.environ.get("TURFGRASS_STORAGE_URL", f"gs://{bucket_name}"))
 
 def connect_to_cam():
     """Connect to the camera"""
@@ -281,29 +295,41 @@ def prompt():
         except ValueError:
             print("Please enter a valid number.")
     
+    print(f"\nAugment the frames ({ROTATE_AUGMENTATION}) before making the video? (yes/no)")
+    rotation = input().lower().startswith('y')
     
-    rotation = False
+    print("\nAlso upload every frame as it is captured? (yes/no)")
+    upload_frames = input().lower().startswith('y')
     
-    return duration, rotation
+    return duration, rotation, upload_frames
 
-def rotate_image(image_path):
-    """Rotate image by a random angle
-    Args:
-        image_path: Path to the image file
-    Returns:
-        PIL Image object
-    """
+def get_current_settings(camera):
+    """Read the current exposure settings so they can be recorded in the manifest"""
+    settings = {}
     try:
-        with Image.open(image_path) as image:
-            random_angle = random.randint(0, 360)  # Random rotation between 0-360 degrees
-            rotated = image.rotate(random_angle, expand=True)
-            return rotated
-    except Exception as e:
-        print(f"Error rotating image {image_path}: {str(e)}")
-        return None
+        config = gp.check_result(gp.gp_camera_get_config(camera))
+    except Exception:
+        return settings
+    for setting_name in ['aperture', 'shutterspeed', 'iso']:
+        try:
+            widget = gp.check_result(gp.gp_widget_get_child_by_name(config, setting_name))
+            settings[setting_name] = gp.check_result(gp.gp_widget_get_value(widget))
+        except Exception:
+            continue
+    return settings
 
-def capture_frames(camera, duration, fps=30):
-    """Capture frames from the camera"""
+def capture_frames(camera, duration, fps=30, uploader=None, manifest=None, gate=None, selector=None, dropped=None):
+    """Capture frames from the camera
+    Args:
+        camera: Initialized gphoto2 camera
+        duration: Seconds to capture for
+        fps: Frames per second to capture
+        uploader: Optional AsyncUploader, each frame is submitted to it as soon as it is saved
+        manifest: Session manifest the uploaded frames are recorded in
+        gate: Optional QualityGate, frames it drops are not uploaded but stay in the video
+        selector: Optional KeyframeSelector, fed every frame that goes into the video
+        dropped: Optional list the names of the frames the gate dropped are appended to
+    """
 
     print(f"Starting rapid frame capture for {duration} seconds at {fps} FPS")
     # create temp directory
@@ -328,14 +354,45 @@ def capture_frames(camera, duration, fps=30):
         except gp.GPhoto2Error as e:
             continue
 
+        capture_time = datetime.datetime.now()
         temp_filename = os.path.join(temp_dir, f"frame_{time.time()}.jpg")
         # Save preview image to temp file
         file.save(temp_filename)
+        
+        # score the frame on a small copy, blurred or badly exposed frames aren't uploaded
+        quality = None
+        if gate:
+            quality = gate.check_file(temp_filename)
+        
+        # score the motion since the last keyframe while the frame is still in the page cache
+        if selector:
+            selector.add(os.path.basename(temp_filename), temp_filename)
+        
+        # upload in the background, the frame stays on disk for the video
+        if quality and quality['decision'] == 'drop':
+            if dropped is not None:
+                dropped.append(os.path.basename(temp_filename))
+        elif uploader:
+            submit_frame(uploader, manifest, temp_filename, capture_time, quality)
 
         time.sleep(time_per_frame)
     
 
     print(f"Captured {total_frames} frames in {duration} seconds")
+    if gate:
+        print(f"Quality gate: {gate.counts['accept']} accepted, {gate.counts['tag']} tagged, {gate.counts['drop']} dropped")
+    if selector:
+        print(f"Selected {len(selector.keyframes)} keyframes of {selector.frames} frames")
+
+def submit_frame(uploader, manifest, frame_path, capture_time, quality=None):
+    """Submit one frame for upload and record it (with its quality verdict) in the manifest once it is uploaded"""
+    destination_name = f"{GCS_FOLDER}/frames_{manifest['session_id']}/{os.path.basename(frame_path)}"
+    
+    # runs on the uploader's worker thread, with the size and crc32c the upload verified
+    def record(upload):
+        capture_manifest.append_entry(manifest, destination_name, frame_path, capture_time,
+                                      crc32c=upload['crc32c'], size=upload['size'], quality=quality)
+    return uploader.submit(frame_path, destination_name, 'image/jpeg', on_uploaded=record)
 
 def create_video_from_images(image_folder, output_video_path, fps=30):
     # Get all images and extract timestamps for sorting
@@ -449,23 +506,50 @@ def download_from_gcs(source_blob_name):
         # Generate a unique filename
         tmp_filename = os.path.join(tmp_dir, f"temp_video_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.mp4")
         
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(source_blob_name)
-        
         # Download to tmp file
-        with open(tmp_filename, "wb") as file_obj:
-            blob.download_to_file(file_obj)
+        storage_backends.run(backend.get(source_blob_name, tmp_filename))
             
         print(f"Downloaded {source_blob_name} to {tmp_filename}")
         return tmp_filename
     except Exception as e:
-        print(f"Error downloading from GCS: {str(e)}")
+        print(f"Error downloading from storage: {str(e)}")
         traceback.print_exc()
         return None
 
-def upload_video_to_gcs(video_path):
-    """Upload video to Google Cloud Storage"""
+def probe_video(video_path):
+    """Read the video stream header with ffprobe, without decoding any frames
+    Returns:
+        dict with codec_name, width, height and nb_frames, or None if the file is not a valid video
+    """
+    try:
+        result = subprocess.run([
+            'ffprobe', '-v', 'error',
+            '-select_streams', 'v:0',
+            '-show_entries', 'stream=codec_name,width,height,nb_frames',
+            '-of', 'json',
+            video_path
+        ], capture_output=True, text=True, timeout=30)
+        if result.returncode != 0:
+            print(f"ffprobe failed: {result.stderr}")
+            return None
+        streams = json.loads(result.stdout).get('streams', [])
+        return streams[0] if streams else None
+    except Exception as e:
+        print(f"Error probing video file: {str(e)}")
+        return None
+
+def get_signed_url(blob_name, hours=1):
+    """Generate a signed URL for an uploaded video, only when someone asks for one"""
+    return storage_backends.run(backend.signed_url(blob_name, expiration=datetime.timedelta(hours=hours)))
+
+def upload_video_to_gcs(video_path, signed_url=False):
+    """Upload video to the storage bucket
+    Args:
+        video_path: Path to the MP4 to upload
+        signed_url: Also generate and print a signed URL valid for 1 hour
+    Returns:
+        dict with the uploaded blob's name, size, crc32c and md5, or False
+    """
     if not os.path.exists(video_path):
         print(f"Error: Video file {video_path} does not exist")
         return False
@@ -475,95 +559,45 @@ def upload_video_to_gcs(video_path):
         return False
         
     try:
-        # Verify the video file is readable
-        try:
-            cap = cv2.VideoCapture(video_path)
-            if not cap.isOpened():
-                print("Error: Cannot open video file for verification")
-                return False
-            ret, frame = cap.read()
-            if not ret:
-                print("Error: Cannot read frames from video file")
-                return False
-            cap.release()
-        except Exception as e:
-            print(f"Error verifying video file: {str(e)}")
+        # Verify the container from its header, no frames are decoded
+        stream = probe_video(video_path)
+        if not stream or not stream.get('width'):
+            print("Error: Video file has no readable video stream")
             return False
             
-        # Find first json file in directory to use as credentials
-        json_files = [f for f in os.listdir() if f.endswith('.json')]
-        if not json_files:
-            raise Exception("No JSON credential file found in directory")
-        os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = json_files[0]
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(bucket_name)
-        
         # Generate a unique filename using timestamp
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
         destination_blob_name = f"{GCS_FOLDER}/video_{timestamp}.mp4"
         
-        blob = bucket.blob(destination_blob_name)
-        
-        # Set content type and cache control before upload
-        blob.content_type = 'video/mp4'
-        blob.cache_control = 'public, max-age=3600'  # Cache for 1 hour
-        
-        # Upload the file with explicit content type
-        with open(video_path, 'rb') as file_obj:
-            blob.upload_from_file(
-                file_obj,
-                content_type='video/mp4',
-                timeout=600  # 10 minute timeout
-            )
-        
-        # Verify the upload
-        if not blob.exists():
-            print("Error: Blob does not exist after upload")
-            return False
-            
-        # Generate a signed URL that will work for 1 hour
-        signed_url = blob.generate_signed_url(
-            version="v4",
-            expiration=datetime.timedelta(hours=1),
-            method="GET"
-        )
+        # Upload the file with explicit content type and cache for 1 hour.
+        # The backend hashes the file while sending it and raises if the
+        # server's crc32c/MD5 differ, so no extra request is needed to verify.
+        upload = storage_backends.run(backend.put(
+            video_path,
+            destination_blob_name,
+            content_type='video/mp4',
+            cache_control='public, max-age=3600'
+        ))
         
+        if signed_url:
+            print(f"Signed URL (valid 1 hour): {get_signed_url(destination_blob_name)}")
         
-        return True
+        return upload
+    except storage_backends.IntegrityError as e:
+        print(f"Error: Upload corrupted: {str(e)}")
+        return False
     except Exception as e:
-        print(f"Error uploading to GCS: {str(e)}")
+        print(f"Error uploading to storage: {str(e)}")
         traceback.print_exc()
         return False
 
-def main():
-    setup()
-    camera = connect_to_cam()
-    global rotate
-    duration, rotate = prompt()
-    try:
-        capture_frames(camera, duration)
-        print("Captured frames")
-    except KeyboardInterrupt:
-        print("\nProgram interrupted by user")
-    
-
-    if rotate:
-        print("Rotating images...")
-        for filename in os.listdir("temp_frames"):
-            image_path = os.path.join("temp_frames", filename)
-            rotated_image = rotate_image(image_path)
-            if rotated_image:
-                rotated_image.save(image_path)
-            else:
-                print(f"Skipping rotation for {filename} due to error")
-                
+def make_video(output_video):
+    """Encode temp_frames into output_video and upload it, returns the upload result or None"""
     # Use tmp directory for video processing
-    tmp_dir = "/tmp"
+    tmp_dir = os.path.dirname(output_video)
     if not os.path.exists(tmp_dir):
         os.makedirs(tmp_dir)
     
-    output_video = os.path.join(tmp_dir, "output_video.mp4")
-    
     # Delete existing output video if it exists
     if os.path.exists(output_video):
         os.remove(output_video)
@@ -572,20 +606,79 @@ def main():
     # create video from images
     if not create_video_from_images("temp_frames", output_video, 30):
         print("Failed to create video file")
-        return
+        return None
     
     # upload video to gcs
-    if not upload_video_to_gcs(output_video):
+    upload = upload_video_to_gcs(output_video)
+    if not upload:
         print("Failed to upload video to GCS")
-        return
-        
-    # Clean up tmp file
+        return None
+    return upload
+
+def main():
+    setup()
+    camera = connect_to_cam()
+    global rotate
+    duration, rotate, upload_frames = prompt()
+    manifest = capture_manifest.new_session("rapid", get_current_settings(camera))
+    uploader = async_uploader.AsyncUploader(backend) if upload_frames else None
+    capture_time = datetime.datetime.now()
+    selector = keyframes.KeyframeSelector(min_new_ground=KEYFRAME_NEW_GROUND)
+    # untuned default thresholds only tag frames
+    gate = quality_gate.QualityGate.load(QUALITY_GATE_FILE) if QUALITY_GATE_FILE else quality_gate.QualityGate(drop=())
+    dropped = []
     try:
-        os.remove(output_video)
-    except:
-        pass
+        capture_frames(camera, duration, uploader=uploader, manifest=manifest,
+                       gate=gate, selector=selector, dropped=dropped)
+        print("Captured frames")
+    except KeyboardInterrupt:
+        print("\nProgram interrupted by user")
+    
+
+    # the frames already uploaded are recorded in the manifest however the rest goes
+    upload = None
+    output_video = os.path.join("/tmp", "output_video.mp4")
+    try:
+        if rotate:
+            # frames are rotated in place, let the uploads read the originals first
+            if uploader:
+                uploader.drain()
+            print("Rotating images...")
+            # frames are rotated on all cores and written back once they are all done
+            frame_paths = [os.path.join("temp_frames", filename) for filename in sorted(os.listdir("temp_frames"))]
+            outputs = augment.augment_files(frame_paths, augment.Pipeline.from_spec(ROTATE_AUGMENTATION))
+            print(f"Rotated {augment.write_outputs(outputs)} of {len(frame_paths)} frames")
+        upload = make_video(output_video)
+    finally:
+        # frames were uploading while the video was encoded, wait for the rest
+        if uploader:
+            print("Waiting for frame uploads to finish...")
+            uploader.drain()
+            stats = uploader.stats()
+            print(f"Uploaded {stats['completed']} frames, {stats['failed']} failed")
         
-    print("Successfully completed video creation and upload")
+        # record the video in the session manifest and upload it alongside, the keyframes
+        # are the frames worth segmenting ('index' is the frame number in the video)
+        try:
+            if upload:
+                capture_manifest.append_entry(manifest, upload['name'], output_video, capture_time,
+                                              crc32c=upload['crc32c'], size=upload['size'],
+                                              duration=duration, fps=30,
+                                              frames=len(os.listdir("temp_frames")),
+                                              keyframes=selector.keyframes,
+                                              dropped_frames=dropped)
+            capture_manifest.upload_manifest(manifest, backend)
+        except Exception as e:
+            print(f"Error writing manifest: {str(e)}")
+        
+        # Clean up tmp file
+        try:
+            os.remove(output_video)
+        except:
+            pass
+    
+    if upload:
+        print("Successfully completed video creation and upload")
     print("Exiting program...")
 
 if __name__ == "__main__":
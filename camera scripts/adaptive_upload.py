@@ -0,0 +1,346 @@
+import os
+import json
+import time
+import argparse
+import functools
+import queue
+import shutil
+import threading
+import collections
+import concurrent.futures
+from PIL import Image # type: ignore
+
+# Bandwidth-adaptive stage between capture and upload.
+#
+# Captures are moved into a local spool and uploaded by a background thread.
+# The thread keeps a moving average of upload throughput, and when the backlog
+# in the queue would take too long to drain it walks down the ladder below:
+# lower JPEG quality first, then downscale, then upload a thumbnail now and the
+# full resolution original later. Originals of degraded uploads stay in the
+# spool, per capture session, until backfill() uploads them.
+#
+# Originals left over from earlier sessions are uploaded, and recorded in the
+# manifest of the session that captured them, with
+#   python adaptive_upload.py --storage-url gs://turfgrass               # every session with originals waiting
+#   python adaptive_upload.py --storage-url gs://turfgrass 20240514_101500_000000
+
+# each rung is used while the backlog (in seconds of upload time) is below 'max_backlog'
+DEFAULT_LADDER = [
+    {'name': 'original', 'max_backlog': 2.0},
+    {'name': 'quality_80', 'max_backlog': 5.0, 'quality': 80},
+    {'name': 'quality_60', 'max_backlog': 10.0, 'quality': 60},
+    {'name': 'half_size', 'max_backlog': 20.0, 'quality': 60, 'scale': 0.5},
+    {'name': 'thumbnail', 'max_backlog': float('inf'), 'quality': 70, 'max_side': 320},
+]
+
+SPOOL_DIR = "upload_spool"
+
+
+def encode_variant(source_path, output_path, rung):
+    """Write the degraded version of a JPEG described by a ladder rung
+    Args:
+        source_path: Path to the original image
+        output_path: Where to write the re-encoded image
+        rung: Ladder entry with optional 'quality', 'scale' and 'max_side'
+    Returns:
+        output_path
+    """
+    with Image.open(source_path) as image:
+        if 'scale' in rung:
+            size = (max(1, int(image.width * rung['scale'])), max(1, int(image.height * rung['scale'])))
+            image.draft('RGB', size)
+            image = image.resize(size, Image.BILINEAR)
+        if 'max_side' in rung:
+            image.draft('RGB', (rung['max_side'], rung['max_side']))
+            image.thumbnail((rung['max_side'], rung['max_side']))
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        image.save(output_path, 'JPEG', quality=rung.get('quality', 90))
+    return output_path
+
+
+def _upload_info(result):
+    """The upload's result when it describes the object, {} for a plain success flag"""
+    return result if isinstance(result, dict) else {}
+
+
+class AdaptiveUploader:
+    """Background uploader that degrades captures when the link can't keep up
+
+    upload_fn(local_path, object_name, content_type) does the actual upload. It
+    either blocks and returns something truthy on success, or returns a
+    concurrent.futures.Future (e.g. AsyncUploader.submit) so many uploads can
+    be in flight at once. on_uploaded(object_name, local_path, variant,
+    capture_time, result, metadata) is called after each successful upload,
+    before the uploaded file is removed, so the caller can record it (e.g. in
+    the session manifest); result is what the upload returned (a dict with
+    'size' and 'crc32c' for the storage backends) and metadata what was given
+    to submit(). For a backfilled original, metadata also has 'replaces', the
+    variant uploaded before. Finished uploads are handled on a
+    thread of their own, never on the thread that completed the future (the
+    storage event loop). Uploads that fail are kept in the spool for backfill().
+    """
+
+    def __init__(self, upload_fn, ladder=None, spool_dir=SPOOL_DIR, on_uploaded=None, window=10.0):
+        self.upload_fn = upload_fn
+        self.ladder = ladder or DEFAULT_LADDER
+        self.spool_dir = spool_dir
+        self.on_uploaded = on_uploaded
+        self.window = window
+
+        self.level = 0
+        self.queued_bytes = 0       # bytes waiting in the queue or still uploading
+        self.in_flight = 0
+        self.uploaded = 0
+        self.failed = 0
+        self.degraded = 0
+
+        self._completions = collections.deque()     # (start, end, bytes) of recent uploads
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._finisher = concurrent.futures.ThreadPoolExecutor(1)
+        os.makedirs(spool_dir, exist_ok=True)
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, local_path, object_name, content_type="image/jpeg", capture_time=None, metadata=None,
+               session=None):
+        """Move a capture into the spool and queue it for upload, returns immediately
+        Args:
+            metadata: JSON-serializable dict handed to on_uploaded, also when the original is backfilled
+            session: Capture session the original is kept under for backfill()
+        """
+        spool_path = os.path.join(self.spool_dir, os.path.basename(local_path))
+        shutil.move(local_path, spool_path)
+        size = os.path.getsize(spool_path)
+        with self._lock:
+            self.queued_bytes += size
+        self._queue.put((spool_path, object_name, content_type, capture_time, size, dict(metadata or {}), session))
+
+    @property
+    def throughput(self):
+        """Bytes per second uploaded over the recent window, None before the first upload"""
+        with self._lock:
+            if not self._completions:
+                return None
+            start = min(c[0] for c in self._completions)
+            end = max(c[1] for c in self._completions)
+            return sum(c[2] for c in self._completions) / max(end - start, 1e-3)
+
+    def backlog_seconds(self):
+        """Estimated time to upload everything still queued at the current throughput"""
+        throughput = self.throughput
+        if not throughput:
+            return 0.0
+        return self.queued_bytes / throughput
+
+    def choose_level(self):
+        """Pick the first ladder rung whose backlog limit is not exceeded"""
+        backlog = self.backlog_seconds()
+        for level, rung in enumerate(self.ladder):
+            if backlog < rung['max_backlog']:
+                return level
+        return len(self.ladder) - 1
+
+    def _record_throughput(self, start, size):
+        end = time.time()
+        with self._lock:
+            self._completions.append((start, end, size))
+            while self._completions and self._completions[0][1] < end - self.window:
+                self._completions.popleft()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                return
+            with self._lock:
+                self.in_flight += 1
+            try:
+                self._upload_job(*job)
+            except Exception as e:
+                self._finish(job, job[0], None, e)
+            finally:
+                self._queue.task_done()
+
+    def _upload_job(self, spool_path, object_name, content_type, capture_time, size, metadata, session):
+        self.level = self.choose_level()
+        rung = self.ladder[self.level]
+        job = (spool_path, object_name, content_type, capture_time, size, metadata, session)
+
+        upload_path = spool_path
+        if rung['name'] != 'original' and content_type == "image/jpeg":
+            base, ext = os.path.splitext(spool_path)
+            upload_path = encode_variant(spool_path, f"{base}_{rung['name']}{ext}", rung)
+
+        start = time.time()
+        try:
+            result = self.upload_fn(upload_path, object_name, content_type)
+        except Exception as e:
+            self._finish(job, upload_path, rung['name'], e)
+            return
+        if isinstance(result, concurrent.futures.Future):
+            result.add_done_callback(lambda future: self._finisher.submit(
+                self._finish, job, upload_path, rung['name'], future.exception(), start,
+                None if future.exception() else future.result()))
+        else:
+            self._finish(job, upload_path, rung['name'], None if result else Exception("upload failed"), start, result)
+
+    def _finish(self, job, upload_path, variant, error, start=None, result=None):
+        spool_path, object_name, content_type, capture_time, size, metadata, session = job
+        try:
+            if error is None:
+                self._record_throughput(start, os.path.getsize(upload_path))
+                self.uploaded += 1
+                if self.on_uploaded:
+                    self.on_uploaded(object_name, upload_path, variant, capture_time, _upload_info(result),
+                                     dict(metadata))
+                if upload_path == spool_path:
+                    os.remove(spool_path)
+                else:
+                    # keep the original for backfill
+                    os.remove(upload_path)
+                    self.degraded += 1
+                    self._keep_for_backfill(job, variant)
+            else:
+                print(f"Error uploading {object_name}: {str(error)}")
+                self.failed += 1
+                if upload_path != spool_path and os.path.exists(upload_path):
+                    os.remove(upload_path)
+                self._keep_for_backfill(job, 'failed')
+        except Exception as e:
+            print(f"Error finishing upload of {object_name}: {str(e)}")
+        finally:
+            with self._lock:
+                self.queued_bytes -= size
+                self.in_flight -= 1
+                self._idle.notify_all()
+
+    def backfill_dir(self, session=None):
+        """Where the originals of a session wait for backfill()"""
+        return os.path.join(self.spool_dir, "backfill", session or "unscoped")
+
+    def _keep_for_backfill(self, job, variant):
+        spool_path, object_name, content_type, capture_time, size, metadata, session = job
+        backfill_dir = self.backfill_dir(session)
+        os.makedirs(backfill_dir, exist_ok=True)
+        backfill_path = os.path.join(backfill_dir, os.path.basename(spool_path))
+        shutil.move(spool_path, backfill_path)
+        with open(backfill_path + ".json", 'w') as f:
+            json.dump({'object_name': object_name, 'content_type': content_type,
+                       'capture_time': capture_time, 'variant': variant, 'metadata': metadata}, f)
+
+    def pending_backfill(self, session=None):
+        """Originals of a session in the spool whose full resolution version has not been uploaded"""
+        backfill_dir = self.backfill_dir(session)
+        if not os.path.isdir(backfill_dir):
+            return []
+        return sorted(os.path.join(backfill_dir, f) for f in os.listdir(backfill_dir)
+                      if not f.endswith(".json"))
+
+    def backfill_sessions(self):
+        """Sessions with originals waiting in the spool"""
+        backfill_root = os.path.join(self.spool_dir, "backfill")
+        if not os.path.isdir(backfill_root):
+            return []
+        return sorted(session for session in os.listdir(backfill_root) if self.pending_backfill(session))
+
+    def backfill(self, session=None, on_uploaded=None):
+        """Upload the full resolution originals of a session's degraded captures over their previews
+
+        Runs synchronously, meant for when the camera is idle or back on a
+        good link. on_uploaded (self.on_uploaded by default) gets variant
+        'original' and 'replaces' in the metadata, so the record of the earlier
+        upload can be superseded; pass one that writes to the manifest of the
+        session the originals belong to.
+        Returns the number of originals uploaded.
+        """
+        on_uploaded = on_uploaded or self.on_uploaded
+        count = 0
+        for original_path in self.pending_backfill(session):
+            try:
+                with open(original_path + ".json") as f:
+                    info = json.load(f)
+                result = self.upload_fn(original_path, info['object_name'], info['content_type'])
+                if isinstance(result, concurrent.futures.Future):
+                    result = result.result()
+                if not result:
+                    raise Exception("upload failed")
+                if on_uploaded:
+                    on_uploaded(info['object_name'], original_path, 'original', info['capture_time'],
+                                _upload_info(result), dict(info.get('metadata') or {}, replaces=info['variant']))
+                os.remove(original_path)
+                os.remove(original_path + ".json")
+                count += 1
+            except Exception as e:
+                print(f"Error backfilling {original_path}: {str(e)}")
+        return count
+
+    def drain(self):
+        """Block until everything submitted so far has been uploaded"""
+        self._queue.join()
+        with self._lock:
+            self._idle.wait_for(lambda: self.in_flight == 0)
+
+    def close(self):
+        """Drain the queue and stop the worker thread"""
+        self.drain()
+        self._queue.put(None)
+        self._worker.join()
+        self._finisher.shutdown()
+
+    def stats(self):
+        return {
+            'level': self.ladder[self.level]['name'],
+            'throughput': self.throughput,
+            'queue_depth': self._queue.qsize(),
+            'in_flight': self.in_flight,
+            'backlog_seconds': self.backlog_seconds(),
+            'uploaded': self.uploaded,
+            'degraded': self.degraded,
+            'failed': self.failed,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Upload the full resolution originals of degraded captures "
+                                                 "and record them in their session's manifest")
+    parser.add_argument('sessions', nargs='*', help="session ids, every session with originals waiting by default")
+    parser.add_argument('--storage-url', default=os.environ.get("TURFGRASS_STORAGE_URL", "gs://turfgrass"))
+    parser.add_argument('--spool-dir', default=SPOOL_DIR)
+    parser.add_argument('--list', action='store_true', help="only list the sessions and their waiting originals")
+    args = parser.parse_args()
+
+    import storage_backends
+    import capture_manifest
+
+    backend = storage_backends.open_backend(args.storage_url)
+
+    def upload(local_path, object_name, content_type):
+        return storage_backends.run(backend.put(local_path, object_name, content_type))
+
+    uploader = AdaptiveUploader(upload, spool_dir=args.spool_dir)
+    try:
+        for session in args.sessions or uploader.backfill_sessions():
+            pending = len(uploader.pending_backfill(session))
+            print(f"{session}: {pending} originals waiting")
+            if args.list or not pending:
+                continue
+            try:
+                manifest = capture_manifest.open_session(session, backend=backend)
+            except FileNotFoundError as e:
+                print(f"Skipping {session}: {str(e)}")
+                continue
+            count = uploader.backfill(session, on_uploaded=functools.partial(capture_manifest.record_upload, manifest))
+            print(f"Uploaded {count} of {pending} originals of {session}")
+            if count:
+                capture_manifest.upload_manifest(manifest, backend)
+    finally:
+        uploader.close()
+        backend.close()
+
+
+if __name__ == "__main__":
+    main()
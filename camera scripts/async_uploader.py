@@ -0,0 +1,110 @@
+import time
+import asyncio
+import threading
+import storage_backends
+
+# asyncio upload engine.
+#
+# submit() schedules the upload on the shared storage event loop and returns
+# right away, so the capture loop only pays for queueing a coroutine. The
+# backend's pooled keep-alive client and semaphore limit the requests on the
+# wire, while max_in_flight limits how many uploads may be waiting at once so
+# a stalled link slows the capture loop down instead of growing memory.
+#
+# on_uploaded(result) is run on a worker thread as part of the upload job, so
+# bookkeeping that touches the disk (e.g. the manifest entry) never blocks the
+# event loop, and the upload's future only completes once it has run.
+
+
+class AsyncUploader:
+    """Non-blocking uploader on top of a storage backend
+    Args:
+        backend: Storage backend from storage_backends.open_backend()
+        max_in_flight: Uploads allowed to be queued or running before submit() blocks
+        timeout: Seconds allowed for each upload attempt
+        retries: Extra attempts for uploads that fail or time out
+    """
+
+    def __init__(self, backend, max_in_flight=512, timeout=120, retries=2):
+        self.backend = backend
+        self.timeout = timeout
+        self.retries = retries
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._pending = set()
+
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.bytes_uploaded = 0
+        self.started = time.time()
+
+    async def _upload(self, source, object_name, content_type, cache_control, on_uploaded):
+        for attempt in range(self.retries + 1):
+            try:
+                result = await asyncio.wait_for(
+                    self.backend.put(source, object_name, content_type, cache_control), self.timeout)
+                break
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                print(f"Upload of {object_name} failed ({str(e) or type(e).__name__}), retrying...")
+                await asyncio.sleep(2 ** attempt)
+        if on_uploaded:
+            await asyncio.get_running_loop().run_in_executor(None, self._record, on_uploaded, object_name, result)
+        return result
+
+    def _record(self, on_uploaded, object_name, result):
+        try:
+            on_uploaded(result)
+        except Exception as e:
+            print(f"Error recording upload of {object_name}: {str(e)}")
+
+    def submit(self, source, object_name, content_type=None, cache_control=None, on_uploaded=None):
+        """Queue an upload and return a concurrent.futures.Future with the backend's result
+
+        on_uploaded(result) is called on a worker thread after a successful
+        upload, before the future completes. Only blocks when max_in_flight
+        uploads are already pending.
+        """
+        self._slots.acquire()
+        future = storage_backends.submit(self._upload(source, object_name, content_type, cache_control,
+                                                      on_uploaded))
+        with self._lock:
+            self.submitted += 1
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+            if future.cancelled() or future.exception() is not None:
+                self.failed += 1
+            else:
+                self.completed += 1
+                self.bytes_uploaded += (future.result() or {}).get('size') or 0
+            self._idle.notify_all()
+        self._slots.release()
+
+    def drain(self, timeout=None):
+        """Wait for every upload submitted so far, returns the futures that are still running
+
+        Returns once each upload's on_uploaded and bookkeeping have run, not
+        just its future, so the counters and any records are complete.
+        """
+        with self._idle:
+            self._idle.wait_for(lambda: not self._pending, timeout)
+            return set(self._pending)
+
+    def stats(self):
+        elapsed = time.time() - self.started
+        return {
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'failed': self.failed,
+            'in_flight': len(self._pending),
+            'bytes_uploaded': self.bytes_uploaded,
+            'throughput': self.bytes_uploaded / elapsed if elapsed > 0 else 0.0,
+        }
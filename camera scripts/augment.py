@@ -0,0 +1,314 @@
+import os
+import io
+import json
+import tarfile
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import cv2
+
+# Batch image augmentation on a process pool.
+#
+# A pipeline is a list of ops applied in order, each drawing its random
+# parameters from a generator seeded per image, so a run can be repeated
+# exactly and the parameters are recorded with every output:
+#
+#   rotate=30        rotate by up to +-30 degrees (180 for any angle), the canvas
+#                    grows to fit like PIL's rotate(expand=True)
+#   hflip=0.5        flip left-right with probability 0.5 (vflip: top-bottom)
+#   crop=0.7         random crop keeping 70-100% of each side
+#   jitter=0.2       brightness, contrast and saturation scaled by up to +-20%
+#   scale=0.8-1.2    resize by a random factor in the range
+#
+#   pipeline = Pipeline.from_spec("rotate=180,hflip=0.5,crop=0.8,jitter=0.2")
+#   outputs = augment_files(paths, pipeline, workers=8)     # decoded, augmented and encoded in parallel
+#   write_outputs(outputs)                                  # written once, at the end
+#
+# Work is spread over a process pool in chunks, so a session scales with the
+# number of cores. Files, in-memory frames and dataset_builder.py tar shards
+# can be augmented.
+
+
+class Rotate:
+    """Rotate by a random angle in [-max_angle, max_angle] degrees"""
+
+    def __init__(self, max_angle=180, expand=True):
+        self.max_angle = float(max_angle)
+        self.expand = expand
+
+    def __call__(self, image, rng):
+        angle = rng.uniform(-self.max_angle, self.max_angle)
+        h, w = image.shape[:2]
+        matrix = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1.0)
+        size = (w, h)
+        if self.expand:
+            cos, sin = abs(matrix[0, 0]), abs(matrix[0, 1])
+            size = (int(round(h * sin + w * cos)), int(round(h * cos + w * sin)))
+            matrix[0, 2] += size[0] / 2 - w / 2
+            matrix[1, 2] += size[1] / 2 - h / 2
+        return cv2.warpAffine(image, matrix, size, flags=cv2.INTER_LINEAR, borderValue=0), {'rotate': angle}
+
+
+class Flip:
+    """Flip left-right (or top-bottom) with a probability"""
+
+    def __init__(self, probability=0.5, vertical=False):
+        self.probability = float(probability)
+        self.vertical = vertical
+
+    def __call__(self, image, rng):
+        name = 'vflip' if self.vertical else 'hflip'
+        if rng.random() >= self.probability:
+            return image, {name: False}
+        return cv2.flip(image, 0 if self.vertical else 1), {name: True}
+
+
+class Crop:
+    """Random crop keeping between min_fraction and all of each side"""
+
+    def __init__(self, min_fraction=0.7):
+        self.min_fraction = float(min_fraction)
+
+    def __call__(self, image, rng):
+        h, w = image.shape[:2]
+        crop_w = max(1, int(w * rng.uniform(self.min_fraction, 1.0)))
+        crop_h = max(1, int(h * rng.uniform(self.min_fraction, 1.0)))
+        x = int(rng.integers(0, w - crop_w + 1))
+        y = int(rng.integers(0, h - crop_h + 1))
+        return image[y:y + crop_h, x:x + crop_w], {'crop': [x, y, crop_w, crop_h]}
+
+
+class ColorJitter:
+    """Scale brightness, contrast and saturation by random factors within 1 +- amount"""
+
+    def __init__(self, amount=0.2):
+        self.amount = float(amount)
+
+    def __call__(self, image, rng):
+        brightness, contrast, saturation = 1 + rng.uniform(-self.amount, self.amount, 3)
+        # one lookup table for brightness and contrast, around the image mean
+        mean = float(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY).mean())
+        table = np.clip((np.arange(256) - mean) * contrast + mean * brightness, 0, 255).astype(np.uint8)
+        image = cv2.LUT(image, table)
+        if saturation != 1:
+            gray = cv2.cvtColor(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), cv2.COLOR_GRAY2BGR)
+            image = cv2.addWeighted(image, saturation, gray, 1 - saturation, 0)
+        return image, {'brightness': brightness, 'contrast': contrast, 'saturation': saturation}
+
+
+class Scale:
+    """Resize by a random factor between low and high"""
+
+    def __init__(self, low=0.8, high=1.2):
+        self.low, self.high = float(low), float(high)
+
+    def __call__(self, image, rng):
+        factor = rng.uniform(self.low, self.high)
+        h, w = image.shape[:2]
+        size = (max(1, int(round(w * factor))), max(1, int(round(h * factor))))
+        interpolation = cv2.INTER_AREA if factor < 1 else cv2.INTER_LINEAR
+        return cv2.resize(image, size, interpolation=interpolation), {'scale': factor}
+
+
+def _scale(value):
+    low, _, high = value.partition('-')
+    return Scale(low, high or low)
+
+
+OPS = {
+    'rotate': lambda value: Rotate(value),
+    'hflip': lambda value: Flip(value),
+    'vflip': lambda value: Flip(value, vertical=True),
+    'crop': lambda value: Crop(value),
+    'jitter': lambda value: ColorJitter(value),
+    'scale': _scale,
+}
+DEFAULTS = {'rotate': '180', 'hflip': '0.5', 'vflip': '0.5', 'crop': '0.7', 'jitter': '0.2', 'scale': '0.8-1.2'}
+
+
+class Pipeline:
+    """Ops applied in order to a BGR image
+    Args:
+        ops: Callables op(image, rng) -> (image, params)
+        seed: Base seed, image i uses seed + i; a random base seed by default
+    """
+
+    def __init__(self, ops, seed=None):
+        self.ops = list(ops)
+        self.seed = int(np.random.SeedSequence().entropy % 2 ** 31) if seed is None else seed
+
+    @classmethod
+    def from_spec(cls, spec, seed=None):
+        """Build a pipeline from "name=value,..." (see the top of the file)"""
+        ops = []
+        for part in filter(None, (part.strip() for part in spec.split(','))):
+            name, _, value = part.partition('=')
+            if name not in OPS:
+                raise ValueError(f"Unknown augmentation {name}, choose from {', '.join(OPS)}")
+            ops.append(OPS[name](value or DEFAULTS[name]))
+        return cls(ops, seed)
+
+    def __call__(self, image, index=0):
+        rng = np.random.default_rng(self.seed + index)
+        applied = {}
+        for op in self.ops:
+            image, params = op(image, rng)
+            applied.update(params)
+        return image, applied
+
+
+def _augment_bytes(data, pipeline, index, quality):
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("could not decode image")
+    image, params = pipeline(image, index)
+    ok, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError("JPEG encoding failed")
+    return encoded.tobytes(), params
+
+
+def _augment_file(job):
+    """Worker: (path, output_path, index) -> (output_path, JPEG bytes, params) or (output_path, None, error)"""
+    path, output_path, index, pipeline, quality = job
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        encoded, params = _augment_bytes(data, pipeline, index, quality)
+        return output_path, encoded, params
+    except Exception as e:
+        return output_path, None, f"{path}: {str(e)}"
+
+
+def _augment_frame(job):
+    frame, index, pipeline = job
+    return pipeline(frame, index)
+
+
+def _pool(workers):
+    # spawn: the capture scripts run camera and storage threads, forking those is unsafe
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+def _chunksize(count, workers):
+    return max(1, count // ((workers or os.cpu_count() or 1) * 4))
+
+
+def augment_files(paths, pipeline, output_paths=None, workers=None, quality=90):
+    """Augment image files in parallel, results stay in memory until write_outputs()
+    Args:
+        paths: Image files
+        pipeline: Pipeline to apply, image i uses pipeline seed + i
+        output_paths: Where each result goes, over the originals by default
+        workers: Processes, one per CPU by default
+        quality: JPEG quality of the outputs
+    Returns:
+        List of (output_path, JPEG bytes, params), bytes is None and params the error for failed files
+    """
+    paths = list(paths)
+    output_paths = list(output_paths) if output_paths is not None else paths
+    jobs = [(path, output_path, i, pipeline, quality) for i, (path, output_path) in enumerate(zip(paths, output_paths))]
+    with _pool(workers) as pool:
+        return list(pool.map(_augment_file, jobs, chunksize=_chunksize(len(jobs), workers)))
+
+
+def augment_frames(frames, pipeline, workers=None):
+    """Augment in-memory BGR frames in parallel, returns a list of (frame, params)"""
+    frames = list(frames)
+    jobs = [(frame, i, pipeline) for i, frame in enumerate(frames)]
+    with _pool(workers) as pool:
+        return list(pool.map(_augment_frame, jobs, chunksize=_chunksize(len(jobs), workers)))
+
+
+def write_outputs(outputs):
+    """Write the results of augment_files, returns the number written"""
+    written = 0
+    for output_path, data, params in outputs:
+        if data is None:
+            print(f"Skipping augmentation of {params}")
+            continue
+        os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+        with open(output_path, 'wb') as f:
+            f.write(data)
+        written += 1
+    return written
+
+
+def _augment_sample(job):
+    key, data, metadata, index, pipeline, quality = job
+    try:
+        encoded, params = _augment_bytes(data, pipeline, index, quality)
+    except Exception as e:
+        return key, None, f"{key}: {str(e)}"
+    return key, encoded, dict(metadata, augment=params)
+
+
+def augment_shard(shard_path, output_path, pipeline, copies=1, workers=None, quality=90):
+    """Write a shard of augmented copies of the samples of a dataset_builder.py tar shard
+    Returns:
+        Number of samples written
+    """
+    samples = {}
+    with tarfile.open(shard_path) as tar:
+        for member in tar.getmembers():
+            key, extension = os.path.splitext(member.name)
+            samples.setdefault(key, {})[extension] = tar.extractfile(member).read()
+    keys = sorted(key for key, files in samples.items() if '.jpg' in files)
+    jobs = []
+    for copy in range(copies):
+        for i, key in enumerate(keys):
+            metadata = json.loads(samples[key].get('.json', b'{}'))
+            jobs.append((f"{key}_aug{copy}", samples[key]['.jpg'], metadata, copy * len(keys) + i, pipeline, quality))
+    with _pool(workers) as pool:
+        results = list(pool.map(_augment_sample, jobs, chunksize=_chunksize(len(jobs), workers)))
+
+    written = 0
+    with tarfile.open(output_path + ".partial", 'w') as tar:
+        for key, data, metadata in results:
+            if data is None:
+                print(f"Skipping augmentation of {metadata}")
+                continue
+            for name, payload in [(key + ".jpg", data), (key + ".json", json.dumps(metadata).encode('utf-8'))]:
+                info = tarfile.TarInfo(name)
+                info.size = len(payload)
+                tar.addfile(info, io.BytesIO(payload))
+            written += 1
+    os.replace(output_path + ".partial", output_path)
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Augment images or dataset shards on all cores")
+    parser.add_argument('inputs', nargs='+', help="image files, directories of images, or .tar shards")
+    parser.add_argument('--ops', default="rotate=180,hflip=0.5,crop=0.8,jitter=0.2",
+                        help="augmentation pipeline, e.g. rotate=30,hflip=0.5,vflip=0.5,crop=0.7,jitter=0.2,scale=0.8-1.2")
+    parser.add_argument('--output', default="augmented", help="output directory")
+    parser.add_argument('--copies', type=int, default=1, help="augmented copies per shard sample")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--quality', type=int, default=90)
+    args = parser.parse_args()
+
+    pipeline = Pipeline.from_spec(args.ops, args.seed)
+    print(f"Augmenting with {args.ops}, seed {pipeline.seed}")
+    os.makedirs(args.output, exist_ok=True)
+    images = []
+    for source in args.inputs:
+        if source.endswith('.tar'):
+            output_path = os.path.join(args.output, os.path.basename(source))
+            count = augment_shard(source, output_path, pipeline, args.copies, args.workers, args.quality)
+            print(f"Wrote {count} samples to {output_path}")
+        elif os.path.isdir(source):
+            images.extend(os.path.join(source, name) for name in sorted(os.listdir(source))
+                          if name.lower().endswith(('.jpg', '.jpeg', '.png')))
+        else:
+            images.append(source)
+    if images:
+        outputs = augment_files(images, pipeline, [os.path.join(args.output, os.path.splitext(os.path.basename(path))[0] + ".jpg")
+                                                   for path in images], args.workers, args.quality)
+        print(f"Wrote {write_outputs(outputs)} of {len(images)} images to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+import os
+import io
+import json
+import gzip
+import base64
+import datetime
+import threading
+import google_crc32c # type: ignore
+import storage_backends
+
+# Per-session capture manifest.
+#
+# Each capture session appends one JSON line per uploaded object to a local
+# manifest file, and the manifest is uploaded next to the data when the session
+# ends. Processing jobs read the manifest for a session instead of listing the
+# whole bucket.
+
+MANIFEST_DIR = "manifests"      # local directory the manifests are written to
+MANIFEST_FOLDER = "manifests"   # folder in the bucket the manifests are uploaded to
+COLUMNS = ['object_name', 'size', 'crc32c', 'capture_time', 'settings']
+
+_write_lock = threading.Lock()  # entries are appended from the upload threads
+
+
+def new_session(session_type, settings=None, manifest_dir=MANIFEST_DIR):
+    """Start a new capture session and return its manifest
+    Args:
+        session_type: Name of the script producing the session ("photo", "rapid")
+        settings: Camera settings at the start of the session
+        manifest_dir: Local directory to write the manifest in
+    Returns:
+        dict describing the session, passed to the other manifest functions
+    """
+    os.makedirs(manifest_dir, exist_ok=True)
+    session_id = datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+    return {
+        'session_id': session_id,
+        'session_type': session_type,
+        'settings': dict(settings or {}),
+        'path': os.path.join(manifest_dir, f"session_{session_id}.jsonl"),
+        'count': 0,
+    }
+
+
+def open_session(session_id, session_type=None, backend=None, manifest_dir=MANIFEST_DIR):
+    """Reopen the manifest of an earlier session, to append entries to it (e.g. backfilled originals)
+
+    The local manifest is used when it is still there, otherwise the uploaded
+    one is downloaded from backend. The session type comes from the columnar
+    copy when there is one.
+    Raises:
+        FileNotFoundError when the manifest is neither local nor in the bucket
+    """
+    os.makedirs(manifest_dir, exist_ok=True)
+    path = os.path.join(manifest_dir, f"session_{session_id}.jsonl")
+    columnar_path = os.path.splitext(path)[0] + ".columns.json.gz"
+    if backend is not None:
+        for local_path in [path, columnar_path]:
+            if not os.path.exists(local_path):
+                try:
+                    storage_backends.run(backend.get(f"{MANIFEST_FOLDER}/{os.path.basename(local_path)}", local_path))
+                except Exception:
+                    pass
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No manifest for session {session_id}")
+
+    if os.path.exists(columnar_path):
+        with gzip.open(columnar_path, 'rt') as f:
+            session_type = json.load(f).get('session_type') or session_type
+    entries = read_entries(path)
+    return {
+        'session_id': session_id,
+        'session_type': session_type or "unknown",
+        'settings': dict(entries[0].get('settings') or {}) if entries else {},
+        'path': path,
+        'count': len(entries),
+    }
+
+
+def file_crc32c(file_path, chunk_size=1024 * 1024):
+    """Compute the crc32c of a file, base64 encoded the same way GCS reports it"""
+    checksum = google_crc32c.Checksum()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            checksum.update(chunk)
+    return base64.b64encode(checksum.digest()).decode('ascii')
+
+
+def append_entry(manifest, object_name, local_path=None, capture_time=None, settings=None, crc32c=None,
+                 size=None, **extra):
+    """Append one uploaded object to the session manifest
+
+    Pass the size and crc32c the upload reported, only when they are missing
+    are they read from local_path (which must then still exist). Lines are
+    flushed as they are written so an interrupted session still leaves a
+    usable manifest. Safe to call from several threads, but it does disk I/O:
+    don't call it on the storage event loop.
+    """
+    if capture_time is None:
+        capture_time = datetime.datetime.now()
+    if isinstance(capture_time, datetime.datetime):
+        capture_time = capture_time.isoformat()
+
+    entry = {
+        'object_name': object_name,
+        'size': size if size is not None else os.path.getsize(local_path),
+        'crc32c': crc32c or file_crc32c(local_path),
+        'capture_time': capture_time,
+        'settings': dict(settings if settings is not None else manifest['settings']),
+    }
+    entry.update(extra)
+
+    with _write_lock:
+        with open(manifest['path'], 'a') as f:
+            f.write(json.dumps(entry) + "\n")
+        manifest['count'] += 1
+    return entry
+
+
+def record_upload(manifest, object_name, local_path, variant, capture_time, upload, metadata):
+    """Append an AdaptiveUploader upload to a manifest, takes the arguments of its on_uploaded callback
+
+    Bind the manifest with functools.partial to get an on_uploaded callback for one session.
+    """
+    return append_entry(manifest, object_name, local_path, capture_time, crc32c=upload.get('crc32c'),
+                        size=upload.get('size'), variant=variant, **metadata)
+
+
+def read_entries(manifest_file):
+    """Read manifest entries from a local path or an open text file"""
+    if isinstance(manifest_file, str):
+        with open(manifest_file) as f:
+            return read_entries(f)
+    return [json.loads(line) for line in manifest_file if line.strip()]
+
+
+def latest_entries(entries):
+    """One entry per object, the last one written
+
+    A backfilled original is appended as a new entry with 'replaces' set,
+    it supersedes the entry of the degraded upload of the same object.
+    """
+    latest = {}
+    for entry in entries:
+        latest[entry['object_name']] = entry
+    return list(latest.values())
+
+
+def to_columns(entries):
+    """Convert manifest entries to a compact columnar dict
+
+    Settings are dictionary encoded, since they rarely change within a session
+    each row only stores an index into 'settings_values'.
+    """
+    columns = {name: [] for name in COLUMNS}
+    extra_names = sorted({key for entry in entries for key in entry} - set(COLUMNS))
+    for name in extra_names:
+        columns[name] = []
+    settings_values = []
+    settings_index = {}
+
+    for entry in entries:
+        for name in columns:
+            if name != 'settings':
+                columns[name].append(entry.get(name))
+        key = json.dumps(entry.get('settings', {}), sort_keys=True)
+        if key not in settings_index:
+            settings_index[key] = len(settings_values)
+            settings_values.append(entry.get('settings', {}))
+        columns['settings'].append(settings_index[key])
+
+    return {'num_rows': len(entries), 'columns': columns, 'settings_values': settings_values}
+
+
+def from_columns(table):
+    """Inverse of to_columns, returns the list of manifest entries"""
+    columns = table['columns']
+    entries = []
+    for i in range(table['num_rows']):
+        entry = {name: values[i] for name, values in columns.items()
+                 if name != 'settings' and (name in COLUMNS or values[i] is not None)}
+        entry['settings'] = table['settings_values'][columns['settings'][i]]
+        entries.append(entry)
+    return entries
+
+
+def write_columnar(manifest):
+    """Write the gzipped columnar copy of the manifest next to the JSONL file"""
+    columnar_path = os.path.splitext(manifest['path'])[0] + ".columns.json.gz"
+    entries = read_entries(manifest['path']) if os.path.exists(manifest['path']) else []
+    table = to_columns(entries)
+    table['session_id'] = manifest['session_id']
+    table['session_type'] = manifest['session_type']
+    with gzip.open(columnar_path, 'wt') as f:
+        json.dump(table, f, separators=(',', ':'))
+    return columnar_path
+
+
+def upload_manifest(manifest, backend):
+    """Upload the JSONL manifest and its columnar copy to the bucket
+    Args:
+        manifest: Session manifest from new_session()
+        backend: Storage backend the session's data was uploaded to
+    Returns:
+        Name of the uploaded JSONL manifest object, or None on failure
+    """
+    try:
+        if not os.path.exists(manifest['path']):
+            print("No objects recorded for this session, skipping manifest upload")
+            return None
+
+        columnar_path = write_columnar(manifest)
+        manifest_name = f"{MANIFEST_FOLDER}/{os.path.basename(manifest['path'])}"
+        columnar_name = f"{MANIFEST_FOLDER}/{os.path.basename(columnar_path)}"
+        storage_backends.run(backend.put_many([(manifest['path'], manifest_name),
+                                               (columnar_path, columnar_name)]))
+
+        print(f"Uploaded manifest with {manifest['count']} objects to {manifest_name}")
+        return manifest_name
+    except Exception as e:
+        print(f"Error uploading manifest: {str(e)}")
+        return None
+
+
+def list_sessions(backend):
+    """List the session ids that have an uploaded manifest
+
+    Only the small manifests folder is listed, never the data itself.
+    """
+    prefix = f"{MANIFEST_FOLDER}/session_"
+    names = storage_backends.run(backend.list(prefix))
+    return sorted(name[len(prefix):-len(".jsonl")] for name in names if name.endswith(".jsonl"))
+
+
+def load_manifest(backend, session_id):
+    """Download a session's manifest and return its entries
+
+    Prefers the columnar copy and falls back to the JSONL file for sessions
+    that were interrupted before it was written. Objects uploaded more than
+    once (backfilled originals) appear once, as their latest entry.
+    """
+    try:
+        data = storage_backends.run(backend.get(f"{MANIFEST_FOLDER}/session_{session_id}.columns.json.gz"))
+        with gzip.open(io.BytesIO(data), 'rt') as f:
+            return latest_entries(from_columns(json.load(f)))
+    except Exception:
+        pass
+
+    data = storage_backends.run(backend.get(f"{MANIFEST_FOLDER}/session_{session_id}.jsonl"))
+    return latest_entries(read_entries(io.StringIO(data.decode('utf-8'))))
@@ -0,0 +1,313 @@
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import tarfile
+import argparse
+import tempfile
+import collections
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+import cv2
+import storage_backends
+
+# the reduced-resolution JPEG decode is shared with the segmentation pipeline
+PIPELINES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Pipelines")
+if PIPELINES not in sys.path:
+    sys.path.append(PIPELINES)
+import image_loading
+
+# Build training shards from the turfgrass bucket.
+#
+# Photos land in the bucket as image_<timestamp>.jpg and rapid captures as
+# a6700_frames/video_*.mp4. This streams every object that hasn't been built
+# yet through the steps below and writes the results as tar shards of a fixed
+# number of samples (<key>.jpg + <key>.json per sample, the WebDataset layout):
+#
+#   download    storage_backends, several objects in flight
+#   decode      photos are decoded at reduced JPEG resolution (image_loading.py in
+#               Pipelines) and resized, videos sampled every
+#               --video-interval seconds, in a process pool
+#   dedupe      a 64 bit difference hash (dHash) per sample, samples within
+#               --dedupe-distance bits of a kept one are dropped
+#   shard       re-encoded JPEGs appended to shard-000000.tar, ...
+#
+# The resized samples are stored JPEG compressed, so the tar itself is left
+# uncompressed: gzip gains nothing on JPEG data and an uncompressed tar can be
+# appended to, which keeps shards at a fixed size across incremental runs.
+#
+# state.json in the output directory lists the objects already built and
+# hashes.npy the hashes of the kept samples, so running the builder again only
+# processes new objects. index.json lists the shards and samples.jsonl has a
+# line per sample with its shard, source object and frame.
+#
+#   python dataset_builder.py --storage-url gs://turfgrass --output dataset
+#   python dataset_builder.py --storage-url file:///data/turfgrass_copy --output dataset --max-side 768
+
+IMAGE_PREFIX = "image_"
+VIDEO_PREFIX = "a6700_frames/video_"
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov')
+
+
+def dhash(image):
+    """64 bit difference hash of an RGB image: signs of the horizontal gradients of a 9x8 thumbnail"""
+    gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def resize(image, max_side):
+    h, w = image.shape[:2]
+    scale = max_side / max(h, w) if max_side else 1.0
+    if scale >= 1.0:
+        return image
+    return cv2.resize(image, (round(w * scale), round(h * scale)), interpolation=cv2.INTER_AREA)
+
+
+def make_sample(image, frame, max_side, quality):
+    """(frame, JPEG bytes, dhash, width, height) of a decoded RGB image"""
+    image = resize(image, max_side)
+    ok, encoded = cv2.imencode('.jpg', cv2.cvtColor(image, cv2.COLOR_RGB2BGR), [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError("JPEG encoding failed")
+    return frame, encoded.tobytes(), dhash(image), image.shape[1], image.shape[0]
+
+
+def decode_photo(data, max_side, quality):
+    """Samples of a photo given its file bytes, a JPEG is decoded at the smallest DCT reduction covering max_side"""
+    return [make_sample(image_loading.load_rgb(data, max_side), None, max_side, quality)]
+
+
+def sample_video(path, interval, max_side, quality):
+    """Samples of a video file, one frame every interval seconds
+
+    Skipped frames are only grabbed, not decoded.
+    """
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError("could not open video")
+    fps = capture.get(cv2.CAP_PROP_FPS) or 30
+    step = max(1, round(fps * interval))
+    samples = []
+    frame = 0
+    try:
+        while capture.grab():
+            if frame % step == 0:
+                ok, image = capture.retrieve()
+                if ok:
+                    samples.append(make_sample(cv2.cvtColor(image, cv2.COLOR_BGR2RGB), frame, max_side, quality))
+            frame += 1
+    finally:
+        capture.release()
+    return samples
+
+
+def sample_key(object_name, frame):
+    key = os.path.splitext(object_name)[0].replace('/', '__')
+    return key if frame is None else f"{key}_{frame:06d}"
+
+
+class ShardWriter:
+    """Appends samples to fixed-size tar shards and keeps the index and the build state
+    Args:
+        output_dir: Directory of the shards, index and state
+        shard_size: Samples per shard
+    """
+
+    def __init__(self, output_dir, shard_size=1000):
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+        os.makedirs(output_dir, exist_ok=True)
+        self.state_path = os.path.join(output_dir, "state.json")
+        self.index_path = os.path.join(output_dir, "index.json")
+        self.samples_path = os.path.join(output_dir, "samples.jsonl")
+        self.hashes_path = os.path.join(output_dir, "hashes.npy")
+
+        self.processed = set()
+        self.index = {'shard_size': shard_size, 'shards': []}
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                self.processed = set(json.load(f)['processed'])
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        self.hashes = np.load(self.hashes_path) if os.path.exists(self.hashes_path) else np.zeros(0, np.uint64)
+        self.count = len(self.hashes)
+
+        self.tar = None
+        self.lines = []         # samples.jsonl lines of the open shard
+        self.finished = []      # objects whose samples are all added
+        self.added = 0
+        self.duplicates = 0
+
+    def is_duplicate(self, value, distance):
+        if self.count == 0 or distance < 0:
+            return False
+        differing = np.bitwise_count(self.hashes[:self.count] ^ np.uint64(value))
+        return bool(differing.min() <= distance)
+
+    def _open(self):
+        shards = self.index['shards']
+        if shards and shards[-1]['samples'] < self.shard_size:
+            # fill up the last shard of the previous run, on a copy so a crash leaves it intact
+            self.shard = shards.pop()
+            shutil.copyfile(self._path(self.shard), self._path(self.shard) + ".partial")
+            self.tar = tarfile.open(self._path(self.shard) + ".partial", 'a')
+        else:
+            self.shard = {'name': f"shard-{len(shards):06d}.tar", 'samples': 0}
+            self.tar = tarfile.open(self._path(self.shard) + ".partial", 'w')
+
+    def _path(self, shard):
+        return os.path.join(self.output_dir, shard['name'])
+
+    def add(self, key, data, value, metadata):
+        """Append a sample with its JPEG bytes, dHash and metadata to the open shard"""
+        if self.tar is None:
+            self._open()
+        for name, payload in [(key + ".jpg", data), (key + ".json", json.dumps(metadata).encode('utf-8'))]:
+            info = tarfile.TarInfo(name)
+            info.size = len(payload)
+            info.mtime = int(time.time())
+            self.tar.addfile(info, io.BytesIO(payload))
+        self.shard['samples'] += 1
+        if self.count == len(self.hashes):
+            self.hashes = np.concatenate([self.hashes, np.zeros(max(1024, self.count), np.uint64)])
+        self.hashes[self.count] = value
+        self.count += 1
+        self.lines.append(json.dumps(dict(metadata, key=key, shard=self.shard['name'])))
+        self.added += 1
+        if self.shard['samples'] >= self.shard_size:
+            self.commit()
+
+    def finish_object(self, object_name):
+        self.finished.append(object_name)
+
+    def commit(self):
+        """Close the open shard and record it, its samples and the finished objects"""
+        if self.tar is not None:
+            self.tar.close()
+            self.tar = None
+            os.replace(self._path(self.shard) + ".partial", self._path(self.shard))
+            self.shard['bytes'] = os.path.getsize(self._path(self.shard))
+            self.index['shards'].append(self.shard)
+            with open(self.samples_path, 'a') as f:
+                f.writelines(line + "\n" for line in self.lines)
+            self.lines = []
+        self.processed.update(self.finished)
+        self.finished = []
+        self.index['samples'] = sum(shard['samples'] for shard in self.index['shards'])
+        self._write_json(self.index_path, self.index)
+        np.save(self.hashes_path + ".partial.npy", self.hashes[:self.count])
+        os.replace(self.hashes_path + ".partial.npy", self.hashes_path)
+        self._write_json(self.state_path, {'processed': sorted(self.processed)})
+
+    def _write_json(self, path, value):
+        with open(path + ".partial", 'w') as f:
+            json.dump(value, f, indent=1)
+        os.replace(path + ".partial", path)
+
+
+def list_new_objects(backend, processed):
+    """Photos and videos in the bucket that aren't in the dataset yet, oldest name first"""
+    names = storage_backends.run(backend.list(IMAGE_PREFIX)) + storage_backends.run(backend.list(VIDEO_PREFIX))
+    return [name for name in sorted(names)
+            if name not in processed and name.lower().endswith(IMAGE_EXTENSIONS + VIDEO_EXTENSIONS)]
+
+
+def build(backend, output_dir, shard_size=1000, max_side=1024, quality=90, video_interval=1.0,
+          dedupe_distance=4, workers=None, in_flight=8, limit=None):
+    """Build or extend the dataset with the objects of the bucket not processed yet
+    Returns:
+        The ShardWriter, with added and duplicates counts for this run
+    """
+    writer = ShardWriter(output_dir, shard_size)
+    names = list_new_objects(backend, writer.processed)[:limit]
+    print(f"{len(names)} new objects, {len(writer.processed)} already in {output_dir}")
+    if not names:
+        return writer
+
+    tmp_dir = tempfile.mkdtemp(prefix="dataset_builder_")
+    # spawn, the storage event loop thread is already running and forking with threads is unsafe
+    processes = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def process(name):
+        # runs on a thread: download, then decode on the process pool
+        if name.lower().endswith(VIDEO_EXTENSIONS):
+            path = os.path.join(tmp_dir, name.replace('/', '__'))
+            storage_backends.run(backend.get(name, path))
+            try:
+                return processes.submit(sample_video, path, video_interval, max_side, quality).result()
+            finally:
+                os.remove(path)
+        data = storage_backends.run(backend.get(name))
+        return processes.submit(decode_photo, data, max_side, quality).result()
+
+    start = time.time()
+    failed = 0
+    # results are taken in listing order so the shards come out the same on every run
+    with ThreadPoolExecutor(max_workers=in_flight) as threads:
+        pending = collections.deque()
+        for name in names:
+            pending.append((name, threads.submit(process, name)))
+            if len(pending) < in_flight:
+                continue
+            failed += _drain(writer, *pending.popleft(), dedupe_distance)
+        while pending:
+            failed += _drain(writer, *pending.popleft(), dedupe_distance)
+    writer.commit()
+    processes.shutdown()
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    elapsed = time.time() - start
+    print(f"Added {writer.added} samples from {len(names) - failed} objects in {elapsed:.1f} seconds, "
+          f"dropped {writer.duplicates} near-duplicates, {failed} objects failed")
+    return writer
+
+
+def _drain(writer, name, future, dedupe_distance):
+    """Add the samples of one object, returns 1 if it failed"""
+    try:
+        samples = future.result()
+    except Exception as e:
+        print(f"Error processing {name}: {str(e)}")
+        return 1
+    for frame, data, value, width, height in samples:
+        if writer.is_duplicate(value, dedupe_distance):
+            writer.duplicates += 1
+            continue
+        writer.add(sample_key(name, frame), data, value, {'source': name, 'frame': frame, 'width': width,
+                                                   'height': height, 'dhash': f"{value:016x}"})
+    writer.finish_object(name)
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build training shards from the photos and videos in the bucket")
+    parser.add_argument('--storage-url', default=os.environ.get("TURFGRASS_STORAGE_URL", "gs://turfgrass"))
+    parser.add_argument('--output', default="dataset")
+    parser.add_argument('--shard-size', type=int, default=1000, help="samples per shard")
+    parser.add_argument('--max-side', type=int, default=1024, help="long side of the stored images, 0 keeps the size")
+    parser.add_argument('--quality', type=int, default=90, help="JPEG quality of the stored images")
+    parser.add_argument('--video-interval', type=float, default=1.0, help="seconds between sampled video frames")
+    parser.add_argument('--dedupe-distance', type=int, default=4,
+                        help="dHash bits within which a sample is a duplicate, -1 keeps everything")
+    parser.add_argument('--workers', type=int, default=None, help="decode processes, one per CPU by default")
+    parser.add_argument('--in-flight', type=int, default=8, help="objects downloaded and decoded at once")
+    parser.add_argument('--limit', type=int, default=None, help="process at most this many new objects")
+    args = parser.parse_args()
+
+    backend = storage_backends.open_backend(args.storage_url)
+    try:
+        build(backend, args.output, args.shard_size, args.max_side, args.quality, args.video_interval,
+              args.dedupe_distance, args.workers, args.in_flight, args.limit)
+    finally:
+        backend.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+import os
+import json
+import argparse
+import tempfile
+import numpy as np
+import cv2
+
+# Keyframe selection for RAPID sessions.
+#
+# A 60 second RAPID capture is 1800 frames that mostly show the same ground.
+# Consecutive frames are compared on small gray copies: phase correlation
+# gives the camera's shift between them, and the shifts are added up since
+# the last keyframe. Once the part of the view that wasn't in the last
+# keyframe crosses min_new_ground, the frame becomes a keyframe. A frame also
+# becomes one when the scene changed in a way a shift doesn't explain (the
+# aligned frames still differ by more than max_change, or the correlation is
+# too weak to trust).
+#
+#   selector = KeyframeSelector(min_new_ground=0.4)
+#   for name in frame_names:
+#       if selector.add(name, os.path.join("temp_frames", name)):
+#           ...                                 # a keyframe
+#   selector.keyframes                          # [{'frame': ..., 'index': ..., 'new_ground': ..., 'reason': ...}]
+#
+#   python keyframes.py video_20240514.mp4 --export keyframes/     # keyframes of a video, as JPEGs for segmentation
+
+SIDE = 320              # long side the frames are compared at
+MIN_RESPONSE = 0.05     # phase correlation peaks below this are too weak to trust
+
+
+def small_gray(source, side=SIDE):
+    """Float32 gray copy with a long side of side, from a path, encoded bytes or a BGR array"""
+    if isinstance(source, np.ndarray):
+        gray = cv2.cvtColor(source, cv2.COLOR_BGR2GRAY) if source.ndim == 3 else source
+    elif isinstance(source, (bytes, bytearray, memoryview)):
+        gray = cv2.imdecode(np.frombuffer(source, np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_2)
+    else:
+        gray = cv2.imread(source, cv2.IMREAD_REDUCED_GRAYSCALE_2)
+    if gray is None:
+        raise ValueError("could not decode frame")
+    h, w = gray.shape
+    scale = side / max(h, w)
+    size = (max(1, round(w * scale)), max(1, round(h * scale)))
+    return cv2.resize(gray, size, interpolation=cv2.INTER_AREA).astype(np.float32)
+
+
+class KeyframeSelector:
+    """Picks keyframes from a stream of frames
+    Args:
+        min_new_ground: Fraction of the view not seen in the last keyframe that makes a new keyframe
+        max_change: Mean absolute difference (0-1) of the aligned frames that counts as a scene change
+        max_gap: Frames after which a keyframe is taken anyway, never by default
+        side: Long side the frames are compared at
+    """
+
+    def __init__(self, min_new_ground=0.4, max_change=0.15, max_gap=None, side=SIDE):
+        self.min_new_ground = min_new_ground
+        self.max_change = max_change
+        self.max_gap = max_gap
+        self.side = side
+        self.keyframes = []
+        self.frames = 0
+        self._previous = None
+        self._windowed = None
+        self._keyframe = None
+        self._window = None
+        self._shift = np.zeros(2)
+        self._since_keyframe = 0
+
+    def _change(self, gray):
+        """Mean absolute difference between gray and the last keyframe over the part they share"""
+        h, w = gray.shape
+        dx, dy = int(round(self._shift[0])), int(round(self._shift[1]))
+        if abs(dx) >= w or abs(dy) >= h:
+            return 1.0
+        # the keyframe pixel (x, y) shows up at (x + dx, y + dy) in this frame
+        keyframe = self._keyframe[max(0, -dy):h - max(0, dy), max(0, -dx):w - max(0, dx)]
+        current = gray[max(0, dy):h - max(0, -dy), max(0, dx):w - max(0, -dx)]
+        return float(np.mean(np.abs(current - keyframe))) / 255
+
+    def _take(self, frame_id, reason, new_ground):
+        self.keyframes.append({'frame': frame_id, 'index': self.frames, 'new_ground': round(float(new_ground), 3),
+                               'reason': reason})
+        self._keyframe = self._previous
+        self._shift = np.zeros(2)
+        self._since_keyframe = 0
+
+    def add(self, frame_id, source):
+        """Score the next frame (path, bytes or BGR array), returns True if it is a keyframe"""
+        gray = small_gray(source, self.side)
+        is_keyframe = False
+        if self._previous is None or self._previous.shape != gray.shape:
+            self._previous = gray
+            self._window = cv2.createHanningWindow(gray.shape[::-1], cv2.CV_32F)
+            self._windowed = gray * self._window
+            self._take(frame_id, 'first', 1.0)
+            is_keyframe = True
+        else:
+            # windowed copies: some OpenCV builds apply the window to phaseCorrelate's inputs in place,
+            # which would corrupt the frames _change() compares
+            windowed = gray * self._window
+            (dx, dy), response = cv2.phaseCorrelate(self._windowed, windowed)
+            self._previous = gray
+            self._windowed = windowed
+            self._shift += (dx, dy)
+            self._since_keyframe += 1
+            h, w = gray.shape
+            overlap = max(0.0, w - abs(self._shift[0])) * max(0.0, h - abs(self._shift[1])) / (w * h)
+            new_ground = 1 - overlap
+            reason = None
+            if response < MIN_RESPONSE:
+                reason = 'lost_track'
+            elif new_ground >= self.min_new_ground:
+                reason = 'new_ground'
+            elif self._change(gray) > self.max_change:
+                reason = 'scene_change'
+            elif self.max_gap and self._since_keyframe >= self.max_gap:
+                reason = 'max_gap'
+            if reason:
+                self._take(frame_id, reason, new_ground)
+                is_keyframe = True
+        self.frames += 1
+        return is_keyframe
+
+
+def select_from_video(video_path, selector=None, export_dir=None):
+    """Keyframes of a video file, optionally written to export_dir as <video>_<frame>.jpg
+    Returns:
+        The keyframe list, 'frame' is the frame number in the video
+    """
+    selector = selector or KeyframeSelector()
+    capture = cv2.VideoCapture(video_path)
+    if not capture.isOpened():
+        raise ValueError(f"Could not open {video_path}")
+    fps = capture.get(cv2.CAP_PROP_FPS) or 30
+    if export_dir:
+        os.makedirs(export_dir, exist_ok=True)
+    name = os.path.splitext(os.path.basename(video_path))[0]
+    frame = 0
+    try:
+        while True:
+            ok, image = capture.read()
+            if not ok:
+                break
+            if selector.add(frame, image):
+                selector.keyframes[-1]['time'] = round(frame / fps, 3)
+                if export_dir:
+                    cv2.imwrite(os.path.join(export_dir, f"{name}_{frame:06d}.jpg"), image)
+            frame += 1
+    finally:
+        capture.release()
+    return selector.keyframes
+
+
+def select_from_directory(frame_dir, selector=None):
+    """Keyframes of the frame_<timestamp>.jpg files RAPID_A6700.py writes, in capture order"""
+    selector = selector or KeyframeSelector()
+    names = [name for name in os.listdir(frame_dir) if name.lower().endswith(('.jpg', '.jpeg'))]
+    for name in sorted(names, key=frame_time):
+        selector.add(name, os.path.join(frame_dir, name))
+    return selector.keyframes
+
+
+def frame_time(name):
+    """Capture timestamp in a frame_<timestamp>.jpg name, frames sort by it"""
+    try:
+        return float(os.path.splitext(name)[0].split('_', 1)[1])
+    except (IndexError, ValueError):
+        return float('inf')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Select keyframes from RAPID videos or frame directories")
+    parser.add_argument('inputs', nargs='+',
+                        help="video files, frame directories, or a6700_frames/video_*.mp4 objects with --storage-url")
+    parser.add_argument('--storage-url', default=None, help="read the videos from this bucket")
+    parser.add_argument('--min-new-ground', type=float, default=0.4)
+    parser.add_argument('--max-change', type=float, default=0.15)
+    parser.add_argument('--max-gap', type=int, default=None)
+    parser.add_argument('--export', default=None, help="write the keyframes of videos as JPEGs here")
+    parser.add_argument('--output', default=None, help="JSON file for the keyframe lists, printed by default")
+    args = parser.parse_args()
+
+    results = {}
+    backend = None
+    if args.storage_url:
+        import storage_backends
+        backend = storage_backends.open_backend(args.storage_url)
+    try:
+        for source in args.inputs:
+            selector = KeyframeSelector(args.min_new_ground, args.max_change, args.max_gap)
+            if os.path.isdir(source):
+                results[source] = select_from_directory(source, selector)
+            elif backend is not None:
+                with tempfile.TemporaryDirectory() as tmp_dir:
+                    local_path = os.path.join(tmp_dir, os.path.basename(source))
+                    storage_backends.run(backend.get(source, local_path))
+                    results[source] = select_from_video(local_path, selector, args.export)
+            else:
+                results[source] = select_from_video(source, selector, args.export)
+            print(f"{source}: {len(results[source])} keyframes of {selector.frames} frames")
+    finally:
+        if backend is not None:
+            backend.close()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    else:
+        print(json.dumps(results, indent=1))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import io
+import os
+import json
+import argparse
+import numpy as np
+import cv2
+from PIL import Image
+
+# Frame quality gate.
+#
+# Scores a frame on a small copy (long side SIDE, decoded at reduced size
+# when the frame is a JPEG) so it costs a few milliseconds:
+#   sharpness     variance of the Laplacian of the gray image, low for blurred or out of focus frames
+#   dark/bright   fraction of gray pixels clipped at either end of the histogram
+#   vegetation    fraction of pixels with excess green (2g - r - b on chromatic coordinates) above VEGETATION_EXG
+#
+# Each check that fails names a problem (blurry, underexposed, overexposed,
+# low_vegetation). Problems listed in drop discard the frame before it is
+# uploaded or segmented, the others only tag it, e.g. in the manifest entry.
+#
+#   gate = QualityGate(min_sharpness=60, drop=('blurry', 'overexposed'))
+#   verdict = gate.check_file("capture.jpg")   # {'decision': 'drop', 'problems': ['blurry'], 'scores': {...}}
+#
+# The thresholds depend on the camera, lens and scene. Run
+#   python quality_gate.py some_frames/
+# on frames you know are good and bad to see their scores before changing them.
+
+SIDE = 512
+VEGETATION_EXG = 0.05
+DARK_LEVEL = 8        # gray levels at or below this count as clipped shadows
+BRIGHT_LEVEL = 247    # and at or above this as clipped highlights
+
+
+def _thumbnail_from_source(source, side):
+    """RGB array with a long side of at most side, using PIL's reduced JPEG decode"""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    with Image.open(source) as image:
+        if max(image.size) > side:
+            scale = side / max(image.size)
+            image.draft('RGB', (int(np.ceil(image.width * scale)), int(np.ceil(image.height * scale))))
+        image = image.convert('RGB')
+        image.thumbnail((side, side))
+        return np.asarray(image)
+
+
+def _thumbnail_from_array(image, side, bgr=False):
+    h, w = image.shape[:2]
+    if max(h, w) > side:
+        scale = side / max(h, w)
+        image = cv2.resize(image, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB) if bgr else image
+
+
+def score(rgb):
+    """Quality scores of a small RGB image"""
+    gray = cv2.cvtColor(rgb, cv2.COLOR_RGB2GRAY)
+    channels = rgb.astype(np.float32)
+    total = np.maximum(channels.sum(axis=2), 1)
+    exg = (2 * channels[..., 1] - channels[..., 0] - channels[..., 2]) / total
+    return {
+        'sharpness': float(cv2.Laplacian(gray, cv2.CV_64F).var()),
+        'brightness': float(gray.mean()),
+        'dark': float(np.mean(gray <= DARK_LEVEL)),
+        'bright': float(np.mean(gray >= BRIGHT_LEVEL)),
+        'vegetation': float(np.mean(exg > VEGETATION_EXG)),
+    }
+
+
+class QualityGate:
+    """Accepts, tags or drops frames against thresholds
+    Args:
+        min_sharpness: Laplacian variance below which a frame is blurry
+        max_dark: Fraction of clipped shadows above which a frame is underexposed
+        max_bright: Fraction of clipped highlights above which a frame is overexposed
+        min_vegetation: Vegetation fraction below which a frame is low_vegetation, 0 disables the check
+        drop: Problems that drop a frame, the others tag it
+        side: Long side the frame is scored at
+    """
+
+    def __init__(self, min_sharpness=60.0, max_dark=0.3, max_bright=0.3, min_vegetation=0.05,
+                 drop=('blurry', 'underexposed', 'overexposed'), side=SIDE):
+        self.min_sharpness = min_sharpness
+        self.max_dark = max_dark
+        self.max_bright = max_bright
+        self.min_vegetation = min_vegetation
+        self.drop = set(drop)
+        self.side = side
+        self.reset()
+
+    def reset(self):
+        """Start counting decisions from zero, e.g. for a new capture session"""
+        self.counts = {'accept': 0, 'tag': 0, 'drop': 0}
+
+    @classmethod
+    def load(cls, path=None):
+        """Gate with the thresholds of a JSON file ({"min_sharpness": 40, "drop": ["blurry"], ...}), defaults without one"""
+        if not path:
+            return cls()
+        with open(path) as f:
+            return cls(**json.load(f))
+
+    def problems(self, scores):
+        found = []
+        if scores['sharpness'] < self.min_sharpness:
+            found.append('blurry')
+        if scores['dark'] > self.max_dark:
+            found.append('underexposed')
+        if scores['bright'] > self.max_bright:
+            found.append('overexposed')
+        if self.min_vegetation and scores['vegetation'] < self.min_vegetation:
+            found.append('low_vegetation')
+        return found
+
+    def decide(self, scores):
+        """Verdict for a frame's scores: {'decision': 'accept'|'tag'|'drop', 'problems': [...], 'scores': {...}}"""
+        problems = self.problems(scores)
+        if any(problem in self.drop for problem in problems):
+            decision = 'drop'
+        elif problems:
+            decision = 'tag'
+        else:
+            decision = 'accept'
+        self.counts[decision] += 1
+        return {'decision': decision, 'problems': problems, 'scores': {k: round(v, 4) for k, v in scores.items()}}
+
+    def check_file(self, source):
+        """Verdict for an encoded image, given as a path or bytes"""
+        return self.decide(score(_thumbnail_from_source(source, self.side)))
+
+    def check_image(self, image, bgr=False):
+        """Verdict for a decoded RGB (or BGR) array"""
+        return self.decide(score(_thumbnail_from_array(image, self.side, bgr)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score frames with the quality gate")
+    parser.add_argument('inputs', nargs='+', help="images or directories of images")
+    parser.add_argument('--thresholds', default=None, help="JSON file with QualityGate arguments")
+    args = parser.parse_args()
+
+    gate = QualityGate.load(args.thresholds)
+    paths = []
+    for source in args.inputs:
+        if os.path.isdir(source):
+            paths.extend(os.path.join(source, name) for name in sorted(os.listdir(source))
+                         if name.lower().endswith(('.jpg', '.jpeg', '.png')))
+        else:
+            paths.append(source)
+    print(f"{'image':<32} {'sharpness':>9} {'dark':>6} {'bright':>6} {'veg':>6}  decision")
+    for path in paths:
+        try:
+            verdict = gate.check_file(path)
+        except Exception as e:
+            print(f"{os.path.basename(path):<32} error: {str(e)}")
+            continue
+        s = verdict['scores']
+        print(f"{os.path.basename(path):<32} {s['sharpness']:9.1f} {s['dark']:6.3f} {s['bright']:6.3f} "
+              f"{s['vegetation']:6.3f}  {verdict['decision']} {' '.join(verdict['problems'])}")
+    print(f"accepted {gate.counts['accept']}, tagged {gate.counts['tag']}, dropped {gate.counts['drop']}")
+
+
+if __name__ == "__main__":
+    main()
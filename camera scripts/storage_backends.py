@@ -0,0 +1,581 @@
+import os
+import json
+import base64
+import hashlib
+import asyncio
+import shutil
+import weakref
+import datetime
+import threading
+import mimetypes
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+import google_crc32c # type: ignore
+
+# Pluggable async storage backends.
+#
+# The capture scripts talk to storage through the interface below instead of
+# calling google.cloud.storage directly. open_backend() picks the
+# implementation from a URL:
+#   gs://bucket          Google Cloud Storage, over the JSON API with a pooled keep-alive client
+#   s3://bucket          S3 or an S3-compatible store (set endpoint_url for MinIO etc.)
+#   file:///some/dir     a local directory standing in for a bucket, for offline runs
+#
+# All methods are coroutines. Blocking client libraries run on a thread pool,
+# and every backend bounds the number of requests in flight with a semaphore.
+# put() hashes the data while it is sent and checks it against the hash the
+# server returns, so no extra request is needed to verify an upload.
+# Synchronous code runs them with run() or submit(), which share one
+# long-lived event loop so connection pools are reused across calls.
+
+DEFAULT_CONCURRENCY = 8
+
+_loop = None
+_loop_thread = None
+_loop_lock = threading.Lock()
+
+
+def find_credentials_file(directory="."):
+    """Return the first JSON file in the directory, the scripts keep the service account key next to them"""
+    json_files = sorted(f for f in os.listdir(directory) if f.endswith('.json'))
+    if not json_files:
+        return None
+    return os.path.join(directory, json_files[0])
+
+
+def guess_content_type(object_name):
+    content_type, _ = mimetypes.guess_type(object_name)
+    return content_type or 'application/octet-stream'
+
+
+class IntegrityError(Exception):
+    """The hash reported by the server does not match the data that was sent"""
+
+
+class StreamHasher:
+    """crc32c and MD5 of data fed to it chunk by chunk, base64 encoded like GCS reports them"""
+
+    def __init__(self):
+        self._crc32c = google_crc32c.Checksum()
+        self._md5 = hashlib.md5()
+        self.size = 0
+
+    def update(self, chunk):
+        self._crc32c.update(chunk)
+        self._md5.update(chunk)
+        self.size += len(chunk)
+        return chunk
+
+    @property
+    def crc32c(self):
+        return base64.b64encode(self._crc32c.digest()).decode('ascii')
+
+    @property
+    def md5(self):
+        return base64.b64encode(self._md5.digest()).decode('ascii')
+
+    def info(self, object_name):
+        return {'name': object_name, 'size': self.size, 'crc32c': self.crc32c, 'md5': self.md5}
+
+    def verify(self, object_name, crc32c=None, md5=None):
+        """Compare with the hashes returned by the server, returns the upload info or raises IntegrityError"""
+        if crc32c is not None and crc32c != self.crc32c:
+            raise IntegrityError(f"crc32c mismatch for {object_name}: sent {self.crc32c}, server has {crc32c}")
+        if md5 is not None and md5 != self.md5:
+            raise IntegrityError(f"MD5 mismatch for {object_name}: sent {self.md5}, server has {md5}")
+        return self.info(object_name)
+
+
+def persisted_bytes(headers):
+    """Bytes a resumable upload session has stored, from the Range header of a 308 ('bytes=0-N')"""
+    byte_range = headers.get('Range')
+    if not byte_range:
+        return 0
+    return int(byte_range.rsplit('-', 1)[1]) + 1
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    """Hash a local file with a StreamHasher"""
+    hasher = StreamHasher()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher
+
+
+def background_loop():
+    """Return the event loop shared by all synchronous callers, started on first use"""
+    global _loop, _loop_thread
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            _loop_thread = threading.Thread(target=_loop.run_forever, name="storage-loop", daemon=True)
+            _loop_thread.start()
+    return _loop
+
+
+def submit(coroutine):
+    """Schedule a backend coroutine on the background loop without waiting, returns a concurrent.futures.Future"""
+    return asyncio.run_coroutine_threadsafe(coroutine, background_loop())
+
+
+def run(coroutine):
+    """Run a backend coroutine from synchronous script code and return its result"""
+    if threading.current_thread() is _loop_thread:
+        raise RuntimeError("run() called from the storage loop, await the coroutine instead")
+    return submit(coroutine).result()
+
+
+class StorageBackend:
+    """Async object storage interface
+
+    put(source, object_name) uploads a local path or bytes and returns a dict
+    with the object's name, size, crc32c and md5 once the server has confirmed
+    them. get(object_name, local_path=None) downloads to a path or returns the
+    bytes, list(prefix) returns object names, and compose(source_names,
+    object_name) concatenates existing objects into a new one.
+    """
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY):
+        self.concurrency = concurrency
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def _semaphore(self):
+        # a semaphore belongs to the event loop it was created on, and the
+        # scripts may call run() several times with a new loop each time
+        loop = asyncio.get_running_loop()
+        if loop not in self._semaphores:
+            self._semaphores[loop] = asyncio.Semaphore(self.concurrency)
+        return self._semaphores[loop]
+
+    async def _call(self, func, *args):
+        async with self._semaphore():
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, func, *args)
+
+    async def put(self, source, object_name, content_type=None, cache_control=None):
+        raise NotImplementedError
+
+    async def get(self, object_name, local_path=None):
+        raise NotImplementedError
+
+    async def list(self, prefix=""):
+        raise NotImplementedError
+
+    async def compose(self, source_names, object_name, content_type=None):
+        raise NotImplementedError
+
+    async def exists(self, object_name):
+        raise NotImplementedError
+
+    async def signed_url(self, object_name, expiration=datetime.timedelta(hours=1)):
+        raise NotImplementedError
+
+    async def put_many(self, items):
+        """Upload (source, object_name) pairs concurrently, bounded by the backend's concurrency"""
+        return await asyncio.gather(*(self.put(source, object_name) for source, object_name in items))
+
+    async def get_many(self, object_names, local_dir):
+        """Download objects concurrently into a local directory, returns the local paths"""
+        paths = [os.path.join(local_dir, name) for name in object_names]
+        for path in paths:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        await asyncio.gather(*(self.get(name, path) for name, path in zip(object_names, paths)))
+        return paths
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+class GCSHttpBackend(StorageBackend):
+    """Google Cloud Storage over the JSON API with a pooled keep-alive aiohttp client
+
+    Requests share one connection pool, so many small uploads can be in flight
+    at once without a TLS handshake each. Objects larger than
+    RESUMABLE_THRESHOLD are sent with a chunked resumable upload.
+    """
+
+    API_URL = "https://storage.googleapis.com/storage/v1"
+    UPLOAD_URL = "https://storage.googleapis.com/upload/storage/v1"
+    SCOPES = ["https://www.googleapis.com/auth/devstorage.read_write"]
+    RESUMABLE_THRESHOLD = 8 * 1024 * 1024
+    CHUNK_SIZE = 8 * 1024 * 1024    # must be a multiple of 256 KiB
+
+    def __init__(self, bucket_name, credentials_file=None, concurrency=64, timeout=120, keepalive_timeout=60):
+        super().__init__(concurrency)
+        import google.auth # type: ignore
+        from google.oauth2 import service_account # type: ignore
+
+        credentials_file = credentials_file or find_credentials_file()
+        if credentials_file:
+            self.credentials = service_account.Credentials.from_service_account_file(
+                credentials_file, scopes=self.SCOPES)
+        else:
+            self.credentials, _ = google.auth.default(scopes=self.SCOPES)
+        self.bucket_name = bucket_name
+        self.timeout = timeout
+        self.keepalive_timeout = keepalive_timeout
+        self._sessions = weakref.WeakKeyDictionary()
+        self._token_lock = threading.Lock()
+        self._storage_client = None
+
+    def _session(self):
+        import aiohttp # type: ignore
+
+        loop = asyncio.get_running_loop()
+        if loop not in self._sessions:
+            connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=self.keepalive_timeout)
+            self._sessions[loop] = aiohttp.ClientSession(
+                connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._sessions[loop]
+
+    def _refresh_token(self):
+        import google.auth.transport.requests # type: ignore
+
+        with self._token_lock:
+            if not self.credentials.valid:
+                self.credentials.refresh(google.auth.transport.requests.Request())
+            return self.credentials.token
+
+    async def _request(self, method, url, expect=(200,), headers=None, **kwargs):
+        """Send one authorized request, returns (status, headers, body)"""
+        async with self._semaphore():
+            if not self.credentials.valid:
+                await asyncio.get_running_loop().run_in_executor(self._executor, self._refresh_token)
+            headers = dict(headers or {})
+            headers['Authorization'] = f"Bearer {self.credentials.token}"
+            async with self._session().request(method, url, headers=headers, **kwargs) as response:
+                body = await response.read()
+                if response.status not in expect:
+                    raise Exception(f"GCS {method} {url} failed with {response.status}: {body[:300]!r}")
+                return response.status, response.headers, body
+
+    def _object_url(self, object_name):
+        return f"{self.API_URL}/b/{self.bucket_name}/o/{quote(object_name, safe='')}"
+
+    async def put(self, source, object_name, content_type=None, cache_control=None):
+        import aiohttp # type: ignore
+
+        metadata = {'name': object_name, 'contentType': content_type or guess_content_type(object_name)}
+        if cache_control:
+            metadata['cacheControl'] = cache_control
+
+        loop = asyncio.get_running_loop()
+        if isinstance(source, (bytes, bytearray)):
+            data = bytes(source)
+        elif os.path.getsize(source) > self.RESUMABLE_THRESHOLD:
+            return await self._put_resumable(source, metadata)
+        else:
+            data = await loop.run_in_executor(self._executor, _read_file, source)
+
+        # the whole object is in memory, so the hashes go in the metadata and GCS rejects a corrupted upload
+        hasher = StreamHasher()
+        hasher.update(data)
+        metadata['crc32c'] = hasher.crc32c
+        metadata['md5Hash'] = hasher.md5
+
+        with aiohttp.MultipartWriter('related') as writer:
+            writer.append_json(metadata)
+            writer.append(data, {'Content-Type': metadata['contentType']})
+        _, _, body = await self._request(
+            'POST', f"{self.UPLOAD_URL}/b/{self.bucket_name}/o?uploadType=multipart", data=writer)
+        resource = json.loads(body)
+        return hasher.verify(object_name, resource.get('crc32c'), resource.get('md5Hash'))
+
+    async def _put_resumable(self, path, metadata):
+        size = os.path.getsize(path)
+        _, headers, _ = await self._request(
+            'POST', f"{self.UPLOAD_URL}/b/{self.bucket_name}/o?uploadType=resumable", json=metadata,
+            headers={'X-Upload-Content-Type': metadata['contentType'], 'X-Upload-Content-Length': str(size)})
+        session_url = headers['Location']
+
+        loop = asyncio.get_running_loop()
+        hasher = StreamHasher()
+        pending = b''   # bytes read (and hashed) that GCS hasn't persisted yet
+        offset = 0      # position of pending in the object
+        with open(path, 'rb') as f:
+            while True:
+                if len(pending) < self.CHUNK_SIZE:
+                    pending += hasher.update(
+                        await loop.run_in_executor(self._executor, f.read, self.CHUNK_SIZE - len(pending)))
+                content_range = f"bytes {offset}-{offset + len(pending) - 1}/{size}"
+                status, headers, body = await self._request(
+                    'PUT', session_url, expect=(200, 201, 308), data=pending,
+                    headers={'Content-Range': content_range})
+                if status in (200, 201):
+                    resource = json.loads(body)
+                    return hasher.verify(metadata['name'], resource.get('crc32c'), resource.get('md5Hash'))
+                # GCS may keep only part of a chunk, resend from the first byte it doesn't have
+                persisted = persisted_bytes(headers)
+                if not offset <= persisted <= offset + len(pending):
+                    raise Exception(f"GCS resumable upload of {metadata['name']} has {persisted} bytes, "
+                                    f"expected {offset} to {offset + len(pending)}")
+                pending = pending[persisted - offset:]
+                offset = persisted
+
+    async def get(self, object_name, local_path=None):
+        _, _, body = await self._request('GET', self._object_url(object_name) + "?alt=media")
+        if local_path is None:
+            return body
+        await asyncio.get_running_loop().run_in_executor(self._executor, _write_file, local_path, body)
+        return local_path
+
+    async def list(self, prefix=""):
+        names = []
+        params = {'prefix': prefix, 'fields': 'items(name),nextPageToken'}
+        while True:
+            _, _, body = await self._request('GET', f"{self.API_URL}/b/{self.bucket_name}/o", params=params)
+            page = json.loads(body)
+            names.extend(item['name'] for item in page.get('items', []))
+            if 'nextPageToken' not in page:
+                return names
+            params['pageToken'] = page['nextPageToken']
+
+    async def compose(self, source_names, object_name, content_type=None):
+        # GCS composes at most 32 objects per request, larger sets are composed in steps
+        sources = list(source_names)
+        destination = {'contentType': content_type or guess_content_type(object_name)}
+        while sources:
+            step, sources = sources[:32], sources[32:]
+            await self._request('POST', self._object_url(object_name) + "/compose", json={
+                'sourceObjects': [{'name': name} for name in step],
+                'destination': destination,
+            })
+            if sources:
+                sources.insert(0, object_name)
+        return object_name
+
+    async def exists(self, object_name):
+        status, _, _ = await self._request('GET', self._object_url(object_name) + "?fields=name",
+                                           expect=(200, 404))
+        return status == 200
+
+    def _signed_url(self, object_name, expiration):
+        # signing is local, the client library is only used for building the URL
+        from google.cloud import storage # type: ignore
+
+        if self._storage_client is None:
+            self._storage_client = storage.Client(credentials=self.credentials,
+                                                  project=getattr(self.credentials, 'project_id', None))
+        blob = self._storage_client.bucket(self.bucket_name).blob(object_name)
+        return blob.generate_signed_url(version="v4", expiration=expiration, method="GET")
+
+    async def signed_url(self, object_name, expiration=datetime.timedelta(hours=1)):
+        return await self._call(self._signed_url, object_name, expiration)
+
+    async def aclose(self):
+        for session in list(self._sessions.values()):
+            await session.close()
+
+    def close(self):
+        if _loop is not None and threading.current_thread() is not _loop_thread:
+            run(self.aclose())
+        super().close()
+
+
+class S3Backend(StorageBackend):
+    """S3 or an S3-compatible store (MinIO, Ceph, R2...) through boto3, on a thread pool"""
+
+    def __init__(self, bucket_name, endpoint_url=None, concurrency=DEFAULT_CONCURRENCY, **client_kwargs):
+        super().__init__(concurrency)
+        import boto3 # type: ignore
+        from botocore.config import Config # type: ignore
+
+        self.bucket_name = bucket_name
+        # boto3 clients are thread safe, one pooled client is shared by all workers
+        self.client = boto3.client('s3', endpoint_url=endpoint_url or os.environ.get("S3_ENDPOINT_URL"),
+                                   config=Config(max_pool_connections=concurrency), **client_kwargs)
+
+    MULTIPART_THRESHOLD = 8 * 1024 * 1024
+
+    def _put(self, source, object_name, content_type, cache_control):
+        extra = {'ContentType': content_type or guess_content_type(object_name)}
+        if cache_control:
+            extra['CacheControl'] = cache_control
+        if not isinstance(source, (bytes, bytearray)) and os.path.getsize(source) > self.MULTIPART_THRESHOLD:
+            # multipart ETags are not an MD5 of the object, S3 checks a CRC32C of every part instead
+            hasher = hash_file(source)
+            self.client.upload_file(source, self.bucket_name, object_name,
+                                    ExtraArgs=dict(extra, ChecksumAlgorithm='CRC32C'))
+            # a full object CRC32C can be compared, a composite one (crc-parts) only covers the parts
+            head = self.client.head_object(Bucket=self.bucket_name, Key=object_name, ChecksumMode='ENABLED')
+            crc32c = head.get('ChecksumCRC32C')
+            if crc32c is None or '-' in crc32c:
+                return hasher.info(object_name)
+            return hasher.verify(object_name, crc32c)
+
+        data = bytes(source) if isinstance(source, (bytes, bytearray)) else _read_file(source)
+        hasher = StreamHasher()
+        hasher.update(data)
+        # S3 checks Content-MD5 on its side, and a single part ETag is the hex MD5 of the object
+        result = self.client.put_object(Bucket=self.bucket_name, Key=object_name, Body=data,
+                                        ContentMD5=hasher.md5, **extra)
+        etag_md5 = base64.b64encode(bytes.fromhex(result['ETag'].strip('"'))).decode('ascii')
+        return hasher.verify(object_name, md5=etag_md5)
+
+    async def put(self, source, object_name, content_type=None, cache_control=None):
+        return await self._call(self._put, source, object_name, content_type, cache_control)
+
+    def _get(self, object_name, local_path):
+        if local_path is None:
+            return self.client.get_object(Bucket=self.bucket_name, Key=object_name)['Body'].read()
+        self.client.download_file(self.bucket_name, object_name, local_path)
+        return local_path
+
+    async def get(self, object_name, local_path=None):
+        return await self._call(self._get, object_name, local_path)
+
+    def _list(self, prefix):
+        names = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            names.extend(item['Key'] for item in page.get('Contents', []))
+        return names
+
+    async def list(self, prefix=""):
+        return await self._call(self._list, prefix)
+
+    def _compose(self, source_names, object_name, content_type):
+        # server side multipart copy, every part except the last must be at least 5 MB
+        upload = self.client.create_multipart_upload(
+            Bucket=self.bucket_name, Key=object_name,
+            ContentType=content_type or guess_content_type(object_name))
+        try:
+            parts = []
+            for number, name in enumerate(source_names, start=1):
+                result = self.client.upload_part_copy(
+                    Bucket=self.bucket_name, Key=object_name, UploadId=upload['UploadId'],
+                    PartNumber=number, CopySource={'Bucket': self.bucket_name, 'Key': name})
+                parts.append({'PartNumber': number, 'ETag': result['CopyPartResult']['ETag']})
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket_name, Key=object_name, UploadId=upload['UploadId'],
+                MultipartUpload={'Parts': parts})
+        except Exception:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket_name, Key=object_name, UploadId=upload['UploadId'])
+            raise
+        return object_name
+
+    async def compose(self, source_names, object_name, content_type=None):
+        return await self._call(self._compose, source_names, object_name, content_type)
+
+    def _exists(self, object_name):
+        try:
+            self.client.head_object(Bucket=self.bucket_name, Key=object_name)
+            return True
+        except self.client.exceptions.ClientError:
+            return False
+
+    async def exists(self, object_name):
+        return await self._call(self._exists, object_name)
+
+    def _signed_url(self, object_name, expiration):
+        return self.client.generate_presigned_url(
+            'get_object', Params={'Bucket': self.bucket_name, 'Key': object_name},
+            ExpiresIn=int(expiration.total_seconds()))
+
+    async def signed_url(self, object_name, expiration=datetime.timedelta(hours=1)):
+        return await self._call(self._signed_url, object_name, expiration)
+
+
+class LocalBackend(StorageBackend):
+    """A local directory standing in for a bucket, object names map to relative paths"""
+
+    def __init__(self, root, concurrency=DEFAULT_CONCURRENCY):
+        super().__init__(concurrency)
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, object_name):
+        path = os.path.abspath(os.path.join(self.root, object_name))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError(f"Object name {object_name} is outside of {self.root}")
+        return path
+
+    def _put(self, source, object_name, content_type, cache_control):
+        path = self._path(object_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary name first so readers never see a partial object
+        tmp_path = path + ".partial"
+        hasher = StreamHasher()
+        with open(tmp_path, 'wb') as out:
+            if isinstance(source, (bytes, bytearray)):
+                out.write(hasher.update(bytes(source)))
+            else:
+                with open(source, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                        out.write(hasher.update(chunk))
+        os.replace(tmp_path, path)
+        return hasher.info(object_name)
+
+    async def put(self, source, object_name, content_type=None, cache_control=None):
+        return await self._call(self._put, source, object_name, content_type, cache_control)
+
+    def _get(self, object_name, local_path):
+        path = self._path(object_name)
+        if local_path is None:
+            with open(path, 'rb') as f:
+                return f.read()
+        shutil.copyfile(path, local_path)
+        return local_path
+
+    async def get(self, object_name, local_path=None):
+        return await self._call(self._get, object_name, local_path)
+
+    def _list(self, prefix):
+        names = []
+        for directory, _, files in os.walk(self.root):
+            for filename in files:
+                if filename.endswith(".partial"):
+                    continue
+                name = os.path.relpath(os.path.join(directory, filename), self.root).replace(os.sep, '/')
+                if name.startswith(prefix):
+                    names.append(name)
+        return sorted(names)
+
+    async def list(self, prefix=""):
+        return await self._call(self._list, prefix)
+
+    def _compose(self, source_names, object_name, content_type):
+        path = self._path(object_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".partial"
+        with open(tmp_path, 'wb') as out:
+            for name in source_names:
+                with open(self._path(name), 'rb') as f:
+                    shutil.copyfileobj(f, out)
+        os.replace(tmp_path, path)
+        return object_name
+
+    async def compose(self, source_names, object_name, content_type=None):
+        return await self._call(self._compose, source_names, object_name, content_type)
+
+    async def exists(self, object_name):
+        return os.path.exists(self._path(object_name))
+
+    async def signed_url(self, object_name, expiration=datetime.timedelta(hours=1)):
+        return "file://" + self._path(object_name)
+
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _write_file(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def open_backend(url, **kwargs):
+    """Create a storage backend from a gs://, s3:// or file:// URL (a plain path means file://)"""
+    if url.startswith("gs://"):
+        return GCSHttpBackend(url[len("gs://"):].strip('/'), **kwargs)
+    if url.startswith("s3://"):
+        return S3Backend(url[len("s3://"):].strip('/'), **kwargs)
+    if url.startswith("file://"):
+        return LocalBackend(url[len("file://"):], **kwargs)
+    if "://" in url:
+        raise ValueError(f"Unsupported storage URL: {url}")
+    return LocalBackend(url, **kwargs)
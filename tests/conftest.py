@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the scripts import each other by name from their own directories
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for directory in ("Pipelines", "camera scripts"):
+    sys.path.insert(0, os.path.join(ROOT, directory))
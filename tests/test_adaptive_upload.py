@@ -0,0 +1,55 @@
+import sys
+import functools
+import numpy as np
+from PIL import Image
+import storage_backends
+import capture_manifest
+import adaptive_upload
+
+# every capture goes up as a thumbnail, so all originals wait for backfill
+THUMBNAILS = [{'name': 'thumbnail', 'max_backlog': float('inf'), 'quality': 70, 'max_side': 32}]
+
+
+def capture_session(tmp_path, backend, count):
+    """A photo session whose captures were all uploaded degraded, with its manifest uploaded"""
+    manifest = capture_manifest.new_session("photo", {'iso': '100'}, str(tmp_path / "manifests"))
+
+    def upload(local_path, object_name, content_type):
+        return storage_backends.run(backend.put(local_path, object_name, content_type))
+
+    uploader = adaptive_upload.AdaptiveUploader(upload, THUMBNAILS, str(tmp_path / "spool"),
+                                                functools.partial(capture_manifest.record_upload, manifest))
+    rng = np.random.default_rng(0)
+    for i in range(count):
+        path = tmp_path / f"capture_{i}.jpg"
+        Image.fromarray(rng.integers(0, 256, (64, 96, 3), dtype=np.uint8)).save(path)
+        uploader.submit(str(path), f"image_{i}.jpg", capture_time=f"2024-05-14T10:00:0{i}",
+                        metadata={'quality': 'accept'}, session=manifest['session_id'])
+    uploader.close()
+    capture_manifest.upload_manifest(manifest, backend)
+    return manifest
+
+
+def test_backfill_goes_into_the_capturing_session(tmp_path, monkeypatch):
+    backend = storage_backends.open_backend(f"file://{tmp_path / 'bucket'}")
+    try:
+        first = capture_session(tmp_path, backend, 3)
+        capture_manifest.new_session("photo", {}, str(tmp_path / "manifests"))   # a later session
+        # the local copy is gone, the manifest comes back from the bucket
+        (tmp_path / "manifests" / f"session_{first['session_id']}.jsonl").unlink()
+
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setattr(sys, 'argv', ["adaptive_upload.py", "--storage-url", f"file://{tmp_path / 'bucket'}",
+                                          "--spool-dir", str(tmp_path / "spool")])
+        adaptive_upload.main()
+
+        entries = capture_manifest.load_manifest(backend, first['session_id'])
+        assert sorted(entry['object_name'] for entry in entries) == ["image_0.jpg", "image_1.jpg", "image_2.jpg"]
+        for entry in entries:
+            assert entry['variant'] == 'original' and entry['replaces'] == 'thumbnail'
+            assert entry['quality'] == 'accept'
+            original = storage_backends.run(backend.get(entry['object_name']))
+            assert entry['size'] == len(original)
+        assert not list((tmp_path / "spool" / "backfill").rglob("*.jpg"))
+    finally:
+        backend.close()
@@ -0,0 +1,34 @@
+import numpy as np
+import cv2
+import keyframes
+
+
+def panned_frames(count, step, size=(240, 320), seed=0):
+    """Frames of a camera panning right over blurred noise by step pixels per frame"""
+    h, w = size
+    rng = np.random.default_rng(seed)
+    scene = cv2.GaussianBlur(rng.integers(0, 256, (h, w + count * step, 3), dtype=np.uint8), (0, 0), 3)
+    return [np.ascontiguousarray(scene[:, i * step:i * step + w]) for i in range(count)]
+
+
+def test_pan_takes_keyframes_at_the_expected_overlap():
+    step, width = 10, 320
+    selector = keyframes.KeyframeSelector(min_new_ground=0.4)
+    for index, frame in enumerate(panned_frames(80, step, (240, width))):
+        selector.add(index, frame)
+    # new ground reaches 0.4 once the shift since the last keyframe covers 40% of the width
+    every = int(np.ceil(0.4 * width / step))
+    assert [k['index'] for k in selector.keyframes] == list(range(0, 80, every))
+    assert [k['reason'] for k in selector.keyframes[1:]] == ['new_ground'] * (len(selector.keyframes) - 1)
+    for keyframe in selector.keyframes[1:]:
+        assert abs(keyframe['new_ground'] - every * step / width) < 0.01
+
+
+def test_aligned_frames_match_the_keyframe():
+    selector = keyframes.KeyframeSelector(min_new_ground=0.9)
+    for index, frame in enumerate(panned_frames(20, 5)):
+        selector.add(index, frame)
+        # the part a pure pan shares with the keyframe is the same picture
+        assert selector._change(selector._previous) < 0.01
+    assert [k['reason'] for k in selector.keyframes] == ['first']
+
@@ -0,0 +1,70 @@
+import numpy as np
+import cv2
+import mask_rle
+import mask_features
+
+
+def striped_image(size=(40, 60)):
+    """Red grows with the column, blue with the row, green is constant"""
+    h, w = size
+    image = np.zeros((h, w, 3), dtype=np.uint8)
+    image[..., 0] = 2 * np.arange(w)[None, :]
+    image[..., 1] = 100
+    image[..., 2] = np.arange(h)[:, None]
+    return image
+
+
+def test_square_by_hand():
+    mask = np.zeros((40, 60), dtype=bool)
+    mask[5:15, 3:13] = True
+    features = mask_features.extract_features(striped_image(), [{'segmentation': mask_rle.encode(mask)}])
+    assert features['area'][0] == 100
+    assert [features[name][0] for name in ['bbox_x', 'bbox_y', 'bbox_w', 'bbox_h']] == [3, 5, 10, 10]
+    # the 36 pixels on the edge of a 10x10 square
+    assert features['perimeter'][0] == 36
+    assert np.isclose(features['red_mean'][0], 15.0)                  # 2 * mean(3..12)
+    assert np.isclose(features['red_std'][0], 2 * np.sqrt(8.25))      # 2 * std(3..12)
+    assert np.isclose(features['green_mean'][0], 100.0) and np.isclose(features['green_std'][0], 0.0)
+    assert np.isclose(features['blue_mean'][0], 9.5)                  # mean(5..14)
+
+
+def brute_force(image, mask):
+    """Some of the features of one boolean mask, straight from the pixel arrays"""
+    hsv = cv2.cvtColor(image, cv2.COLOR_RGB2HSV)
+    gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY).astype(np.float32)
+    padded = np.pad(mask, 1)
+    interior = mask & padded[:-2, 1:-1] & padded[2:, 1:-1] & padded[1:-1, :-2] & padded[1:-1, 2:]
+    # pixels on the image border count as edge pixels
+    interior[[0, -1], :] = False
+    interior[:, [0, -1]] = False
+    exg = dict(mask_features.vegetation_indices(image))['exg']
+    return {
+        'area': mask.sum(),
+        'perimeter': (mask & ~interior).sum(),
+        'red_mean': image[..., 0][mask].mean(), 'green_std': image[..., 1][mask].std(),
+        'saturation_mean': hsv[..., 1][mask].mean(), 'value_std': hsv[..., 2][mask].std(),
+        'exg_mean': exg[mask].mean(), 'gray_std': gray[mask].std(),
+    }
+
+
+def test_nested_masks_use_their_own_pixels(monkeypatch):
+    rng = np.random.default_rng(0)
+    image = cv2.GaussianBlur(rng.integers(0, 256, (40, 60, 3), dtype=np.uint8), (0, 0), 2)
+    plant = np.zeros((40, 60), dtype=bool)
+    plant[0:30, 10:50] = True
+    leaf = np.zeros((40, 60), dtype=bool)
+    leaf[5:12, 20:28] = True
+    other = np.zeros((40, 60), dtype=bool)
+    other[25:40, 40:60] = True
+    masks = [{'segmentation': mask_rle.encode(mask)} for mask in [plant, leaf, other]]
+
+    features = mask_features.extract_features(image, masks)
+    for i, mask in enumerate([plant, leaf, other]):
+        for name, value in brute_force(image, mask).items():
+            assert np.isclose(features[name][i], value, atol=1e-4), (i, name)
+
+    # a chunk per mask gives the same columns
+    monkeypatch.setattr(mask_features, 'MAX_CHUNK_PIXELS', 1)
+    chunked = mask_features.extract_features(image, masks)
+    for name, values in features.items():
+        assert np.allclose(chunked[name], values), name
@@ -0,0 +1,54 @@
+import numpy as np
+import mask_rle
+import mask_nms
+
+
+def record(mask, score, bbox=None):
+    rle = mask_rle.encode(mask)
+    return {'segmentation': rle, 'predicted_iou': score, 'bbox': bbox or mask_rle.bbox(rle)}
+
+
+def test_identical_thin_masks_are_duplicates():
+    mask = np.zeros((200, 200), dtype=bool)
+    mask[50:150, 60:63] = True
+    # the generator's box convention, one pixel short of the mask
+    records = [record(mask, 0.9, [60, 50, 2, 99]), record(mask, 0.8, [60, 50, 2, 99])]
+    assert mask_nms.nms(records) == [0]
+
+
+def test_one_pixel_wide_masks_are_compared():
+    mask = np.zeros((200, 200), dtype=bool)
+    mask[50:150, 60] = True
+    records = [record(mask, 0.8, [60, 50, 0, 99]), record(mask, 0.9, [60, 50, 0, 99])]
+    assert mask_nms.nms(records) == [1]
+
+
+def test_separate_and_contained_masks():
+    big = np.zeros((100, 100), dtype=bool)
+    big[10:60, 10:60] = True
+    small = np.zeros((100, 100), dtype=bool)
+    small[20:30, 20:30] = True
+    apart = np.zeros((100, 100), dtype=bool)
+    apart[70:90, 70:90] = True
+    records = [record(big, 0.9), record(small, 0.8), record(apart, 0.7)]
+    assert mask_nms.nms(records, iou_thresh=0.5) == [0, 1, 2]
+    assert mask_nms.nms(records, iou_thresh=0.5, containment_thresh=0.9) == [0, 2]
+
+
+def test_matches_brute_force():
+    rng = np.random.default_rng(0)
+    records = []
+    for _ in range(40):
+        mask = np.zeros((64, 64), dtype=bool)
+        x, y = rng.integers(0, 56, 2)
+        w, h = rng.integers(1, 9, 2)
+        mask[y:y + h, x:x + w] = True
+        records.append(record(mask, float(rng.random())))
+    keep = mask_nms.nms(records, iou_thresh=0.5)
+
+    order = np.argsort([-r['predicted_iou'] for r in records], kind='stable')
+    expected = []
+    for i in order:
+        if all(mask_rle.iou(records[i]['segmentation'], records[j]['segmentation']) <= 0.5 for j in expected):
+            expected.append(int(i))
+    assert keep == expected
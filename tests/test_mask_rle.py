@@ -0,0 +1,56 @@
+import numpy as np
+import mask_rle
+
+
+def random_masks(count, size, seed=0):
+    rng = np.random.default_rng(seed)
+    masks = []
+    for _ in range(count):
+        mask = np.zeros(size, dtype=bool)
+        for _ in range(rng.integers(1, 4)):
+            x, y = rng.integers(0, size[1]), rng.integers(0, size[0])
+            w, h = rng.integers(1, size[1] // 2), rng.integers(1, size[0] // 2)
+            mask[y:y + h, x:x + w] = True
+        masks.append(mask)
+    return masks
+
+
+def test_encode_decode_round_trip():
+    masks = random_masks(20, (37, 53))
+    full = np.ones((5, 4), dtype=bool)
+    empty = np.zeros((5, 4), dtype=bool)
+    for mask in masks + [full, empty]:
+        rle = mask_rle.encode(mask)
+        assert rle['size'] == list(mask.shape)
+        assert sum(rle['counts']) == mask.size
+        assert np.array_equal(mask_rle.decode(rle), mask)
+        assert mask_rle.area(rle) == mask.sum()
+    # counts start with a run of zeros, column-major
+    assert mask_rle.encode(full)['counts'][0] == 0
+    corner = np.zeros((3, 3), dtype=bool)
+    corner[1, 0] = True
+    assert mask_rle.encode(corner)['counts'] == [1, 1, 7]
+
+
+def test_bbox_counts_pixels():
+    for mask in random_masks(20, (37, 53), seed=1):
+        rows, columns = np.nonzero(mask)
+        expected = [columns.min(), rows.min(), columns.max() - columns.min() + 1, rows.max() - rows.min() + 1]
+        assert mask_rle.bbox(mask_rle.encode(mask)) == expected
+    line = np.zeros((10, 10), dtype=bool)
+    line[2:8, 4] = True
+    assert mask_rle.bbox(mask_rle.encode(line)) == [4, 2, 1, 6]
+    assert mask_rle.bbox(mask_rle.encode(np.zeros((4, 4), dtype=bool))) == [0, 0, 0, 0]
+    assert mask_rle.bboxes([]).shape == (0, 4)
+
+
+def test_translate_into_frame():
+    frame_size = (60, 80)
+    for mask in random_masks(20, (25, 30), seed=2):
+        for offset in [(0, 0), (7, 11), (50, 35)]:
+            x0, y0 = offset
+            expected = np.zeros(frame_size, dtype=bool)
+            expected[y0:y0 + 25, x0:x0 + 30] = mask
+            moved = mask_rle.translate(mask_rle.encode(mask), offset, frame_size)
+            assert moved['size'] == list(frame_size)
+            assert np.array_equal(mask_rle.decode(moved), expected)
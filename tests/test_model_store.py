@@ -0,0 +1,37 @@
+import hashlib
+import pytest
+
+pytest.importorskip("segment_anything")
+import model_store  # noqa: E402
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    path = tmp_path / model_store.CHECKPOINTS['vit_b']
+    path.write_bytes(b"weights" * 1000)
+    monkeypatch.setitem(model_store.EXPECTED_SHA256, path.name, hashlib.sha256(path.read_bytes()).hexdigest())
+    return tmp_path, path
+
+
+def test_pinned_checkpoint_is_verified_and_recorded(cache):
+    cache_dir, path = cache
+    assert model_store.checkpoint_path('vit_b', str(cache_dir), allow_download=False) == str(path)
+    assert model_store._load_records(str(cache_dir))[path.name]['sha256'] == model_store.EXPECTED_SHA256[path.name]
+
+
+def test_mismatch_is_rejected_even_after_recording(cache, monkeypatch):
+    cache_dir, path = cache
+    model_store.checkpoint_path('vit_b', str(cache_dir), allow_download=False)
+    # the recorded hash is still compared with the pin
+    monkeypatch.setitem(model_store.EXPECTED_SHA256, path.name, "0" * 64)
+    with pytest.raises(model_store.ChecksumError):
+        model_store.checkpoint_path('vit_b', str(cache_dir), allow_download=False)
+
+
+def test_unpinned_checkpoint_needs_opt_in(tmp_path):
+    path = tmp_path / "sam_vit_b_finetuned.pth"
+    path.write_bytes(b"other weights")
+    with pytest.raises(model_store.ChecksumError):
+        model_store.expected_sha256(path.name)
+    assert model_store.expected_sha256(path.name, allow_unpinned=True) is None
+    assert model_store.verify(str(path), None) == hashlib.sha256(b"other weights").hexdigest()
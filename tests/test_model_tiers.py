@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("segment_anything")
+from segment_anything.build_sam import _build_sam  # noqa: E402
+import model_tiers  # noqa: E402
+
+SECONDS = {'vit_h@1024': 3.0, 'vit_l@1024': 1.6, 'vit_b@1024': 0.9, 'vit_b@512': 0.3}
+TIERS = [{'model_type': name.split('@')[0], 'input_size': int(name.split('@')[1])} for name in SECONDS]
+IMAGE = np.zeros((60, 80, 3), dtype=np.uint8)
+
+
+def tiny_sam(input_size=256):
+    # random weights, no checkpoint download needed
+    torch.manual_seed(0)
+    sam = _build_sam(encoder_embed_dim=64, encoder_depth=2, encoder_num_heads=2, encoder_global_attn_indexes=[1])
+    return model_tiers.set_input_size(sam.eval(), input_size)
+
+
+class StubLoader:
+    """Hands out a placeholder model per tier and remembers which tiers were loaded"""
+
+    def __init__(self):
+        self.loaded = []
+
+    def __call__(self, tier, device):
+        self.loaded.append(model_tiers.tier_name(tier))
+        return model_tiers.tier_name(tier)
+
+
+@pytest.fixture
+def benchmarked(monkeypatch):
+    runs = []
+
+    def benchmark(sam, image, repeats=3, **generator_params):
+        runs.append(sam)
+        return SECONDS[sam]
+
+    monkeypatch.setattr(model_tiers, 'benchmark', benchmark)
+    return runs
+
+
+def test_picks_the_most_accurate_tier_in_budget(tmp_path, benchmarked):
+    loader = StubLoader()
+    results_path = str(tmp_path / "model_tiers.json")
+    tier, sam = model_tiers.auto_select(1.0, TIERS, IMAGE, "cpu", loader, results_path, points_per_side=8)
+    assert tier == {'model_type': 'vit_b', 'input_size': 1024, 'seconds': 0.9}
+    assert sam == 'vit_b@1024'
+    # the benchmarked model is returned, not loaded again, and tiers after the pick are never tried
+    assert loader.loaded == benchmarked == ['vit_h@1024', 'vit_l@1024', 'vit_b@1024']
+    (stored,) = model_tiers.load_results(results_path).values()
+    assert stored['seconds'] == {name: SECONDS[name] for name in loader.loaded}
+
+
+def test_stored_measurements_are_reused(tmp_path, benchmarked):
+    results_path = str(tmp_path / "model_tiers.json")
+    model_tiers.auto_select(1.0, TIERS, IMAGE, "cpu", StubLoader(), results_path, points_per_side=8)
+    del benchmarked[:]
+
+    loader = StubLoader()
+    tier, _ = model_tiers.auto_select(2.0, TIERS, IMAGE, "cpu", loader, results_path, points_per_side=8)
+    assert model_tiers.tier_name(tier) == 'vit_l@1024'
+    assert benchmarked == []
+    assert loader.loaded == ['vit_l@1024']
+
+    # other generator parameters are measured again
+    model_tiers.auto_select(2.0, TIERS, IMAGE, "cpu", StubLoader(), results_path, points_per_side=16)
+    assert benchmarked == ['vit_h@1024', 'vit_l@1024']
+    assert len(model_tiers.load_results(results_path)) == 2
+
+
+def test_fastest_tier_when_nothing_fits(tmp_path, benchmarked):
+    loader = StubLoader()
+    tier, sam = model_tiers.auto_select(0.1, TIERS, IMAGE, "cpu", loader, str(tmp_path / "model_tiers.json"))
+    assert model_tiers.tier_name(tier) == sam == 'vit_b@512'
+    assert benchmarked == list(SECONDS)
+
+
+def test_benchmark_runs_a_random_weight_model(tmp_path):
+    tier, sam = model_tiers.auto_select(
+        60.0, [{'model_type': 'vit_b', 'input_size': 256}], IMAGE, "cpu",
+        lambda tier, device: tiny_sam(tier['input_size']), str(tmp_path / "model_tiers.json"),
+        repeats=1, points_per_side=2)
+    assert tier['seconds'] > 0
+    assert sam.image_encoder.img_size == 256
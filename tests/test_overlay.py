@@ -0,0 +1,93 @@
+import numpy as np
+import cv2
+import mask_rle
+import overlay
+
+
+def random_masks(size=(30, 50), count=12, seed=0):
+    """Overlapping rectangles and blobs of random sizes"""
+    rng = np.random.default_rng(seed)
+    h, w = size
+    masks = []
+    for _ in range(count):
+        mask = np.zeros(size, dtype=bool)
+        y, x = rng.integers(0, h), rng.integers(0, w)
+        mask[y:y + rng.integers(1, h), x:x + rng.integers(1, w)] = True
+        mask &= rng.random(size) < 0.9
+        masks.append(mask)
+    return masks
+
+
+def painted(masks):
+    """Reference label map: paint the masks largest first, one at a time"""
+    order = sorted(range(len(masks)), key=lambda i: masks[i].sum(), reverse=True)
+    labels = np.zeros(masks[0].shape, dtype=np.uint16)
+    for label, i in enumerate(order, start=1):
+        labels[masks[i]] = label
+    return labels, order
+
+
+def test_label_map_matches_painting():
+    masks = random_masks()
+    expected, order = painted(masks)
+    # RLE records, boolean records and bare RLEs label alike
+    records = [{'segmentation': mask_rle.encode(m), 'id': i} for i, m in enumerate(masks)]
+    labels, ordered = overlay.label_map(records)
+    assert labels.dtype == np.uint16
+    assert np.array_equal(labels, expected)
+    assert [r['id'] for r in ordered] == order
+    assert np.array_equal(overlay.label_map([{'segmentation': m} for m in masks])[0], expected)
+    assert np.array_equal(overlay.label_map([mask_rle.encode(m) for m in masks])[0], expected)
+
+
+def test_label_map_groups(monkeypatch):
+    masks = random_masks(count=7, seed=3)
+    expected, _ = painted(masks)
+    # masks scattered a few at a time
+    monkeypatch.setattr(overlay, 'MAX_SCATTER_PIXELS', 100)
+    labels, _ = overlay.label_map([mask_rle.encode(m) for m in masks])
+    assert np.array_equal(labels, expected)
+
+
+def test_label_map_empty():
+    labels, records = overlay.label_map([], (4, 5))
+    assert records == [] and labels.shape == (4, 5) and not labels.any()
+    empty = mask_rle.encode(np.zeros((4, 5), dtype=bool))
+    assert not overlay.label_map([empty])[0].any()
+
+
+def test_palette_is_stable():
+    palette = overlay.make_palette(20, alpha=0.5, seed=7)
+    assert palette.shape == (21, 4) and palette.dtype == np.uint8
+    assert not palette[0].any()
+    assert (palette[1:, 3] == 128).all()
+    assert np.array_equal(palette, overlay.make_palette(20, alpha=0.5, seed=7))
+    # more labels keep the colors of the first ones
+    assert np.array_equal(overlay.make_palette(30, alpha=0.5, seed=7)[:21], palette)
+    assert not np.array_equal(overlay.make_palette(20, alpha=0.5, seed=8), palette)
+
+
+def test_render(tmp_path):
+    image = np.full((20, 30, 3), 200, dtype=np.uint8)
+    big = np.zeros((20, 30), dtype=bool)
+    big[2:18, 2:28] = True
+    small = np.zeros((20, 30), dtype=bool)
+    small[5:10, 5:10] = True
+    masks = [mask_rle.encode(small), mask_rle.encode(big)]
+    path = str(tmp_path / "preview.png")
+    preview = overlay.render(image, masks, path, alpha=0.4, seed=1)
+
+    palette = overlay.make_palette(2, 0.4, 1).astype(np.int64)
+    alpha = palette[1, 3]
+    def mixed(color):
+        return (200 * (255 - alpha) + color[:3] * alpha + 127) // 255
+    assert (image == 200).all()                               # copied, not blended in place
+    assert (preview[~big] == 200).all()
+    assert (preview[big & ~small] == mixed(palette[1])).all()  # the larger mask is label 1
+    assert (preview[small] == mixed(palette[2])).all()         # and the smaller one stays on top
+    assert np.array_equal(cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB), preview)
+    # same masks and seed, same picture
+    assert np.array_equal(overlay.render(image, masks, seed=1, alpha=0.4), preview)
+
+    small_preview = overlay.render(image, masks, alpha=0.4, seed=1, max_side=15)
+    assert small_preview.shape == (10, 15, 3)
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+segment_anything = pytest.importorskip("segment_anything")
+from segment_anything.build_sam import _build_sam  # noqa: E402
+import sam_batch  # noqa: E402
+import model_tiers  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def sam():
+    # a tiny random-weight model at a 256 pixel input, no checkpoint download needed
+    torch.manual_seed(0)
+    model = _build_sam(encoder_embed_dim=64, encoder_depth=2, encoder_num_heads=2,
+                       encoder_global_attn_indexes=[1])
+    return model_tiers.set_input_size(model.eval(), 256)
+
+
+def frames(count, size=(96, 128), seed=0):
+    rng = np.random.default_rng(seed)
+    return [rng.integers(0, 256, (*size, 3), dtype=np.uint8) for _ in range(count)]
+
+
+def test_batched_masks_match_the_generator(sam):
+    params = dict(points_per_side=4, pred_iou_thresh=0.0, stability_score_thresh=0.0,
+                  output_mode="uncompressed_rle")
+    images = frames(3)
+    generator = segment_anything.SamAutomaticMaskGenerator(sam, **params)
+    with torch.no_grad():
+        expected = [generator.generate(image) for image in images]
+
+    segmenter = sam_batch.BatchSegmenter(sam, max_batch=3, max_wait=1.0, **params)
+    try:
+        results = segmenter.segment_many(images)
+    finally:
+        segmenter.close()
+
+    assert segmenter.stats()['batches'] == 1
+    assert any(expected)
+    for masks, reference in zip(results, expected):
+        assert len(masks) == len(reference)
+        for mask, ref in zip(masks, reference):
+            assert mask['bbox'] == ref['bbox']
+            assert mask['point_coords'] == ref['point_coords']
+            assert mask['predicted_iou'] == pytest.approx(ref['predicted_iou'], abs=1e-4)
+            differing = np.logical_xor(segment_anything.utils.amg.rle_to_mask(mask['segmentation']),
+                                       segment_anything.utils.amg.rle_to_mask(ref['segmentation'])).mean()
+            assert differing < 1e-3
@@ -0,0 +1,68 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+import numpy as np
+import pytest
+import cv2
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("segment_anything")
+from segment_anything.build_sam import _build_sam  # noqa: E402
+import model_tiers  # noqa: E402
+import sam_service  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def server():
+    torch.manual_seed(0)
+    sam = model_tiers.set_input_size(_build_sam(encoder_embed_dim=64, encoder_depth=2, encoder_num_heads=2,
+                                                encoder_global_attn_indexes=[1]).eval(), 256)
+    service = sam_service.SegmentationService(sam, points_per_side=4)
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), sam_service.make_handler(service))
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield service, f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def post(url, query):
+    image = np.random.default_rng(0).integers(0, 256, (64, 80, 3), dtype=np.uint8)
+    data = cv2.imencode('.png', image)[1].tobytes()
+    try:
+        with urllib.request.urlopen(urllib.request.Request(f"{url}/segment?{query}", data=data)) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def test_check_overrides():
+    assert sam_service.check_overrides({'points_per_side': 16.0, 'pred_iou_thresh': 1}) == \
+        {'points_per_side': 16, 'pred_iou_thresh': 1.0}
+    for overrides in [{'output_mode': 'binary_mask'}, {'point_grids': [[0.5, 0.5]]}, {'points_per_side': 2.5},
+                      {'points_per_side': 'many'}, {'pred_iou_thresh': 2}, {'crop_n_layers': True}]:
+        with pytest.raises(ValueError):
+            sam_service.check_overrides(overrides)
+
+
+def test_bad_overrides_are_rejected(server):
+    _, url = server
+    for query in ["output_mode=binary_mask", "point_grids=[[0.5,0.5]]", "no_such_parameter=1",
+                  "points_per_side=abc"]:
+        status, body = post(url, query)
+        assert status == 400, query
+        assert 'error' in body
+    status, body = post(url, "points_per_side=2&pred_iou_thresh=0")
+    assert status == 200
+    assert all(set(mask['segmentation']) == {'size', 'counts'} for mask in body['masks'])
+
+
+def test_generators_are_bounded(server):
+    service, url = server
+    for points in range(1, sam_service.MAX_GENERATORS + 4):
+        assert post(url, f"points_per_side={points}")[0] == 200
+    assert len(service._generators) == sam_service.MAX_GENERATORS
+    # the most recently used override sets are the ones kept
+    assert (('points_per_side', sam_service.MAX_GENERATORS + 3),) in service._generators